@@ -0,0 +1,606 @@
+"""
+Benchmarks the BG-Counter Tools parser and downloader.
+
+Generates synthetic smart trap data in the same format as the data
+delivered by the Biogents API and times the main steps of parsing it:
+process_captures, make_collection and write_collection on their own,
+and parse_json as a whole, both from a JSON file and from a capture
+store.  The database isn't used; the parser is given metadata for the
+synthetic traps instead.  The generated data can be tuned to include
+duplicate captures, GPS drift, captures with zeroed coordinates and days
+on which the counter was off, and the same seed always generates the
+same data.
+
+With --download, download_data is also timed against a local fake API
+server that serves the synthetic data, delivering at most 1000 captures
+per trap for each request like the real API does.
+
+The results can be saved as a baseline, and later runs with the same
+settings are compared against it.  The script exits with a non-zero
+status if any step got slower than the baseline by more than the
+tolerance.
+
+For usage information, run with -h.
+
+This script requires at least Python 3.5.
+"""
+
+import argparse
+import bisect
+import contextlib
+import datetime as dt
+import gzip
+import json
+import math
+import os
+import platform
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import bg_common as com
+import bg_download_data
+import bg_json_parser
+
+# The prefix of the provider the synthetic traps belong to.
+prefix = 'bench'
+
+# The most captures the fake API delivers per trap for each request.
+limit = 1000
+
+
+def parse_args():
+    """Parse the command line arguments and return an args namespace."""
+    parser = argparse.ArgumentParser(description='Benchmarks the BG-Counter Tools parser and '
+                                                 'downloader on synthetic data.')
+
+    data_group = parser.add_argument_group('data arguments')
+    data_group.add_argument('--traps', type=int, default=10,
+                            help='The number of traps. Default: 10')
+    data_group.add_argument('--days', type=int, default=60,
+                            help='The number of days of captures per trap. Default: 60')
+    data_group.add_argument('--start-date', type=com.parse_date, default=dt.datetime(2018, 1, 1),
+                            help='The day the captures start on. Same acceptable formats as '
+                                 'bg_download_data.py. Default: 2018-01-01')
+    data_group.add_argument('--duplicates', type=float, default=0.02,
+                            help='The fraction of captures that are delivered twice. '
+                                 'Default: 0.02')
+    data_group.add_argument('--gps-drift', type=float, default=10,
+                            help='The greatest distance in meters that a reported location '
+                                 "strays from the trap's location. Default: 10")
+    data_group.add_argument('--zero-coordinates', type=float, default=0.01,
+                            help='The fraction of captures with coordinates of 0. Default: 0.01')
+    data_group.add_argument('--counter-off', type=float, default=0.05,
+                            help='The fraction of days on which the counter is off. '
+                                 'Default: 0.05')
+    data_group.add_argument('--seed', type=int, default=0,
+                            help='The seed to generate the data from. Default: 0')
+    data_group.add_argument('--save-data', metavar='FILE',
+                            help='Also write the generated data to this JSON file.')
+
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='The number of times to run each benchmark. The fastest run is '
+                             'kept. Default: 3')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help='The number of processes for parse_json. Default: 1')
+    parser.add_argument('--download', action='store_true',
+                        help='Also time download_data against a local fake API server.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='The number of seconds the fake API server takes to answer each '
+                             'request. Default: 0')
+    parser.add_argument('--shard', choices=bg_download_data.shard_units,
+                        help='Split the timeframe download_data is timed on at the start of each '
+                             'year, month or week and download the pieces in parallel. Default: '
+                             'download it as a whole')
+    parser.add_argument('-b', '--baseline', default='bg_benchmark_baseline.json',
+                        help='The file holding the baseline results. Default: '
+                             'bg_benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='The fraction by which a time may exceed the baseline before it '
+                             'counts as a regression. Default: 0.2')
+
+    args = parser.parse_args()
+
+    if args.traps < 1 or args.days < 1 or args.repeat < 1:
+        parser.error('--traps, --days and --repeat must be at least 1')
+
+    return args
+
+
+def run_benchmarks(traps=10, days=60, start_date=dt.datetime(2018, 1, 1), duplicates=0.02,
+                   gps_drift=10, zero_coordinates=0.01, counter_off=0.05, seed=0,
+                   save_data=None, repeat=3, processes=1, download=False, latency=0, shard=None,
+                   baseline='bg_benchmark_baseline.json', save_baseline=False, tolerance=0.2):
+    """Run all benchmarks and compare them against the baseline.
+
+    Returns a list of the names of the benchmarks that regressed.  See
+    parse_args for the meaning of the arguments.
+    """
+    settings = {
+        'traps': traps,
+        'days': days,
+        'start_date': start_date.isoformat(' '),
+        'duplicates': duplicates,
+        'gps_drift': gps_drift,
+        'zero_coordinates': zero_coordinates,
+        'counter_off': counter_off,
+        'seed': seed,
+        'processes': processes,
+        'latency': latency,
+        'shard': shard
+    }
+
+    print('Generating data...')
+    data = generate_data(traps, days, start_date, duplicates, gps_drift, zero_coordinates,
+                         counter_off, seed)
+    num_captures = sum(len(trap_wrapper['Capture']) for trap_wrapper in data['traps'])
+    print('Generated {} captures for {} traps.'.format(num_captures, traps))
+
+    if save_data:
+        with open(save_data, 'w') as f:
+            json.dump(data, f)
+
+    results = benchmark_parser(data, repeat, processes, seed)
+
+    if download:
+        end_time = start_date + dt.timedelta(days=days)
+        results.update(benchmark_download(data, start_date, end_time, repeat, latency,
+                                          shard))
+
+    print()
+    print('{:<22}{:>12}{:>12}{:>10}'.format('Benchmark', 'Time (s)', 'Baseline', 'Change'))
+
+    base_results = load_baseline(baseline, settings)
+    regressions = []
+
+    for name, seconds in results.items():
+        base_seconds = base_results.get(name)
+
+        if base_seconds:
+            change = seconds / base_seconds - 1
+            line = '{:<22}{:>12.4f}{:>12.4f}{:>+9.0%}'.format(name, seconds, base_seconds, change)
+
+            if change > tolerance:
+                regressions.append(name)
+                line += '  REGRESSION'
+        else:
+            line = '{:<22}{:>12.4f}{:>12}{:>10}'.format(name, seconds, '-', '-')
+
+        print(line)
+
+    # Captures per second make runs with different data comparable
+    # at a glance.
+    if 'parse_json' in results:
+        print('\nparse_json: {:.0f} captures per second.'
+              .format(num_captures / results['parse_json']))
+
+    if save_baseline:
+        with open(baseline, 'w') as f:
+            json.dump({'settings': settings, 'environment': get_environment(),
+                       'results': results}, f, indent=4)
+
+        print('Saved baseline to ' + baseline)
+
+    if regressions:
+        print('Regressions (more than {:.0%} slower): {}'
+              .format(tolerance, ', '.join(regressions)))
+
+    return regressions
+
+
+def generate_data(traps, days, start_date, duplicates=0.02, gps_drift=10, zero_coordinates=0.01,
+                  counter_off=0.05, seed=0):
+    """Generate synthetic smart trap data.
+
+    Returns a dict in the format delivered by the Biogents API, with
+    a trap object for each trap holding one capture every 15 minutes
+    over the given number of days, in forward chronological order.
+
+    Arguments:
+    traps -- The number of traps.
+    days -- The number of days of captures per trap.
+    start_date -- A datetime object representing the day the captures
+        start on.
+    duplicates -- The fraction of captures that are delivered twice.
+    gps_drift -- The greatest distance in meters that a reported
+        location strays from the trap's location.
+    zero_coordinates -- The fraction of captures whose coordinates are
+        reported as 0 because the trap couldn't get a GPS fix.
+    counter_off -- The fraction of days on which the counter is off.
+    seed -- The seed to generate the data from.
+    """
+    rng = random.Random(seed)
+    start_date = dt.datetime.combine(start_date.date(), dt.time())
+    fmt = '%Y-%m-%d %H:%M:%S'
+    capture_id = 0
+    trap_wrappers = []
+
+    for trap_number in range(traps):
+        trap_id = str(100000000000000 + trap_number)
+        lat = rng.uniform(25, 45)
+        lon = rng.uniform(-120, -75)
+
+        # Traps don't all report at the same second.
+        offset = dt.timedelta(seconds=rng.randrange(60))
+        captures = []
+
+        for day in range(days):
+            counter_status = '0' if rng.random() < counter_off else '1'
+
+            for quarter in range(96):
+                timestamp_start = start_date + dt.timedelta(days=day, minutes=15*quarter) + offset
+                timestamp_end = timestamp_start + dt.timedelta(minutes=15)
+
+                if rng.random() < zero_coordinates:
+                    curr_lat = curr_lon = 0
+                else:
+                    # Move up to gps_drift meters in a random
+                    # direction.
+                    distance = rng.uniform(0, gps_drift)
+                    bearing = rng.uniform(0, 2 * math.pi)
+                    curr_lat = lat + math.degrees(distance * math.cos(bearing) / 6373000)
+                    curr_lon = lon + math.degrees(distance * math.sin(bearing)
+                                                  / (6373000 * math.cos(math.radians(lat))))
+
+                capture_id += 1
+                capture = {
+                    'id': str(capture_id),
+                    'trap_id': trap_id,
+                    'timestamp_start': timestamp_start.strftime(fmt),
+                    'timestamp_end': timestamp_end.strftime(fmt),
+                    'co2_status': rng.random() < 0.8,
+                    'counter_status': counter_status,
+                    'medium': str(rng.randrange(20)),
+                    'trap_latitude': '{:.6f}'.format(curr_lat),
+                    'trap_longitude': '{:.6f}'.format(curr_lon)
+                }
+
+                captures.append(capture)
+
+                if rng.random() < duplicates:
+                    capture_id += 1
+                    duplicate = dict(capture, id=str(capture_id))
+                    captures.append(duplicate)
+
+        trap_wrappers.append({'Trap': {'id': trap_id, 'name': 'Trap {}'.format(trap_number)},
+                              'Capture': captures})
+
+    return {'traps': trap_wrappers}
+
+
+def make_metadata(data):
+    """Make the parser metadata for the traps in synthetic data.
+
+    Returns a dict in the form returned by get_trapsets_metadata, in
+    which every trap belongs to the same provider and has no known
+    locations, so they all have to be found by the parser.
+    """
+    trap_ids = [trap_wrapper['Trap']['id'] for trap_wrapper in data['traps']]
+
+    return {
+        prefix: {
+            'traps': {trap_id: [] for trap_id in trap_ids},
+            'ordinals': {},
+            'checkpoints': {},
+            'obfuscate': True
+        }
+    }
+
+
+def benchmark_parser(data, repeat=3, processes=1, seed=0):
+    """Time the steps of parsing synthetic data.
+
+    Returns a dict mapping the name of each step to the fastest time it
+    took in seconds.  Everything the parser prints is discarded.
+
+    Arguments:
+    data -- The synthetic data, as returned by generate_data.
+    repeat -- The number of times to run each benchmark.
+    processes -- The number of processes for parse_json.
+    seed -- The seed to obfuscate locations with.
+    """
+    results = {}
+    trap_wrappers = [trap_wrapper for trap_wrapper in data['traps'] if trap_wrapper['Capture']]
+
+    def trap_metadata(trap_id):
+        return {'locations': [], 'obfuscate': True, 'seed': '{}:{}'.format(seed, trap_id),
+                'checkpoint': None}
+
+    with tempfile.TemporaryDirectory(prefix='bg_benchmark_') as temp_dir, \
+            open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        # Process all traps' captures into collections.
+        def run_process_captures():
+            return [bg_json_parser.process_captures(trap_wrapper['Capture'],
+                                                    trap_metadata(trap_wrapper['Trap']['id']))
+                    for trap_wrapper in trap_wrappers]
+
+        results['process_captures'], collections = time_best(run_process_captures, repeat)
+
+        # Bin each day's captures by location.
+        days = []
+
+        for trap_wrapper in trap_wrappers:
+            columns = bg_json_parser.CaptureColumns(trap_wrapper['Capture'])
+            days.append((columns, trap_wrapper['Trap']['id'],
+                         [indexes for _, indexes in bg_json_parser.find_days(columns)]))
+
+        def run_make_collection():
+            for columns, trap_id, day_indexes in days:
+                metadata = trap_metadata(trap_id)
+
+                for indexes in day_indexes:
+                    bg_json_parser.make_collection(columns, indexes, metadata['locations'],
+                                                   metadata['obfuscate'], metadata['seed'])
+
+        results['make_collection'] = time_best(run_make_collection, repeat)[0]
+
+        # Write the collections to an interchange file.
+        def run_write_collection():
+            out_csv = bg_json_parser.CSVWriter(os.path.join(temp_dir, 'write.pop'))
+            metadata = {'prefix': prefix, 'ordinals': {}}
+
+            try:
+                for trap_collections in collections:
+                    for collection in trap_collections:
+                        bg_json_parser.write_collection(collection, metadata, out_csv)
+            finally:
+                out_csv.close()
+
+        results['write_collection'] = time_best(run_write_collection, repeat)[0]
+
+        # Parse the whole file, from JSON and from a capture store.
+        json_name = os.path.join(temp_dir, 'data.json')
+        store_name = os.path.join(temp_dir, 'data.store')
+
+        with open(json_name, 'w') as f:
+            json.dump(data, f)
+
+        com.write_capture_store(store_name, data['traps'])
+
+        get_trapsets_metadata = bg_json_parser.get_trapsets_metadata
+        bg_json_parser.get_trapsets_metadata = lambda trap_ids: make_metadata(data)
+
+        try:
+            for name, filename in (('parse_json', json_name), ('parse_json_store', store_name)):
+                results[name] = time_best(lambda: bg_json_parser.parse_json(
+                    files=[filename], output=os.path.join(temp_dir, name + '.pop'),
+                    preserve_metadata=True, processes=processes, seed=seed), repeat)[0]
+        finally:
+            bg_json_parser.get_trapsets_metadata = get_trapsets_metadata
+
+    return results
+
+
+def benchmark_download(data, start_time, end_time, repeat=3, latency=0, shard=None):
+    """Time download_data against a fake API server.
+
+    Returns a dict mapping 'download_data' to the fastest time it took
+    in seconds.  The downloaded data is checked against the synthetic
+    data: each trap's captures must have the same IDs and timestamps in
+    the same order.  Duplicate captures, which follow their originals
+    with the same timestamps, are left out of the check, since one can
+    be skipped when it's split from the original by the capture limit.
+
+    Arguments:
+    data -- The synthetic data, as returned by generate_data.
+    start_time -- A datetime object representing the beginning of the
+        timeframe to download.
+    end_time -- A datetime object representing the end of the
+        timeframe to download.
+    repeat -- The number of times to run the benchmark.
+    latency -- The number of seconds the server takes to answer each
+        request.
+    shard -- 'year', 'month', 'week', or None, passed on to
+        download_data.
+    """
+    server = FakeAPIServer(data, latency)
+    api_url = bg_download_data.api_url
+    bg_download_data.api_url = server.url
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='bg_benchmark_') as temp_dir, \
+                open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            # download_data takes output names relative to the current
+            # directory.
+            output = os.path.relpath(os.path.join(temp_dir, 'download.json'))
+
+            def run_download_data():
+                bg_download_data.download_data(None,
+                                               api_key='00000000-0000-0000-0000-000000000000',
+                                               start_time=start_time, end_time=end_time,
+                                               output=output, rate=1000, shard=shard)
+
+            seconds = time_best(run_download_data, repeat)[0]
+
+            with open(output) as f:
+                downloaded = json.load(f)
+    finally:
+        bg_download_data.api_url = api_url
+        server.close()
+
+    # Every capture should have been downloaded once, in order.
+    expected = {trap_wrapper['Trap']['id']: capture_sequence(trap_wrapper['Capture'])
+                for trap_wrapper in data['traps']}
+    actual = {trap_wrapper['Trap']['id']: capture_sequence(trap_wrapper['Capture'])
+              for trap_wrapper in downloaded['traps']}
+
+    if actual != expected:
+        raise ValueError('Downloaded data does not match the synthetic data.')
+
+    print('download_data: {} requests per run.'.format(server.num_requests // repeat))
+
+    return {'download_data': seconds}
+
+
+def capture_sequence(captures):
+    """Return the (id, timestamp_start) pairs of a trap's captures.
+
+    The pairs are in the order of the captures, leaving out each
+    duplicate: a capture with another ID but the same timestamps as the
+    one before it.  The same capture given twice is kept twice.
+    """
+    sequence = []
+    previous = None
+
+    for capture in captures:
+        if not (previous is not None and capture['id'] != previous['id']
+                and capture['timestamp_start'] == previous['timestamp_start']
+                and capture['timestamp_end'] == previous['timestamp_end']):
+            sequence.append((capture['id'], capture['timestamp_start']))
+
+        previous = capture
+
+    return sequence
+
+
+def time_best(func, repeat):
+    """Call func repeatedly and return the fastest time and its result.
+
+    Returns a (seconds, result) tuple, where result is the return value
+    of the last call.
+    """
+    best = math.inf
+    result = None
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def load_baseline(filename, settings):
+    """Load the baseline results to compare against.
+
+    Returns a dict mapping benchmark names to times in seconds, which is
+    empty if there is no baseline or it was recorded with different
+    settings.
+    """
+    if not os.path.isfile(filename):
+        return {}
+
+    with open(filename) as f:
+        baseline = json.load(f)
+
+    if baseline['settings'] != settings:
+        print('Warning: Baseline {} was recorded with different settings. Not comparing.'
+              .format(filename))
+        return {}
+
+    return baseline['results']
+
+
+def get_environment():
+    """Describe the environment the benchmarks ran in."""
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': bg_json_parser.np is not None,
+        'time': dt.datetime.now().isoformat(' ')
+    }
+
+
+class FakeAPIServer:
+    """Serve synthetic data the way the Biogents API does.
+
+    Runs an HTTP server on a local port in a background thread.  It
+    answers requests for data over a timeframe with each trap's
+    captures that start within it, up to limit captures per trap, in
+    the same format as the real API.
+
+    Public methods:
+        close
+    """
+
+    def __init__(self, data, latency=0):
+        """Initialize the instance and start the server.
+
+        data -- The synthetic data, as returned by generate_data.
+        latency -- The number of seconds to wait before answering each
+            request.
+        """
+        self.latency = latency
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+        # Each trap's captures along with their starting timestamps,
+        # which sort chronologically as strings, to search them by.
+        self.traps = [(trap_wrapper['Trap'], trap_wrapper['Capture'],
+                       [capture['timestamp_start'] for capture in trap_wrapper['Capture']])
+                      for trap_wrapper in data['traps']]
+
+        fake_api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+                body = json.dumps(fake_api.answer(form['data[startTime]'][0],
+                                                  form['data[endTime]'][0])).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header('Content-Encoding', 'gzip')
+
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}/traps/exportTrapCapturesForTimeFrame.json'.format(
+            self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def answer(self, start_time, end_time):
+        """Return the response to a request for a timeframe."""
+        with self.lock:
+            self.num_requests += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        trap_wrappers = []
+
+        for trap, captures, starts in self.traps:
+            first = bisect.bisect_left(starts, start_time)
+            last = min(bisect.bisect_left(starts, end_time), first + limit)
+            trap_wrappers.append({'Trap': trap, 'Capture': captures[first:last]})
+
+        return {'traps': trap_wrappers}
+
+    def close(self):
+        """Stop the server."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """An HTTP server that handles each request in a new thread."""
+
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    args = vars(parse_args())
+    regressions = run_benchmarks(**args)
+
+    if regressions:
+        sys.exit(1)
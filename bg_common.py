@@ -2,7 +2,23 @@
 Contains functions used at multiple steps in the pipeline.
 
 get_connection_params -- Get the database connection parameters.
+get_pool_params -- Get the connection pool size parameters.
+get_pool -- Get the process-wide database connection pool.
+close_pool -- Close all connections held by the pool.
+pooled_connection -- Borrow a connection from the pool in a block.
+shared_connection -- Share one connection and transaction in a block.
 run_with_connection -- Run a function with a database connection.
+add_metrics_arguments -- Add the metrics options to an argument parser.
+configure_metrics -- Set where to write stage metrics and profiles.
+stage -- Measure a stage of the pipeline in a block or function.
+count -- Add to a counter of the stages running in this thread.
+with_stages -- Make a function count toward the caller's stages.
+open_json -- Open a JSON file, compressed or not, as text.
+iter_traps -- Yield the trap objects in a JSON file one at a time.
+iter_trap_ids -- Yield the trap IDs in a JSON file without parsing it.
+capture_columns -- Convert captures into typed columns.
+write_capture_store -- Write traps' captures to a capture store.
+iter_capture_store -- Yield the traps in a capture store one at a time.
 make_datetime -- Make a datetime object from a full timestamp string.
 make_date -- Make a date object from a full timestamp string.
 parse_date -- Try to make a datetime object from an arbitrary string.
@@ -11,15 +27,92 @@ This module requires at least Python 3.5.
 """
 
 import argparse
+import atexit
 import configparser
+import cProfile
 import datetime as dt
-from functools import wraps
+import gzip
+import io
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from array import array
+from contextlib import contextmanager, ExitStack
+from functools import lru_cache, wraps
 
-import psycopg2 as pg2
 import psycopg2.extras as pg2_extras
+import psycopg2.pool as pg2_pool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Only available on Unix.
+try:
+    import resource
+except ImportError:
+    resource = None
 
 config_file = 'db_config.ini'
 
+# Matches full timestamp strings in the format delivered by the API.
+_timestamp_re = re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})\Z', re.ASCII)
+
+# Fast parser for the above format; only available as of Python 3.7.
+_fromisoformat = getattr(dt.datetime, 'fromisoformat', None)
+
+# Maps the supported compression formats to their file extensions and
+# to the magic numbers their files start with.
+compression_extensions = {'gzip': '.gz', 'zstd': '.zst'}
+_compression_magic = {'gzip': b'\x1f\x8b', 'zstd': b'\x28\xb5\x2f\xfd'}
+
+# The typed columns of a capture store and their array type codes.
+store_columns = (('start', 'd'), ('end', 'd'), ('lat', 'd'), ('lon', 'd'), ('medium', 'q'),
+                 ('co2', 'b'), ('counter', 'b'))
+
+# Stands in for a missing mosquito count in capture columns.
+missing_count = -1
+
+# Timestamps in capture columns are seconds since this time.
+epoch = dt.datetime(1970, 1, 1)
+
+# The process-wide connection pool.  Created on first use, along with
+# a semaphore counting the connections that can still be borrowed, since
+# the pool raises an error instead of waiting when there are none left.
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+# Holds the cursor of the shared connection, if any, for each thread.
+_shared = threading.local()
+
+# Where stage metrics and profiles are written.  Nothing is measured
+# unless at least one of them is set.
+_metrics_file = None
+_profile_dir = None
+_metrics_lock = threading.Lock()
+
+# Holds the counters of the stages running in each thread.
+_stages = threading.local()
+
+# Only one profiler can run at a time, so nested and concurrent stages
+# aren't profiled separately.
+_profiling = False
+_num_profiles = 0
+
+# Statements that write rows, for counting them.
+_write_re = re.compile(rb'\s*(INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
 
 def get_connection_params():
     """Return a dict-like object with database connection parameters.
@@ -32,30 +125,669 @@ def get_connection_params():
     return config['database']
 
 
+def get_pool_params():
+    """Return a (minconn, maxconn) tuple for the connection pool.
+
+    Parses the optional 'pool' section of the database config file,
+    falling back to a small pool if it isn't present.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    minconn = config.getint('pool', 'minconn', fallback=1)
+    maxconn = config.getint('pool', 'maxconn', fallback=4)
+
+    if not 0 <= minconn <= maxconn or maxconn < 1:
+        raise ValueError('Invalid pool size in {}: minconn = {}, maxconn = {}'
+                         .format(config_file, minconn, maxconn))
+
+    return minconn, maxconn
+
+
+def get_pool():
+    """Return the process-wide database connection pool.
+
+    The pool is created the first time this function is called, using
+    the parameters in the database config file, and is closed
+    automatically when the interpreter exits.  Borrow connections with
+    pooled_connection, which waits for one to be returned if they're
+    all in use.
+    """
+    global _pool, _pool_slots
+
+    with _pool_lock:
+        if _pool is None:
+            minconn, maxconn = get_pool_params()
+            _pool = pg2_pool.ThreadedConnectionPool(minconn, maxconn,
+                                                    cursor_factory=MeteredCursor,
+                                                    **get_connection_params())
+            _pool_slots = threading.BoundedSemaphore(maxconn)
+
+    return _pool
+
+
+def close_pool():
+    """Close all connections held by the pool, if it exists."""
+    global _pool, _pool_slots
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_slots = None
+
+
+atexit.register(close_pool)
+
+
+@contextmanager
+def pooled_connection():
+    """Borrow a connection from the pool for the duration of a block.
+
+    If all of the pool's connections are in use, such as by other
+    threads, waits for one to be returned.  The connection is returned
+    to the pool afterwards, or discarded if it was closed while in use.
+    """
+    pool = get_pool()
+    slots = _pool_slots
+
+    with slots:
+        conn = pool.getconn()
+
+        try:
+            yield conn
+        finally:
+            pool.putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def shared_connection():
+    """Run a block of code within a single connection and transaction.
+
+    Every function decorated with run_with_connection that is called
+    inside the block (in the same thread) uses the same cursor instead
+    of borrowing its own connection.  The transaction is committed when
+    the block exits normally and rolled back if it raises.  Nested uses
+    join the outermost transaction.  Yields the shared cursor.
+    """
+    cur = getattr(_shared, 'cur', None)
+
+    if cur is not None:
+        yield cur
+        return
+
+    with pooled_connection() as conn:
+        try:
+            with conn, conn.cursor() as cur:
+                _shared.cur = cur
+                yield cur
+        finally:
+            _shared.cur = None
+
+
 def run_with_connection(func):
     """Run a function with a database connection.
 
-    This function is a decorator that sets up a database connection and
-    gives the called function a cursor through that connnection.  Note:
-    This adds the 'cur' parameter to the beginning of func's parameter
-    list, therefore any function using this decorator must include an
-    extra cursor parameter at the beginning of its parameter list but
-    omit this parameter when being called.  All other parameters must be
-    provided as keyword arguments.
+    This function is a decorator that borrows a connection from the
+    pool and gives the called function a cursor through that
+    connnection.  If called within a shared_connection block, the
+    shared cursor is used instead and the transaction is left to the
+    block.  Note: This adds the 'cur' parameter to the beginning of
+    func's parameter list, therefore any function using this decorator
+    must include an extra cursor parameter at the beginning of its
+    parameter list but omit this parameter when being called.  All other
+    parameters must be provided as keyword arguments.
     """
     @wraps(func)
     def connected_func(**kwargs):
-        conn = pg2.connect(cursor_factory=pg2_extras.RealDictCursor, **get_connection_params())
+        cur = getattr(_shared, 'cur', None)
 
-        with conn, conn.cursor() as cur:
-            result = func(cur, **kwargs)
+        if cur is not None:
+            return func(cur, **kwargs)
+
+        with pooled_connection() as conn:
+            with conn, conn.cursor() as cur:
+                result = func(cur, **kwargs)
 
-        conn.close()
         return result
 
     return connected_func
 
 
+class MeteredCursor(pg2_extras.RealDictCursor):
+    """A RealDictCursor that counts its work toward the current stages.
+
+    Each statement executed counts as a database round trip, and the
+    rows affected by INSERT, UPDATE and DELETE statements count as rows
+    written (see count).
+    """
+
+    def execute(self, query, vars=None):
+        """Execute a statement and count it."""
+        result = super().execute(query, vars)
+
+        count('db_round_trips')
+
+        if isinstance(query, str):
+            query = query.encode()
+
+        if isinstance(query, bytes) and _write_re.match(query) and self.rowcount > 0:
+            count('rows_written', self.rowcount)
+
+        return result
+
+
+def add_metrics_arguments(parser):
+    """Add the options controlling metrics to an argument parser.
+
+    The options are stored as 'metrics' and 'profile'.  Pass them to
+    configure_metrics.
+    """
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Append the time, memory use and amount of work of each stage of '
+                             'the pipeline to this file as JSON lines.')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='Dump cProfile statistics for each stage to a file in this '
+                             'directory.')
+
+
+def configure_metrics(metrics_file=None, profile_dir=None):
+    """Set where to write stage metrics and profiles.
+
+    Arguments:
+    metrics_file -- The name of the file to append a JSON line with the
+        metrics of each stage to, or None.
+    profile_dir -- The name of the directory to dump the cProfile
+        statistics of each stage to, or None.  It's created if it
+        doesn't exist.
+    """
+    global _metrics_file, _profile_dir
+
+    # Keep writing to the same places if the working directory changes.
+    if metrics_file:
+        metrics_file = os.path.abspath(metrics_file)
+
+    if profile_dir:
+        profile_dir = os.path.abspath(profile_dir)
+        os.makedirs(profile_dir, exist_ok=True)
+
+    _metrics_file = metrics_file
+    _profile_dir = profile_dir
+
+
+@contextmanager
+def stage(name, **fields):
+    """Measure a stage of the pipeline.
+
+    Measures the wall time, CPU time (of this process and of its
+    finished child processes) and peak memory use of a block, along
+    with the bytes downloaded, captures processed, database round trips
+    and rows written counted while it runs (see count).  The results
+    are appended to the metrics file as a JSON object with the stage's
+    name, the time it started, any extra fields given and, if the stage
+    raised, the type of the error.  Can also be used as a function
+    decorator.  Does nothing unless enabled with configure_metrics.
+
+    The CPU times and peak memory use are for the whole process, so
+    they include the work of anything running alongside the stage.
+    Nested stages count toward their outer stages as well.
+    """
+    global _profiling, _num_profiles
+
+    if _metrics_file is None and _profile_dir is None:
+        yield
+        return
+
+    counters = dict.fromkeys(['bytes_downloaded', 'captures', 'db_round_trips',
+                              'rows_written'], 0)
+
+    if getattr(_stages, 'counters', None) is None:
+        _stages.counters = []
+
+    _stages.counters.append(counters)
+    profiler = None
+
+    if _profile_dir:
+        with _metrics_lock:
+            if not _profiling:
+                _profiling = True
+                _num_profiles += 1
+                profiler = cProfile.Profile()
+                profile_name = os.path.join(_profile_dir,
+                                            '{}_{}.prof'.format(_num_profiles, name))
+
+    record = {'stage': name, 'start': dt.datetime.now().isoformat(' ')}
+    record.update(fields)
+    error = None
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    child_cpu_start = _child_cpu_time()
+
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_name)
+
+            with _metrics_lock:
+                _profiling = False
+
+        # Stages in a thread always end in the reverse order they
+        # started in.
+        _stages.counters.pop()
+
+        record['wall_time'] = round(time.perf_counter() - wall_start, 3)
+        record['cpu_time'] = round(time.process_time() - cpu_start, 3)
+
+        if resource is not None:
+            record['child_cpu_time'] = round(_child_cpu_time() - child_cpu_start, 3)
+
+            # Reported in bytes on macOS and in kilobytes elsewhere.
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            record['peak_rss'] = peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+        with _metrics_lock:
+            record.update(counters)
+
+        if error:
+            record['error'] = error
+
+        if _metrics_file:
+            with _metrics_lock, open(_metrics_file, 'a') as metrics_f:
+                metrics_f.write(json.dumps(record, default=str) + '\n')
+
+
+def count(name, amount=1):
+    """Add to a counter of the stages running in this thread.
+
+    The counters are 'bytes_downloaded', 'captures', 'commits',
+    'db_round_trips' and 'rows_written'.  Does nothing outside of
+    a stage.
+    """
+    stages = getattr(_stages, 'counters', None)
+
+    if stages:
+        with _metrics_lock:
+            for counters in stages:
+                counters[name] = counters.get(name, 0) + amount
+
+
+def with_stages(func):
+    """Make a function count toward the stages running in this thread.
+
+    Returns a wrapper of func that can be run on another thread (by an
+    executor, for instance) and still add to the counters of the stages
+    that were running when the wrapper was made.
+    """
+    stages = list(getattr(_stages, 'counters', None) or [])
+
+    @wraps(func)
+    def staged_func(*args, **kwargs):
+        saved = getattr(_stages, 'counters', None)
+        _stages.counters = list(stages)
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _stages.counters = saved
+
+    return staged_func
+
+
+def _child_cpu_time():
+    """Return the CPU time used by finished child processes."""
+    if resource is None:
+        return 0
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def open_json(filename, mode='r', compression=None):
+    """Open a JSON file, compressed or not, as a text file.
+
+    When reading, the compression format is detected from the start of
+    the file, so compressed files are read transparently whatever their
+    names.  When writing, the data is compressed as it's written, so it
+    never has to be held in memory in full.
+
+    Arguments:
+    filename -- The name of the file to open.
+    mode -- 'r' to read the file or 'w' to write it.
+    compression -- The format to compress a written file with: 'gzip',
+        'zstd', or None.  If None, the format is chosen based on the
+        file's extension ('.gz' or '.zst'), and the file isn't
+        compressed if it has neither.  Ignored when reading.
+    """
+    if mode == 'r':
+        with open(filename, 'rb') as f:
+            start = f.read(4)
+
+        compression = None
+
+        for name, magic in _compression_magic.items():
+            if start.startswith(magic):
+                compression = name
+
+    elif mode == 'w':
+        if compression is None:
+            for name, extension in compression_extensions.items():
+                if filename.endswith(extension):
+                    compression = name
+
+    else:
+        raise ValueError('Invalid mode: ' + mode)
+
+    if compression is None:
+        return open(filename, mode)
+    elif compression == 'gzip':
+        # Favor speed over size; the data compresses well either way.
+        return gzip.open(filename, mode + 't', compresslevel=6)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ValueError('The zstandard package is required for zstd compression: '
+                             + filename)
+
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'))
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+
+        return io.TextIOWrapper(stream)
+    else:
+        raise ValueError('Unknown compression format: ' + compression)
+
+
+def iter_traps(filename, chunk_size=2**20):
+    """Yield the trap objects in a smart trap JSON file one at a time.
+
+    Incrementally decodes the elements of the file's 'traps' array so
+    that only one trap's data (plus one chunk of the file) is held in
+    memory at a time, rather than the whole document.  Each yielded
+    object is identical to the corresponding element of
+    json.load(file)['traps'].
+
+    The file may be compressed (see open_json).
+
+    Arguments:
+    filename -- The name of the JSON file to read.
+    chunk_size -- The minimum number of characters to read at a time.
+    """
+    traps_key = re.compile(r'"traps"\s*:\s*\[')
+    separator = re.compile(r'[\s,]*')
+    decoder = json.JSONDecoder()
+
+    with open_json(filename) as json_f:
+        buffer = json_f.read(chunk_size)
+        match = traps_key.search(buffer)
+
+        # Find the beginning of the traps array.
+        while not match:
+            chunk = json_f.read(chunk_size)
+
+            if not chunk:
+                raise ValueError("No 'traps' array in file: " + filename)
+
+            buffer += chunk
+            match = traps_key.search(buffer)
+
+        pos = match.end()
+        eof = False
+
+        while True:
+            pos = separator.match(buffer, pos).end()
+
+            if pos < len(buffer):
+                if buffer[pos] == ']':
+                    return
+
+                try:
+                    trap, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                else:
+                    yield trap
+                    continue
+
+            elif eof:
+                raise ValueError("Unterminated 'traps' array in file: " + filename)
+
+            # The next trap is cut off at the end of the buffer.  Drop
+            # what has been decoded and at least double what's left so
+            # that large traps aren't decoded over and over.
+            buffer = buffer[pos:]
+            pos = 0
+            chunk = json_f.read(max(chunk_size, len(buffer)))
+            eof = not chunk
+            buffer += chunk
+
+
+def iter_trap_ids(filename, chunk_size=2**20):
+    """Yield the trap IDs in a smart trap JSON file without parsing it.
+
+    Scans the file in chunks for the 'Trap' objects and decodes only
+    those, skipping over the capture data entirely.  This is much faster
+    and lighter on memory than loading the whole file when only the trap
+    IDs are needed.  The file may be compressed (see open_json) or be
+    a capture store.
+
+    Arguments:
+    filename -- The name of the JSON file to scan.
+    chunk_size -- The number of characters to read at a time.
+    """
+    if os.path.isdir(filename):
+        for entry in _read_store_index(filename)['traps']:
+            yield entry['Trap']['id']
+
+        return
+
+    trap_key = re.compile(r'"Trap"\s*:\s*(?=\{)')
+    decoder = json.JSONDecoder()
+    buffer = ''
+    eof = False
+
+    with open_json(filename) as json_f:
+        while not eof:
+            chunk = json_f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            pos = 0
+
+            while True:
+                match = trap_key.search(buffer, pos)
+
+                if not match:
+                    # Keep a tail in case the key is split
+                    # between chunks.
+                    pos = max(pos, len(buffer) - 32)
+                    break
+
+                try:
+                    trap, pos = decoder.raw_decode(buffer, match.end())
+                except json.JSONDecodeError:
+                    # The object is probably cut off at the end of
+                    # the buffer, so read more unless we're done.
+                    if eof:
+                        raise
+
+                    pos = match.start()
+                    break
+
+                yield trap['id']
+
+            buffer = buffer[pos:]
+
+
+def capture_columns(captures):
+    """Convert captures into typed columns.
+
+    Returns a dict mapping 'ids' and each name in store_columns to
+    a list of the captures' values: timestamps as seconds since the
+    epoch (NaN if empty), coordinates as floats (NaN if missing or
+    malformed), mosquito counts (from the 'medium' field) as integers
+    (missing_count if missing or malformed) and the CO2 and counter
+    statuses as flags.  Whether a bad value is an error depends on
+    whether the capture is used, so it's left to the parser.
+
+    captures -- A list containing the captures of a single trap.
+    """
+    start = [make_datetime(capture['timestamp_start']) for capture in captures]
+    end = [make_datetime(capture['timestamp_end']) for capture in captures]
+
+    return {
+        'ids': [capture['id'] for capture in captures],
+        'start': [(timestamp - epoch).total_seconds() if timestamp else math.nan
+                  for timestamp in start],
+        'end': [(timestamp - epoch).total_seconds() if timestamp else math.nan
+                for timestamp in end],
+        'lat': [_column_value(float, capture['trap_latitude'], math.nan)
+                for capture in captures],
+        'lon': [_column_value(float, capture['trap_longitude'], math.nan)
+                for capture in captures],
+        'medium': [_column_value(int, capture['medium'], missing_count) for capture in captures],
+        'co2': [bool(capture['co2_status']) for capture in captures],
+        'counter': [capture['counter_status'] in {'1', True} for capture in captures]
+    }
+
+
+def _column_value(convert, value, missing):
+    """Convert a capture's value, or return missing if it's bad."""
+    if value is None or value == '':
+        return missing
+
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return missing
+
+
+def write_capture_store(dirname, trap_wrappers):
+    """Write traps' captures to a capture store.
+
+    A capture store is a directory holding each of the columns made by
+    capture_columns in its own binary file, with the captures of all
+    traps one after another, along with a file of capture IDs and an
+    index of the traps.  It takes a fraction of the space of the JSON
+    and can be read without parsing anything (see iter_capture_store).
+    The index is written last, so an incomplete store can't be read.
+
+    Arguments:
+    dirname -- The name of the directory to write the store to.  It's
+        created if it doesn't exist.
+    trap_wrappers -- An iterable of trap objects, each holding a trap
+        and its captures.
+    """
+    os.makedirs(dirname, exist_ok=True)
+
+    # Remove the index of any store written here before, so that it
+    # can't be read while it's being overwritten.
+    try:
+        os.remove(os.path.join(dirname, 'index.json'))
+    except FileNotFoundError:
+        pass
+
+    index = {'byteorder': sys.byteorder, 'traps': []}
+    offset = 0
+
+    with ExitStack() as stack:
+        column_files = {name: stack.enter_context(open(os.path.join(dirname, name + '.bin'),
+                                                       'wb'))
+                        for name, _ in store_columns}
+        ids_f = stack.enter_context(open(os.path.join(dirname, 'ids.txt'), 'wb'))
+
+        for trap_wrapper in trap_wrappers:
+            captures = list(trap_wrapper['Capture'])
+            columns = capture_columns(captures)
+
+            for name, typecode in store_columns:
+                array(typecode, columns[name]).tofile(column_files[name])
+
+            index['traps'].append({
+                'Trap': trap_wrapper['Trap'],
+                'trap_id': captures[0]['trap_id'] if captures else None,
+                'offset': offset,
+                'count': len(captures),
+                'ids_offset': ids_f.tell()
+            })
+
+            ids_f.write(''.join(str(capture_id) + '\n' for capture_id in columns['ids']).encode())
+            offset += len(captures)
+
+    with open(os.path.join(dirname, 'index.json'), 'w') as index_f:
+        json.dump(index, index_f)
+
+
+def iter_capture_store(dirname):
+    """Yield the traps in a capture store one at a time.
+
+    Yields a (trap, trap_id, ids, columns) tuple for each trap, where
+    trap is the trap object, trap_id is the trap ID given by its
+    captures (None if it has none), ids is a list of its capture IDs and
+    columns is a dict mapping each name in store_columns to an array of
+    its captures' values.  If NumPy is installed, the arrays are views
+    of memory-mapped files, so a trap's data is only read once it's
+    used.  Otherwise, they are standard library arrays.
+
+    dirname -- The name of the capture store's directory.
+    """
+    index = _read_store_index(dirname)
+    paths = {name: os.path.join(dirname, name + '.bin') for name, _ in store_columns}
+
+    if index['byteorder'] != sys.byteorder:
+        raise ValueError('Capture store has a different byte order than this machine: '
+                         + dirname)
+
+    with ExitStack() as stack:
+        if np is not None:
+            # Empty files can't be memory-mapped.
+            mapped = {name: np.asarray(np.memmap(paths[name], dtype=typecode, mode='r'))
+                      if os.path.getsize(paths[name]) else np.empty(0, dtype=typecode)
+                      for name, typecode in store_columns}
+        else:
+            column_files = {name: stack.enter_context(open(paths[name], 'rb'))
+                            for name, _ in store_columns}
+
+        ids_f = stack.enter_context(open(os.path.join(dirname, 'ids.txt'), 'rb'))
+
+        for entry in index['traps']:
+            start, count = entry['offset'], entry['count']
+
+            ids_f.seek(entry['ids_offset'])
+            ids = [ids_f.readline().decode().rstrip('\n') for _ in range(count)]
+
+            if np is not None:
+                columns = {name: column[start:start + count] for name, column in mapped.items()}
+            else:
+                columns = {}
+
+                for name, typecode in store_columns:
+                    column = array(typecode)
+                    column_files[name].seek(start * column.itemsize)
+                    column.fromfile(column_files[name], count)
+                    columns[name] = column
+
+            yield entry['Trap'], entry['trap_id'], ids, columns
+
+
+def _read_store_index(dirname):
+    """Load the index of a capture store."""
+    try:
+        with open(os.path.join(dirname, 'index.json')) as index_f:
+            return json.load(index_f)
+    except FileNotFoundError:
+        raise ValueError('Not a complete capture store: ' + dirname) from None
+
+
 def make_datetime(string):
     """Make a datetime object from a full timestamp string.
 
@@ -65,16 +797,28 @@ def make_datetime(string):
     """
     if string == '0000-00-00 00:00:00':
         return None
+
+    # Timestamps delivered by the API always have the same format, so
+    # skip strptime, which is slow, for strings that match it.
+    match = _timestamp_re.match(string)
+
+    if match:
+        if _fromisoformat:
+            return _fromisoformat(string)
+        else:
+            return dt.datetime(*map(int, match.groups()))
     else:
         return dt.datetime.strptime(string, '%Y-%m-%d %H:%M:%S')
 
 
+@lru_cache(maxsize=2**12)
 def make_date(string):
     """Make a date object from a full timestamp string.
 
     Attempts to interpret a string as a full timestamp string and create
     a date object from that string, dropping the time information.
-    Returns None if the string represents an empty date.
+    Returns None if the string represents an empty date.  Results are
+    cached, since the same timestamps tend to be looked up repeatedly.
     """
     date_time = make_datetime(string)
 
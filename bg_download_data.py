@@ -15,12 +15,20 @@ This script requires at least Python 3.5.
 """
 
 import argparse
+import bisect
 import collections
+import concurrent.futures
 import curses
+import gzip
+import hashlib
+import itertools
 import json
 import math
 import os
+import random
 import re
+import tempfile
+import threading
 import time
 import datetime as dt
 
@@ -28,6 +36,38 @@ import requests
 
 import bg_common as com
 
+api_url = 'http://live.bg-counter.com/traps/exportTrapCapturesForTimeFrame.json'
+
+# Response codes that signal a transient problem worth retrying.
+retry_statuses = {429, 500, 502, 503, 504}
+
+# Seconds to wait for a connection to the server.
+connect_timeout = 30
+
+# Traps whose cursors are closer together than this share a request.
+group_span = dt.timedelta(days=1)
+
+# The longest window of time to request at once.  The API delivers at
+# most 1000 captures per trap, a little over 10 days of captures taken
+# every 15 minutes, so a trap's captures in a window this long normally
+# all arrive and the trap can carry on into the next window.
+max_window = dt.timedelta(days=9)
+
+# How far back from the end of a window the next request for a trap
+# starts, to catch captures straddling the end of the window.  This is
+# the length of one capture, so that as little data as possible is
+# downloaded twice.
+window_overlap = dt.timedelta(minutes=15)
+
+# The units of time a timeframe can be split into shards by.
+shard_units = ('year', 'month', 'week')
+
+# The shared HTTP session and the number of connections it keeps open.
+# Created on first use, under the lock.
+_session = None
+_session_size = 0
+_session_lock = threading.Lock()
+
 
 def parse_args():
     """Parse the command line arguments and return an args namespace."""
@@ -52,6 +92,47 @@ def parse_args():
                         help="Don't show the graphical display.")
     parser.add_argument('--split-traps', action='store_true',
                         help='Write each trap into a separate file.')
+    parser.add_argument('--compress', dest='compression', choices=['gzip', 'zstd'],
+                        help='Compress the output as it is written. Implied by an output file '
+                             'name ending in ".gz" or ".zst". zstd requires the zstandard '
+                             'package.')
+    parser.add_argument('--store', metavar='DIR',
+                        help='Also write the captures to a capture store in this directory: '
+                             'a compact columnar copy of the data that bg_json_parser.py reads '
+                             'much faster than the JSON.')
+    parser.add_argument('--spill', action='store_true',
+                        help="Buffer each trap's captures in a temporary file instead of in "
+                             "memory. Use when downloading long timeframes.")
+    parser.add_argument('--retries', type=int, default=3,
+                        help='The number of times to retry a failed request. Default: 3')
+    parser.add_argument('--timeout', type=int, default=600,
+                        help='The number of seconds to wait for a response. Default: 600')
+    parser.add_argument('--max-requests', type=int, default=4,
+                        help='The maximum number of concurrent requests. Default: 4')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='The maximum number of requests to start per second. Default: 1')
+    parser.add_argument('--shard', choices=shard_units,
+                        help='Split the timeframe at the start of each year, month or week and '
+                             'download the pieces in parallel. Speeds up long timeframes.')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='Record each response in this file so that the download can be '
+                             'resumed by running it again with the same API key and timeframe '
+                             'if it gets interrupted. The file is removed when the download '
+                             'finishes.')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Keep the responses in this directory and answer identical requests '
+                             'from it instead of from the API. Responses covering the last 24 '
+                             'hours are not kept.')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='The maximum size of the cache in MB. The least recently used '
+                             'responses are removed once it grows past this. Default: 1024')
+    parser.add_argument('--cache-ttl', type=float,
+                        help='The number of hours a cached response stays usable. Default: No '
+                             'limit')
+    parser.add_argument('--replay-only', action='store_true',
+                        help='Only answer requests from the cache and fail if a response is '
+                             'missing from it. Requires --cache.')
+    com.add_metrics_arguments(parser)
 
     output_group_wrapper = parser.add_argument_group('output arguments',
                                                      'Must specify exactly one of the following.')
@@ -77,13 +158,22 @@ def parse_args():
               '  may yield incomplete datasets. Continuing in 5 seconds.')
         time.sleep(5)
 
-    del args.nested_directories
+    if args.cache:
+        ttl = args.cache_ttl * 3600 if args.cache_ttl is not None else None
+        args.cache = ResponseCache(args.cache, args.cache_size * 2**20, ttl, args.replay_only)
+    elif args.replay_only:
+        parser.error('--replay-only requires --cache')
+
+    del args.nested_directories, args.cache_size, args.cache_ttl, args.replay_only
 
     return args
 
 
+@com.stage('download_data')
 def download_data(stdscr, api_key, start_time, end_time, output, target_traps=None,
-                  split_traps=False, skip_empty=False, pretty_print=None, dry=False):
+                  split_traps=False, skip_empty=False, pretty_print=None, dry=False, spill=False,
+                  retries=3, timeout=600, max_requests=4, rate=1, limiter=None, journal=None,
+                  cache=None, compression=None, store=None, progress=None, shard=None):
     """Download smart trap data over a specific timeframe.
 
     Required arguments:
@@ -112,10 +202,57 @@ def download_data(stdscr, api_key, start_time, end_time, output, target_traps=No
     pretty_print -- A boolean controlling whether to add indentation
         to the final JSON output.
     dry -- Pass True to prevent the script from creating any files.
+    spill -- Pass True to append each trap's captures to a temporary
+        file as they arrive instead of keeping them in memory.  The
+        output file is then assembled by streaming from these files.
+    retries -- The number of times to retry a request that failed
+        because of a network or server problem.
+    timeout -- The number of seconds to wait for a response to
+        a request.
+    max_requests -- The maximum number of requests to have in flight
+        at once.
+    rate -- The maximum number of requests to start per second.
+    limiter -- A RequestLimiter to use instead of one made from
+        max_requests and rate.  Pass the same limiter to concurrent
+        downloads to limit their combined requests.
+    journal -- The name of a file to record each response in.  If the
+        file already holds responses recorded for the same API key and
+        timeframe, the download picks up where it left off.  The file
+        is removed once the download is finished.
+    cache -- A ResponseCache to answer requests from before sending
+        them to the API.  New responses are added to it.
+    compression -- The format to compress the output with: 'gzip',
+        'zstd', or None.  If None, the format is chosen based on the
+        output file's extension.
+    store -- The name of a directory to also write the captures to as
+        a capture store (see bg_common.write_capture_store), or None.
+    progress -- A DownloadProgress to report the progress of the
+        download to, such as one tracked by a Dashboard, instead of
+        printing it.  Only used if stdscr is None.
+    shard -- 'year', 'month', or 'week' to split the timeframe at the
+        start of each of these and download the pieces side by side,
+        or None to download the timeframe as a whole.
+
+    Each trap's timeframe is split into segments, one for each shard,
+    and an initial request is performed for each shard.  After that,
+    each segment's progress is tracked separately.  Segments that are
+    at similar points in time are grouped together, and each group is
+    requested over its own windows of time, up to where the next group
+    begins, each short enough for a trap's captures in it to fit in one
+    response.  The requests for all windows are performed concurrently,
+    and a segment's data from a window that it hasn't reached yet is
+    kept until it does, so that it's only requested up to that window
+    afterwards.  This avoids downloading the same captures again for
+    traps that are ahead of the others, and lets a long timeframe be
+    paged through many windows at once instead of one page after the
+    other.  Finally, each trap's segments are joined in order,
+    dropping the captures at the boundaries that both segments got.
     """
     # The limit of data points (captures) per trap the API can deliver.
     limit = 1000
 
+    duration = end_time - start_time
+
     if stdscr:
         # Get screen size.
         max_y, max_x = stdscr.getmaxyx()
@@ -129,7 +266,6 @@ def download_data(stdscr, api_key, start_time, end_time, output, target_traps=No
         curses.curs_set(False)
         stdscr.nodelay(True)
         graph_width = max_x - 35
-        duration = end_time - start_time
         gradation = duration / graph_width
         curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
         curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_GREEN)
@@ -143,171 +279,349 @@ def download_data(stdscr, api_key, start_time, end_time, output, target_traps=No
     else:
         pad = None
 
-    # Perform a request on the full duration first.
-    js = request_data(api_key, start_time, end_time, stdscr)
+    if progress is not None:
+        progress.start()
 
-    # Keys will be traps with incomplete data and values will be
-    # their most recent timestamps.
-    incomplete_traps = {}
+    # Requests made while the progress is shown on a screen
+    # shouldn't print.
+    quiet = bool(stdscr) or progress is not None
 
-    # Will contain the JSON objects for each individual trap.
-    trap_data = {}
+    # Spaces out the requests and performs them concurrently.
+    if not limiter:
+        limiter = RequestLimiter(rate, max_requests)
 
-    if stdscr:
-        # Determine whether the pad needs to be resized.
-        num_traps = len(js['traps'])
-        min_height = 8 + 2*num_traps
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_requests)
 
-        if min_height > max_y:
-            pad.resize(min_height, max_x)
+    # Records the responses so an interrupted download can be resumed.
+    page_journal = PageJournal(journal, api_key, start_time, end_time) if journal else None
 
-        # Move cursor to prepare for horizontal line drawing.
-        pad.move(3, 2)
+    # Holds the temporary files that captures are spilled to.
+    spill_dir = tempfile.TemporaryDirectory(prefix='bg_spill_') if spill else None
 
-    # Loop over each trap.
-    for trap_wrapper in js['traps']:
-        trap_id = trap_wrapper['Trap']['id']
+    try:
+        if page_journal is not None and len(page_journal):
+            message = 'Resuming from {} recorded response(s).'.format(len(page_journal))
 
-        # If no trap was specified or this trap was specified,
-        # grab its data.
-        if not target_traps or trap_id in target_traps:
-            captures = trap_wrapper['Capture']
-            num_captures = len(captures)
-            trap_data[trap_id] = trap_wrapper
+            if stdscr:
+                print_status(message, pad)
+            elif progress is not None:
+                progress.set_status(message)
+            else:
+                print(message)
+
+        # Each trap's timeframe is split into the same shards, and the part
+        # of a trap's timeframe within a shard (a segment) is downloaded
+        # separately.  Keys will be (trap ID, shard index) pairs.
+        shards = split_timeframe(start_time, end_time, shard)
+
+        # Perform a request on the full duration of each shard first.  The
+        # requests for all but the first shard start a little early to
+        # catch captures straddling the boundary.
+        first_windows = [(max(shard_start - window_overlap, start_time), shard_end)
+                         for shard_start, shard_end in shards]
+
+        # Keys will be segments with incomplete data and values will be
+        # the times to request their next data from.
+        incomplete_segments = {}
+
+        # Keys will be segments and values will be the ending timestamps
+        # of their most recent captures.
+        last_endings = {}
+
+        # Keys will be segments and values will be their captures.
+        segment_captures = {}
+
+        # Will contain the JSON objects for each individual trap, without
+        # their captures, which are kept in segment_captures until the
+        # segments are joined.
+        trap_data = collections.OrderedDict()
+
+        # Keys will be traps and values will be the (shard index,
+        # position) at which they were first listed, to put them back in
+        # the order the API lists them in.
+        first_listed = {}
+
+        def add_first_page(i, js):
+            """Store each trap's captures from the first request for
+            shard i, so that the response can be dropped.
+            """
+            shard_start, shard_end = shards[i]
+
+            for position, trap_wrapper in enumerate(js['traps']):
+                trap_id = trap_wrapper['Trap']['id']
+
+                # If no trap was specified or this trap was specified,
+                # grab its data.
+                if not target_traps or trap_id in target_traps:
+                    captures = trap_wrapper['Capture']
+                    num_captures = len(captures)
+                    com.count('captures', num_captures)
+
+                    if trap_id not in first_listed or (i, position) < first_listed[trap_id]:
+                        first_listed[trap_id] = (i, position)
+
+                    if trap_id not in trap_data:
+                        # Keep the captures' place among the trap's keys.
+                        trap_data[trap_id] = collections.OrderedDict(
+                            (key, None if key == 'Capture' else value)
+                            for key, value in trap_wrapper.items())
+
+                        if stdscr:
+                            # Draw horizontal lines, one every other row
+                            # from row 5, making room for them if needed.
+                            y = 5 + 2*len(trap_ys)
+                            trap_ys[trap_id] = y
+
+                            if y + 5 > pad.getmaxyx()[0]:
+                                pad.resize(y + 5, max_x)
+
+                            pad.addstr(y, 2, trap_id)
+                            pad.hline(y, 21, '-', graph_width)
+
+                    if spill:
+                        segment_captures[trap_id, i] = SpilledCaptures(
+                            os.path.join(spill_dir.name, '{}_{}.jsonl'.format(trap_id, i)))
+                        segment_captures[trap_id, i].extend(captures)
+                    else:
+                        segment_captures[trap_id, i] = captures
+
+                    # If the API is ever improved so that it can deliver
+                    # more than limit captures, we'll have to modify this
+                    # script.
+                    if num_captures > limit:
+                        raise ValueError('More than {} (limit) captures for a trap: {}.'
+                                         .format(limit, num_captures))
+
+                    # If we get limit capture for this segment, most likely
+                    # we hit the max and the trap has more data in the
+                    # shard that wasn't delivered.  Store the most recent
+                    # timestamp in incomplete_segments.  Else, assume that
+                    # we got all captures.
+                    if num_captures == limit:
+                        ending_timestamp = captures[-1]['timestamp_end']
+                        ending_datetime = dt.datetime.strptime(ending_timestamp,
+                                                               '%Y-%m-%d %H:%M:%S')
+                        last_endings[trap_id, i] = ending_datetime
+
+                        if ending_datetime < shard_end:
+                            incomplete_segments[trap_id, i] = ending_datetime
+
+                    if stdscr:
+                        if (trap_id, i) in incomplete_segments:
+                            # Draw a white line to show the data
+                            # we currently have.
+                            fill_graph(trap_ys[trap_id], shard_start, ending_datetime, start_time,
+                                       gradation, curses.color_pair(1), pad)
+                        else:
+                            fill_graph(trap_ys[trap_id], shard_start, shard_end, start_time,
+                                       gradation, curses.color_pair(2), pad)
+
+        if len(first_windows) == 1:
+            if progress is not None:
+                progress.set_status('Performing request...')
+
+            add_first_page(0, fetch_page(page_journal, cache, limiter, api_key, start_time,
+                                         end_time, pad, retries, timeout, quiet,
+                                         progress=progress))
+        else:
+            message = 'Performing {} request(s)...'.format(len(first_windows))
 
             if stdscr:
-                # Draw horizontal lines.
-                y, x = pad.getyx()
-                y += 2
-                pad.move(y, 2)
-                trap_ys[trap_id] = y
-                pad.addstr(trap_id)
-                pad.hline(y, 21, '-', graph_width)
-
-            # If we get limit capture for this trap, most likely we hit
-            # the max and the trap has more data that wasn't delivered.
-            if num_captures == limit:
-                # Store the most recent timestamp in incomplete_traps.
-                ending_timestamp = captures[-1]['timestamp_end']
-                ending_datetime = dt.datetime.strptime(ending_timestamp, '%Y-%m-%d %H:%M:%S')
-                incomplete_traps[trap_id] = ending_datetime
+                print_status(message, pad)
+            elif progress is not None:
+                progress.set_status(message)
+            else:
+                print(message)
 
-                if stdscr:
-                    # Draw a white line to show the data
-                    # we currently have and print the number of
-                    # captures (limit) to the right of the line.
-                    position = date_to_position(ending_datetime, start_time, gradation)
-                    pad.hline(trap_ys[trap_id], 21, ' ', position, curses.color_pair(1))
-                    pad.addstr(y, 23 + graph_width, str(num_captures))
-                else:
-                    percentage = date_to_percentage(ending_datetime, start_time, end_time)
-                    print('Trap {}: {}% complete.'.format(trap_id, percentage))
+            # Handle each response as soon as it arrives, and let go of
+            # it, so that only the responses that haven't been handled
+            # yet are held in memory.
+            for i, js in fetch_windows(executor, max_requests, first_windows, page_journal,
+                                       cache, limiter, api_key, None, retries, timeout, quiet,
+                                       progress=progress):
+                add_first_page(i, js)
 
-            # If the API is ever improved so that it can deliver more
-            # than limit captures, we'll have to modify this script.
-            elif num_captures > limit:
-                raise ValueError('More than {} (limit) captures for a trap: {}.'
-                                 .format(limit, num_captures))
+            del js
 
-            # Else, assume that we got all captures.
+        # The responses arrive in any order, so put the traps in the
+        # order the API lists them in.
+        trap_data = collections.OrderedDict(
+            sorted(trap_data.items(), key=lambda item: first_listed[item[0]]))
+
+        # If traps were specified, check to see if they're all there.
+        if target_traps:
+            diff = set(target_traps) - set(trap_data.keys())
+
+            if diff:
+                raise ValueError('Trap ID(s) not found in response: ' + ', '.join(diff))
+
+        # The time left to download for each trap with incomplete data.
+        remaining = remaining_time(incomplete_segments, shards)
+
+        for trap_id in trap_data:
+            if trap_id in remaining:
+                if stdscr:
+                    # Print the number of captures to the right
+                    # of the trap's line.
+                    num_captures = sum(len(segment_captures[trap_id, i])
+                                       for i in range(len(shards))
+                                       if (trap_id, i) in segment_captures)
+                    pad.addstr(trap_ys[trap_id], 23 + graph_width, str(num_captures))
+                elif progress is None:
+                    percentage = math.floor((1 - remaining[trap_id]/duration) * 100)
+                    print('Trap {}: {}% complete.'.format(trap_id, percentage))
             else:
                 if stdscr:
+                    y = trap_ys[trap_id]
                     pad.addstr(y, 23 + graph_width, 'Done')
                     pad.hline(y, 21, ' ', graph_width, curses.color_pair(2))
-                else:
+                elif progress is None:
                     print('Trap {}: 100% complete.'.format(trap_id))
 
-    # If traps were specified, check to see if they're all there.
-    if target_traps:
-        diff = set(target_traps) - set(trap_data.keys())
-
-        if diff:
-            raise ValueError('Trap ID(s) not found in response: ' + ', '.join(diff))
-
-    if stdscr:
-        # Draw vertical lines.
-        pad.vline(3, 20, '|', 2*len(trap_ys) + 3)
-        pad.vline(3, 21 + graph_width, '|', 2*len(trap_ys) + 3)
-        pad.addch(2, 20, '+')
-        pad.addch(2*len(trap_ys) + 6, 20, '+')
-
-        pad.refresh()
+        if stdscr:
+            # Draw vertical lines.
+            pad.vline(3, 20, '|', 2*len(trap_ys) + 3)
+            pad.vline(3, 21 + graph_width, '|', 2*len(trap_ys) + 3)
+            pad.addch(2, 20, '+')
+            pad.addch(2*len(trap_ys) + 6, 20, '+')
+
+        if progress is not None:
+            progress.set_progress(timeframe_fraction(len(trap_data), remaining, start_time,
+                                                     end_time))
+
+        # The start of each shard, to find the shards a window overlaps.
+        shard_starts = [shard_start for shard_start, shard_end in shards]
+
+        # Keys will be segments and values will be lists of
+        # (window_start, window_end, captures) tuples holding data from
+        # windows that the segment hasn't caught up to yet.  If spill is
+        # set, the captures are kept in files.
+        pending = collections.defaultdict(list)
+
+        # The number of windows' captures that have been spilled, to
+        # name their files.
+        num_spilled = 0
+
+        # Loop while there are still segments with more data.
+        while incomplete_segments:
+            # Each segment needs data up to the end of its shard, or
+            # up to the data it already has from a later window, which
+            # it can carry on with from there.
+            ranges = []
+
+            for segment, cursor in incomplete_segments.items():
+                needed_until = shards[segment[1]][1]
+
+                if pending.get(segment):
+                    needed_until = min([needed_until]
+                                       + [window[0] for window in pending[segment]])
+
+                ranges.append((cursor, needed_until))
+
+            # Group the segments by how far along they are and plan
+            # the requests for each group.
+            windows = plan_requests(ranges, end_time)
+            earliest_date = windows[0][0]
+
+            # The traps with incomplete data, in order.
+            incomplete_traps = list(collections.OrderedDict.fromkeys(
+                trap_id for trap_id, i in incomplete_segments))
 
-    # Loop while there are still traps with more data.
-    while incomplete_traps:
-        # Find which ending timestamp is the earliest.
-        ending_dates = list(incomplete_traps.values())
-        earliest_date = ending_dates[0]
+            if stdscr:
+                # Move the tracking line to the earliest time.
+                position = date_to_position(earliest_date, start_time, gradation)
+                erase_tracking_line(graph_width, trap_ys, pad)
+                draw_tracking_line(position, trap_ys, pad)
+                print_status('Performing {} request(s)...'.format(len(windows)), pad)
+            elif progress is not None:
+                progress.set_status('Performing {} request(s)...'.format(len(windows)))
+
+            # Turn all previous data green.
+            if stdscr:
+                for trap_id, i in incomplete_segments:
+                    fill_graph(trap_ys[trap_id], shards[i][0], last_endings[trap_id, i],
+                               start_time, gradation, curses.color_pair(2), pad)
+
+            # Perform the requests concurrently, spacing them out so we
+            # don't overload the server, and store each segment's data
+            # from each window as soon as it arrives.
+            for window_index, new_js in fetch_windows(executor, max_requests, windows,
+                                                      page_journal, cache, limiter, api_key,
+                                                      None, retries, timeout, quiet,
+                                                      progress=progress):
+                window_start, window_end = windows[window_index]
+
+                # Only the segments of shards that the window overlaps,
+                # counting the early start of their first request, can
+                # use its data.
+                first_shard = max(bisect.bisect_right(shard_starts, window_start) - 1, 0)
+                last_shard = bisect.bisect_left(shard_starts, window_end + window_overlap)
+
+                for trap_wrapper in new_js['traps']:
+                    trap_id = trap_wrapper['Trap']['id']
+                    captures = trap_wrapper['Capture']
+
+                    for i in range(first_shard, last_shard):
+                        segment = (trap_id, i)
+
+                        if (segment in incomplete_segments
+                                and window_end > incomplete_segments[segment]):
+                            # Check if there are more than limit captures
+                            # for the same reason as before.
+                            if len(captures) > limit:
+                                raise ValueError('More than {} (limit) captures for a trap: {}.'
+                                                 .format(limit, len(captures)))
+
+                            # Keep the data on disk until the segment
+                            # catches up to it.  The segments of all
+                            # shards the window overlaps share the file.
+                            if spill and not isinstance(captures, SpilledCaptures):
+                                captures = SpilledCaptures(os.path.join(
+                                    spill_dir.name, '{}_w{}.jsonl'.format(trap_id, num_spilled)))
+                                captures.extend(trap_wrapper['Capture'])
+                                num_spilled += 1
+
+                            pending[segment].append((window_start, window_end, captures))
+
+            # Keys will be traps and values will be the numbers of
+            # captures they got in this round.
+            new_captures_per_trap = collections.Counter()
+
+            for segment in list(incomplete_segments):
+                trap_id, i = segment
+                shard_start, shard_end = shards[i]
+                num_new_captures = 0
 
-        for date in ending_dates:
-            if date < earliest_date:
-                earliest_date = date
+                if stdscr:
+                    y = trap_ys[trap_id]
+                    last_ending = last_endings[segment]
 
-        if stdscr:
-            # Move the tracking line to the earliest time.
-            position = date_to_position(earliest_date, start_time, gradation)
-            erase_tracking_line(graph_width, trap_ys, pad)
-            draw_tracking_line(position, trap_ys, pad)
+                # Use the data from the windows in chronological order.
+                # Data from a window starting after the point we need data
+                # from has to wait until the segment catches up to it, or
+                # else there would be a gap.
+                for window in sorted(pending[segment], key=lambda window: window[0]):
+                    window_start, window_end, captures = window
 
-        # Perform a request from the earliest time to the original
-        # end time with a second delay so we don't overload the server.
-        time.sleep(1)
-        new_js = request_data(api_key, earliest_date, end_time, pad)
+                    if not window_start <= incomplete_segments[segment] < window_end:
+                        continue
 
-        # Turn all previous data green.
-        if stdscr:
-            for trap_id, ending_date in incomplete_traps.items():
-                position = date_to_position(ending_date, start_time, gradation)
-                pad.hline(trap_ys[trap_id], 21, ' ', position, curses.color_pair(2))
+                    pending[segment].remove(window)
+                    num_captures = len(captures)
 
-            pad.refresh()
+                    # Only load one window of spilled data at a time.
+                    if spill:
+                        captures = list(captures)
 
-        for trap_wrapper in new_js['traps']:
-            trap_id = trap_wrapper['Trap']['id']
+                    # Add the new captures, if any, to the segment and
+                    # update its most recent timestamp.
+                    new_captures = captures[first_new_capture(captures, last_endings[segment]):]
 
-            if trap_id in incomplete_traps:
-                captures = trap_wrapper['Capture']
-                num_captures = len(captures)
-                num_new_captures = 0
+                    if new_captures:
+                        num_new_captures += len(new_captures)
+                        segment_captures[segment].extend(new_captures)
+                        com.count('captures', len(new_captures))
 
-                if stdscr:
-                    # Get the last timestamp and draw a white bar
-                    # for all new data.
-                    y = trap_ys[trap_id]
-                    last_ending_position = date_to_position(incomplete_traps[trap_id], start_time,
-                                                            gradation)
-                    ending_timestamp = captures[-1]['timestamp_end']
-                    ending_datetime = dt.datetime.strptime(ending_timestamp, '%Y-%m-%d %H:%M:%S')
-                    position = date_to_position(ending_datetime, start_time, gradation)
-                    pad.hline(y, last_ending_position + 21, ' ', position - last_ending_position,
-                              curses.color_pair(1))
-                    pad.refresh()
-
-                # Check if there are more than limit captures
-                # for the same reason as before.
-                if num_captures > limit:
-                    raise ValueError('More than {} (limit) captures for a trap: {}.'
-                                     .format(limit, num_captures))
-
-                # Loop through the captures.
-                for i in range(num_captures):
-                    capture = captures[i]
-                    timestamp_start = com.make_datetime(capture['timestamp_start'])
-                    timestamp_end = com.make_datetime(capture['timestamp_end'])
-
-                    # If this capture has valid timestamps and has
-                    # a timestamp after the most recent timestamp
-                    # for this trap, this and all following captures
-                    # are new data.
-                    if (timestamp_start and timestamp_end
-                            and timestamp_start >= incomplete_traps[trap_id]):
-                        # Add the new data to the JSON object.
-                        new_captures = captures[i:]
-                        num_new_captures = len(new_captures)
-                        trap_data[trap_id]['Capture'].extend(new_captures)
-
-                        # Update the most recent timestamp
-                        # in incomplete_traps.
                         ending_timestamp = new_captures[-1]['timestamp_end']
                         ending_datetime = com.make_datetime(ending_timestamp)
 
@@ -317,57 +631,127 @@ def download_data(stdscr, api_key, start_time, end_time, output, target_traps=No
                         # a problem.
                         if not ending_datetime:
                             raise ValueError('Last ending timestamp is empty at capture ID: '
-                                             + capture['id'])
+                                             + new_captures[0]['id'])
+
+                        last_endings[segment] = incomplete_segments[segment] = ending_datetime
+
+                    # If less than limit captures were delivered, assume
+                    # we now have all the data in this window.  Pick up at
+                    # the end of the window, backing up a little in case
+                    # a capture straddles it; any duplicates are skipped
+                    # above.  If the segment has reached the end of its
+                    # shard, we have all of its data.
+                    if (last_endings[segment] >= shard_end
+                            or (num_captures < limit and window_end >= shard_end)):
+                        del incomplete_segments[segment]
+                        del pending[segment]
+                        break
 
-                        incomplete_traps[trap_id] = ending_datetime
+                    if num_captures < limit:
+                        incomplete_segments[segment] = max(last_endings[segment],
+                                                           window_end - window_overlap)
 
-                        # No need to loop through the rest
-                        # of the captures.
-                        break
+                new_captures_per_trap[trap_id] += num_new_captures
+
+                if stdscr and num_new_captures:
+                    # Draw a white bar for all new data.
+                    fill_graph(y, last_ending, last_endings[segment], start_time, gradation,
+                               curses.color_pair(1), pad)
 
-                # If less than limit captures were delivered, assume
-                # we now have all the data.
-                if num_captures < limit:
-                    del incomplete_traps[trap_id]
+                if segment not in incomplete_segments:
+                    if stdscr:
+                        fill_graph(y, shard_start, shard_end, start_time, gradation,
+                                   curses.color_pair(2), pad)
+                else:
+                    # Forget data that the segment has already moved past.
+                    pending[segment] = [window for window in pending[segment]
+                                        if window[1] > incomplete_segments[segment]]
+
+            remaining = remaining_time(incomplete_segments, shards)
+
+            for trap_id in incomplete_traps:
+                if stdscr:
+                    y = trap_ys[trap_id]
+                    pad.hline(y, 23 + graph_width, ' ', 6)
 
+                if trap_id not in remaining:
                     if stdscr:
-                        pad.hline(y, 23 + graph_width, ' ', 6)
                         pad.addstr(y, 23 + graph_width, 'Done')
                         pad.hline(y, 21, ' ', graph_width, curses.color_pair(2))
-                    else:
+                    elif progress is None:
                         print('Trap {}: 100% complete.'.format(trap_id))
 
-                else:
-                    if stdscr:
-                        # Print the number of new captures
-                        # to the right of the trap's line.
-                        pad.hline(y, 23 + graph_width, ' ', 6)
-                        pad.addstr(y, 23 + graph_width, '+' + str(num_new_captures))
-                    else:
-                        percentage = date_to_percentage(incomplete_traps[trap_id],
-                                                        start_time, end_time)
-                        print('Trap {}: {}% complete. ({} new captures)'
-                              .format(trap_id, percentage, num_new_captures))
+                elif stdscr:
+                    # Print the number of new captures
+                    # to the right of the trap's line.
+                    pad.addstr(y, 23 + graph_width, '+' + str(new_captures_per_trap[trap_id]))
+                elif progress is None:
+                    percentage = math.floor((1 - remaining[trap_id]/duration) * 100)
+                    print('Trap {}: {}% complete. ({} new captures)'
+                          .format(trap_id, percentage, new_captures_per_trap[trap_id]))
 
-    if stdscr:
-        # Now that we're done, move the tracking line to the end.
-        erase_tracking_line(graph_width, trap_ys, pad)
-        draw_tracking_line(graph_width, trap_ys, pad)
+            if progress is not None:
+                progress.set_progress(timeframe_fraction(len(trap_data), remaining, start_time,
+                                                         end_time))
+
+        # Put each trap's segments back together in chronological order.
+        for trap_id, trap_wrapper in trap_data.items():
+            segments = [segment_captures[trap_id, i] for i in range(len(shards))
+                        if (trap_id, i) in segment_captures]
+
+            if len(segments) == 1:
+                trap_wrapper['Capture'] = segments[0]
+            elif spill:
+                trap_wrapper['Capture'] = SpilledCaptures(
+                    os.path.join(spill_dir.name, trap_id + '.jsonl'))
+                trap_wrapper['Capture'].extend(merge_segments(segments))
+            else:
+                trap_wrapper['Capture'] = list(merge_segments(segments))
+
+        if stdscr:
+            # Now that we're done, move the tracking line to the end.
+            erase_tracking_line(graph_width, trap_ys, pad)
+            draw_tracking_line(graph_width, trap_ys, pad)
 
-    # Unless we're doing a dry run, write the JSON objects to file.
-    if not dry:
-        write_to_file(trap_data, api_key, start_time, end_time, output,
-                      split_traps, skip_empty, pretty_print, pad)
+        # Unless we're doing a dry run, write the JSON objects to file.
+        if not dry:
+            write_to_file(trap_data, api_key, start_time, end_time, output,
+                          split_traps, skip_empty, pretty_print, pad, compression, progress)
+
+            if store:
+                com.write_capture_store(store, [
+                    trap_wrapper for trap_wrapper in trap_data.values()
+                    if not (skip_empty and not trap_wrapper['Capture'])])
+
+        # The journal is only kept to resume a download that didn't
+        # finish.
+        if page_journal is not None:
+            page_journal.remove()
+
+        if stdscr:
+            print_status('Finished!', pad)
+    finally:
+        # Don't wait for requests still in flight if the download
+        # failed.
+        executor.shutdown(wait=False)
+
+        if spill_dir is not None:
+            spill_dir.cleanup()
+
+        if pad is not None:
+            pad.close()
 
     if stdscr:
-        print_status('Finished!', pad)
         time.sleep(1.5)
+    elif progress is not None:
+        progress.finish()
     else:
         print('Finished.')
 
 
 def write_to_file(trap_data, api_key, start_time, end_time, output,
-                  split_traps=False, skip_empty=False, pretty_print=None, screen=None):
+                  split_traps=False, skip_empty=False, pretty_print=None, screen=None,
+                  compression=None, progress=None):
     """Write smart trap JSON data to file.
 
     Required arguments:
@@ -393,10 +777,18 @@ def write_to_file(trap_data, api_key, start_time, end_time, output,
         to the output files.
     screen -- The curses screen object on which to print the status.
         'None' indicates that a curses screen is not being used.
+    compression -- The format to compress the output files with:
+        'gzip', 'zstd', or None.  If None, the format is chosen based on
+        the output option's extension.  The JSON is compressed as it's
+        encoded, so the uncompressed document is never held in memory.
+    progress -- A DownloadProgress to show the status on instead of
+        printing it, if no curses screen is used.
     """
     # Write trap data to file.
     if screen:
         print_status('Writing to file...', screen)
+    elif progress is not None:
+        progress.set_status('Writing to file...')
     else:
         print('Writing to file...')
 
@@ -408,6 +800,15 @@ def write_to_file(trap_data, api_key, start_time, end_time, output,
     if start_time.time() != midnight or end_time.time() != midnight:
         date_fmt += 'T%H-%M-%S'
 
+    # The files split from a compressed output file don't keep its
+    # extension, so work out the format from the output option.
+    if compression is None and output:
+        for name, extension in com.compression_extensions.items():
+            if output.endswith(extension):
+                compression = name
+
+    extension = '.json' + com.compression_extensions.get(compression, '')
+
     if split_traps:
         i = 0
 
@@ -425,22 +826,18 @@ def write_to_file(trap_data, api_key, start_time, end_time, output,
                     if not os.path.exists(dir_path):
                         os.makedirs(dir_path)
 
-                    filename = '{}_{}_{}.json'.format(trap_id, start_time.strftime(date_fmt),
-                                                      end_time.strftime(date_fmt))
+                    filename = '{}_{}_{}{}'.format(trap_id, start_time.strftime(date_fmt),
+                                                   end_time.strftime(date_fmt), extension)
                     path = '{}/{}'.format(dir_path, filename)
 
-                with open(path, 'w') as f:
-                    trap_obj = {'traps': [trap_wrapper]}
-                    json.dump(trap_obj, f, indent=pretty_print)
+                with com.open_json(path, 'w', compression) as f:
+                    write_traps(f, [trap_wrapper], pretty_print)
 
                 i += 1
 
     else:
-        trap_obj = {'traps': []}
-
-        for trap_wrapper in trap_data.values():
-            if not (skip_empty and not trap_wrapper['Capture']):
-                trap_obj['traps'].append(trap_wrapper)
+        trap_wrappers = [trap_wrapper for trap_wrapper in trap_data.values()
+                         if not (skip_empty and not trap_wrapper['Capture'])]
 
         if output:
             path = './' + output
@@ -451,12 +848,70 @@ def write_to_file(trap_data, api_key, start_time, end_time, output,
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
 
-            filename = '{}_{}.json'.format(start_time.strftime(date_fmt),
-                                           end_time.strftime(date_fmt))
+            filename = '{}_{}{}'.format(start_time.strftime(date_fmt),
+                                        end_time.strftime(date_fmt), extension)
             path = '{}/{}'.format(dir_path, filename)
 
-        with open(path, 'w') as f:
-            json.dump(trap_obj, f, indent=pretty_print)
+        with com.open_json(path, 'w', compression) as f:
+            write_traps(f, trap_wrappers, pretty_print)
+
+
+def write_traps(f, trap_wrappers, indent=None):
+    """Write trap objects to a file as a JSON object under 'traps'.
+
+    The result is the same as from json.dump, but each trap's captures
+    are written one at a time from any iterable, so that captures held
+    in a SpilledCaptures are streamed from disk.
+
+    Arguments:
+    f -- The file object to write to.
+    trap_wrappers -- A list of the trap objects, each holding its
+        captures under 'Capture'.
+    indent -- The indentation to pretty-print with, as for json.dump,
+        or None to write the JSON compactly.
+    """
+    if indent is None:
+        item_separator = ', '
+        newlines = [''] * 5
+    else:
+        if not isinstance(indent, str):
+            indent = ' ' * indent
+
+        item_separator = ','
+        newlines = ['\n' + indent * level for level in range(5)]
+
+    def encode(value, level):
+        """Encode a value nested level deep."""
+        return json.dumps(value, indent=indent).replace('\n', newlines[level])
+
+    if not trap_wrappers:
+        f.write('{' + newlines[1] + '"traps": []' + newlines[0] + '}')
+        return
+
+    f.write('{' + newlines[1] + '"traps": [')
+
+    for i, trap_wrapper in enumerate(trap_wrappers):
+        f.write((item_separator if i else '') + newlines[2] + '{')
+
+        for j, (key, value) in enumerate(trap_wrapper.items()):
+            f.write((item_separator if j else '') + newlines[3] + json.dumps(key) + ': ')
+
+            if key != 'Capture':
+                f.write(encode(value, 3))
+                continue
+
+            f.write('[')
+            empty = True
+
+            for capture in value:
+                f.write(('' if empty else item_separator) + newlines[4] + encode(capture, 4))
+                empty = False
+
+            f.write(']' if empty else newlines[3] + ']')
+
+        f.write(newlines[2] + '}')
+
+    f.write(newlines[1] + ']' + newlines[0] + '}')
 
 
 def valid_trap_id(string):
@@ -467,23 +922,301 @@ def valid_trap_id(string):
     return string
 
 
-def request_data(api_key, start_time, end_time, screen):
-    """Send a request for smart trap data and return data as a dict."""
+def get_session(max_requests=1):
+    """Return the HTTP session shared by all requests to the API.
+
+    Reusing one session keeps connections to the server alive between
+    requests instead of opening a new one for every page of data.  The
+    session keeps up to max_requests connections open, one for each
+    request in flight at once, and makes room for more if a later
+    caller has more requests in flight.
+    """
+    global _session, _session_size
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers['Accept-Encoding'] = 'gzip'
+
+        if max_requests > _session_size:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=max_requests)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+            _session_size = max_requests
+
+        return _session
+
+
+def plan_requests(ranges, end_time):
+    """Plan a set of requests covering the data that traps still need.
+
+    Sorts the ranges of time that traps need data over by their starts
+    and joins the ranges that overlap into spans, so that no time is
+    requested twice.  Each span is split into windows of at most
+    max_window, so that each trap's captures in a window normally all
+    arrive in one response, and a new window also starts wherever
+    a range starts at least group_span after the start of the current
+    window.  Each window runs window_overlap past the start of the next
+    one, or past the end of its span, so that a trap that gets all of
+    its data in one window can carry on from there without missing any
+    captures.
+
+    Returns a list of (window_start, window_end) tuples in chronological
+    order.
+
+    Arguments:
+    ranges -- An iterable of (start, end) tuples of datetimes, one for
+        each trap with incomplete data, holding the time to request its
+        next data from and the time it needs data up to.
+    end_time -- A datetime object representing the end of the full
+        timeframe.  No window runs past it.
+    """
+    # Will contain a [window_starts, span_end] list for each span.
+    spans = []
+
+    for range_start, range_end in sorted(ranges):
+        if not spans or range_start > spans[-1][1]:
+            spans.append([[range_start], range_end])
+            continue
+
+        window_starts = spans[-1][0]
+
+        while range_start - window_starts[-1] > max_window:
+            window_starts.append(window_starts[-1] + max_window)
+
+        if range_start - window_starts[-1] >= group_span:
+            window_starts.append(range_start)
+
+        spans[-1][1] = max(spans[-1][1], range_end)
+
+    windows = []
+
+    for window_starts, span_end in spans:
+        while span_end - window_starts[-1] > max_window:
+            window_starts.append(window_starts[-1] + max_window)
+
+        for window_start, next_start in zip(window_starts, window_starts[1:] + [span_end]):
+            windows.append((window_start, min(next_start + window_overlap, end_time)))
+
+    return windows
+
+
+def split_timeframe(start_time, end_time, shard=None):
+    """Split a timeframe into shards at the start of each calendar unit.
+
+    Returns a list of (start, end) tuples covering the timeframe in
+    chronological order.  shard is one of shard_units, or None to
+    return the whole timeframe as the only shard.  Weeks start on
+    Monday.
+    """
+    boundaries = [start_time]
+
+    if shard:
+        while True:
+            previous = boundaries[-1]
+
+            if shard == 'year':
+                boundary = dt.datetime(previous.year + 1, 1, 1)
+            elif shard == 'month':
+                boundary = dt.datetime(previous.year + previous.month // 12,
+                                       previous.month % 12 + 1, 1)
+            elif shard == 'week':
+                boundary = dt.datetime.combine(
+                    previous.date() + dt.timedelta(days=7 - previous.weekday()), dt.time())
+            else:
+                raise ValueError('Invalid shard unit: ' + shard)
+
+            if boundary >= end_time:
+                break
+
+            boundaries.append(boundary)
+
+    boundaries.append(end_time)
+
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def first_new_capture(captures, last_ending):
+    """Return the index of the first capture following last_ending.
+
+    This is the first capture with valid timestamps starting at or after
+    last_ending, the ending datetime of the most recent capture already
+    downloaded.  All captures from there on are new data.  Returns
+    len(captures) if there are none.
+    """
+    for i, capture in enumerate(captures):
+        timestamp_start = com.make_datetime(capture['timestamp_start'])
+        timestamp_end = com.make_datetime(capture['timestamp_end'])
+
+        if timestamp_start and timestamp_end and timestamp_start >= last_ending:
+            return i
+
+    return len(captures)
+
+
+def merge_segments(segments):
+    """Yield the captures of a trap's segments in chronological order.
+
+    segments is a list of the trap's captures in each shard, in order.
+    The first request for a shard starts a little before the shard does,
+    so the captures at the start of a segment that the previous segments
+    already got are skipped.
+    """
+    last_ending = None
+
+    for captures in segments:
+        new = last_ending is None
+        last_capture = None
+
+        for capture in captures:
+            if not new:
+                timestamp_start = com.make_datetime(capture['timestamp_start'])
+                timestamp_end = com.make_datetime(capture['timestamp_end'])
+                new = timestamp_start and timestamp_end and timestamp_start >= last_ending
+
+                if not new:
+                    continue
+
+            yield capture
+            last_capture = capture
+
+        if last_capture is not None:
+            last_ending = com.make_datetime(last_capture['timestamp_end']) or last_ending
+
+
+def fetch_page(journal, cache, limiter, api_key, start_time, end_time, *args, **kwargs):
+    """Get the data for a window of time.
+
+    Returns the response recorded in the journal if there is one.
+    Otherwise, looks the response up in the cache, or calls request_data
+    once the limiter allows it and adds the response to the cache, then
+    records the response in the journal.  The journal and the cache may
+    be None.
+    """
+    js = journal.get(start_time, end_time) if journal is not None else None
+
+    if js is None:
+        js = cache.get(api_key, start_time, end_time) if cache is not None else None
+
+        if js is None:
+            js = limited_request(limiter, api_key, start_time, end_time, *args, **kwargs)
+
+            if cache is not None:
+                cache.put(api_key, start_time, end_time, js)
+
+        if journal is not None:
+            journal.record(start_time, end_time, js)
+
+    return js
+
+
+def fetch_windows(executor, max_pending, windows, journal, cache, limiter, api_key, *args,
+                  **kwargs):
+    """Get the data for several windows of time concurrently.
+
+    Calls fetch_page for each (start, end) tuple in windows on the
+    executor and yields an (index, js) tuple for each window as its
+    response arrives, where index is the window's index in windows.
+    At most max_pending windows are requested ahead of the responses
+    that have been yielded, so that responses don't pile up in memory
+    when they arrive faster than they're handled.  The other arguments
+    are passed on to fetch_page.
+    """
+    unrequested = enumerate(windows)
+    fetch = com.with_stages(fetch_page)
+
+    # Keys will be futures and values will be the indexes of their
+    # windows.
+    futures = {}
+
+    while True:
+        for i, (window_start, window_end) in itertools.islice(unrequested,
+                                                              max_pending - len(futures)):
+            futures[executor.submit(fetch, journal, cache, limiter, api_key, window_start,
+                                    window_end, *args, **kwargs)] = i
+
+        if not futures:
+            return
+
+        done, _ = concurrent.futures.wait(futures,
+                                          return_when=concurrent.futures.FIRST_COMPLETED)
+        future = done.pop()
+        del done
+
+        yield futures.pop(future), future.result()
+
+        # Let go of the response once it has been handled.
+        del future
+
+
+def limited_request(limiter, *args, **kwargs):
+    """Call request_data with args once the limiter allows it."""
+    with limiter:
+        return request_data(*args, max_requests=limiter.max_requests, **kwargs)
+
+
+def request_data(api_key, start_time, end_time, screen, retries=3, timeout=600, quiet=False,
+                 backoff=2, progress=None, max_requests=1):
+    """Send a request for smart trap data and return data as a dict.
+
+    Requests that fail because of a connection problem, a timeout, or
+    a server-side error are retried up to 'retries' times.  The delay
+    before each retry grows exponentially from 'backoff' seconds and is
+    randomized to avoid retrying in lockstep with other clients.
+    'timeout' is the number of seconds to wait for the server to start
+    sending a response.  Pass True for 'quiet' to suppress all status
+    messages, such as when the request is made off the main thread while
+    the graphical display is shown.  If a DownloadProgress is passed as
+    'progress', the request, the bytes received and any retries are
+    counted on it, and retries are shown as its status.  'max_requests'
+    is the number of requests that can be in flight at once, which the
+    shared session keeps as many connections open for.
+    """
     if screen:
         print_status('Performing request...', screen)
-    else:
+    elif not quiet:
         print('Performing request...')
 
-    url = 'http://live.bg-counter.com/traps/exportTrapCapturesForTimeFrame.json'
-
     data = {
         'data[user_id]': api_key,
         'data[startTime]': start_time.isoformat(' '),
         'data[endTime]': end_time.isoformat(' ')
     }
 
-    response = requests.post(url, data)
-    response.raise_for_status()
+    attempt = 0
+
+    while True:
+        try:
+            response = get_session(max_requests).post(api_url, data,
+                                                      timeout=(connect_timeout, timeout))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise
+
+            error = type(e).__name__
+        else:
+            if response.status_code not in retry_statuses or attempt >= retries:
+                response.raise_for_status()
+                break
+
+            error = '{} {}'.format(response.status_code, response.reason)
+
+        delay = random.uniform(0.5, 1.5) * backoff * 2**attempt
+        attempt += 1
+        message = 'Request failed ({}). Retry {} in {:.1f}s...'.format(error, attempt, delay)
+
+        if progress is not None:
+            progress.add_retry()
+
+        if screen:
+            print_status(message, screen)
+        elif progress is not None:
+            progress.set_status(message)
+        elif not quiet:
+            print(message)
+
+        time.sleep(delay)
 
     try:
         js = json.loads(response.text, object_pairs_hook=collections.OrderedDict)
@@ -494,9 +1227,16 @@ def request_data(api_key, start_time, end_time, screen):
         print("Response text:\n'" + response.text + "'\n")
         raise
 
+    # Count the bytes received over the network, which are fewer than
+    # in the text if the response was compressed.
+    com.count('bytes_downloaded', response.raw.tell())
+
+    if progress is not None:
+        progress.add_request(response.raw.tell())
+
     if screen:
         print_status('Done.', screen)
-    else:
+    elif not quiet:
         print('Done.')
 
     return js
@@ -507,9 +1247,72 @@ def date_to_position(datetime, start_time, gradation):
     return math.floor((datetime-start_time) / gradation)
 
 
-def date_to_percentage(datetime, start_time, end_time):
-    """Return the percentage of the timeframe a datetime represents."""
-    return math.floor(((datetime-start_time) / (end_time-start_time)) * 100)
+def remaining_time(incomplete_segments, shards):
+    """Return how much of each trap's timeframe is left to download.
+
+    Returns a dict mapping the trap ID of each trap with incomplete data
+    to a timedelta.
+
+    Arguments:
+    incomplete_segments -- A dict mapping (trap ID, shard index) pairs
+        to the datetimes to request the segments' next data from.
+    shards -- The list of (start, end) tuples the timeframe is split
+        into.
+    """
+    remaining = collections.OrderedDict()
+
+    for (trap_id, i), cursor in incomplete_segments.items():
+        shard_start, shard_end = shards[i]
+        remaining[trap_id] = (remaining.get(trap_id, dt.timedelta())
+                              + shard_end - max(cursor, shard_start))
+
+    return remaining
+
+
+def timeframe_fraction(num_traps, remaining, start_time, end_time):
+    """Return the fraction of all traps' timeframes that has been covered.
+
+    Arguments:
+    num_traps -- The number of traps being downloaded.
+    remaining -- A dict as returned by remaining_time.
+    start_time -- A datetime object representing the beginning of the
+        timeframe.
+    end_time -- A datetime object representing the end of the
+        timeframe.
+    """
+    if not num_traps:
+        return 1
+
+    left = sum(remaining.values(), dt.timedelta())
+
+    return 1 - left / ((end_time-start_time) * num_traps)
+
+
+def format_size(num_bytes):
+    """Return a number of bytes as a short human-readable string."""
+    for unit in ('B', 'kB', 'MB'):
+        if num_bytes < 1000:
+            return '{:.1f} {}'.format(num_bytes, unit)
+
+        num_bytes /= 1000
+
+    return '{:.1f} GB'.format(num_bytes)
+
+
+def format_duration(seconds):
+    """Return a number of seconds in the form H:MM:SS."""
+    minutes, seconds = divmod(round(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+def fill_graph(y, from_datetime, to_datetime, start_time, gradation, attr, screen):
+    """Fill in a trap's graph between two datetimes."""
+    from_position = date_to_position(from_datetime, start_time, gradation)
+    to_position = date_to_position(to_datetime, start_time, gradation)
+
+    screen.hline(y, from_position + 21, ' ', to_position - from_position, attr)
 
 
 def draw_tracking_line(position, trap_ys, screen):
@@ -524,7 +1327,6 @@ def draw_tracking_line(position, trap_ys, screen):
 
     screen.addch(2*len(trap_ys) + 5, position, '|')
     screen.addch(2*len(trap_ys) + 6, position, '+')
-    screen.refresh()
 
 
 def erase_tracking_line(graph_width, trap_ys, screen):
@@ -538,14 +1340,398 @@ def erase_tracking_line(graph_width, trap_ys, screen):
 
     screen.hline(2*len(trap_ys) + 5, 21, ' ', graph_width)
     screen.hline(2*len(trap_ys) + 6, 20, ' ', graph_width + 2)
-    screen.refresh()
 
 
 def print_status(string, screen):
     """Print the given string at the top left of the screen."""
     screen.hline(1, 2, ' ', 30)
     screen.addstr(1, 2, string)
-    screen.refresh()
+
+
+class RequestLimiter:
+    """Limit how often and how many requests can be made across threads.
+
+    An instance is used as a context manager around each request.
+    Entering it blocks until fewer than max_requests requests are in
+    flight and at least 1/rate seconds have passed since the previous
+    request was started.  Sharing one instance between several
+    downloads limits their combined load on the server.
+    """
+
+    def __init__(self, rate, max_requests):
+        """Initialize the instance.
+
+        rate -- The maximum number of requests to start per second.
+        max_requests -- The maximum number of requests in flight.
+        """
+        self.interval = 1 / rate
+        self.max_requests = max_requests
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_requests)
+
+    def __enter__(self):
+        """Wait until a request is allowed to start."""
+        self.slots.acquire()
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+        return self
+
+    def __exit__(self, *exc_info):
+        """Mark the request as finished."""
+        self.slots.release()
+
+
+class SpilledCaptures:
+    """Hold a trap's captures in a file instead of in memory.
+
+    The captures are stored in a file with one JSON-encoded capture per
+    line.  They can be added to the end, counted, and iterated over,
+    which reads them back from the file one at a time.  write_traps
+    streams them from the file into the output.
+
+    Public methods:
+        extend
+    """
+
+    def __init__(self, path):
+        """Initialize the instance and create its (empty) file.
+
+        path -- The name of the file to store the captures in.
+        """
+        self.path = path
+        self.count = 0
+
+        open(path, 'w').close()
+
+    def extend(self, captures):
+        """Append captures to the end of the file."""
+        with open(self.path, 'a') as f:
+            for capture in captures:
+                f.write(json.dumps(capture) + '\n')
+                self.count += 1
+
+    def __len__(self):
+        """Return the number of captures."""
+        return self.count
+
+    def __bool__(self):
+        """Return whether there are any captures."""
+        return self.count > 0
+
+    def __iter__(self):
+        """Read the captures back from the file one at a time."""
+        with open(self.path) as f:
+            for line in f:
+                yield json.loads(line, object_pairs_hook=collections.OrderedDict)
+
+
+class PageJournal:
+    """Record the responses of a download so it can be resumed.
+
+    Each response is appended to a file, one per line, along with the
+    window of time it was requested for.  Because the requests that
+    download_data makes only depend on the responses to the previous
+    ones, a download that is started again with the same API key and
+    timeframe can be resumed by answering its requests from the
+    journal until it runs out of recorded responses.  The journal is
+    started over if it was recorded for a different download.
+
+    Public methods:
+        recorded_end_time
+        get
+        record
+        remove
+    """
+
+    def __init__(self, path, api_key, start_time, end_time):
+        """Initialize the instance, loading the journal if it exists.
+
+        path -- The name of the journal file.
+        api_key -- The API key of the download.  Only a hash of it is
+            stored.
+        start_time -- A datetime object representing the beginning of
+            the timeframe of the download.
+        end_time -- A datetime object representing the end of the
+            timeframe of the download.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+
+        # Maps each recorded window to the offset of its response
+        # in the file.
+        self.offsets = {}
+
+        header = json.dumps(self._header(api_key, start_time, end_time)).encode() + b'\n'
+        size = 0
+
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                if f.readline() == header:
+                    size = len(header)
+
+                    for line in f:
+                        # Stop at a line that was cut off
+                        # while it was being written.
+                        if not line.endswith(b'\n'):
+                            break
+
+                        window_start, window_end, _ = line.split(b'\t', 2)
+                        key = (window_start.decode(), window_end.decode())
+                        self.offsets[key] = size + len(window_start) + len(window_end) + 2
+                        size += len(line)
+
+        if size:
+            # Drop anything after the last complete line.
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+        else:
+            with open(path, 'wb') as f:
+                f.write(header)
+
+    @staticmethod
+    def _header(api_key, start_time, end_time):
+        """Return the header identifying the download of a journal."""
+        return {
+            'api_key': hashlib.sha256(api_key.encode()).hexdigest(),
+            'start_time': start_time.isoformat(' '),
+            'end_time': end_time.isoformat(' ')
+        }
+
+    @classmethod
+    def recorded_end_time(cls, path, api_key, start_time):
+        """Return the end of the timeframe a journal was recorded for.
+
+        A download can only be resumed from the journal if it's started
+        again with this end time.  Returns None if there is no journal
+        or it was recorded for a different API key or start time.
+
+        Arguments:
+        path -- The name of the journal file.
+        api_key -- The API key of the download.
+        start_time -- A datetime object representing the beginning of
+            the timeframe of the download.
+        """
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline().decode())
+        except (OSError, ValueError):
+            return None
+
+        expected = cls._header(api_key, start_time, start_time)
+
+        if (not isinstance(header, dict) or 'end_time' not in header
+                or any(header.get(key) != expected[key] for key in ('api_key', 'start_time'))):
+            return None
+
+        try:
+            return com.make_datetime(header['end_time'])
+        except (TypeError, ValueError):
+            return None
+
+    def __len__(self):
+        """Return the number of recorded responses."""
+        return len(self.offsets)
+
+    def get(self, start_time, end_time):
+        """Return the recorded response for a window, or None."""
+        offset = self.offsets.get((start_time.isoformat(' '), end_time.isoformat(' ')))
+
+        if offset is None:
+            return None
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline().decode(), object_pairs_hook=collections.OrderedDict)
+
+    def record(self, start_time, end_time, js):
+        """Append the response for a window to the journal."""
+        prefix = '{}\t{}\t'.format(start_time.isoformat(' '), end_time.isoformat(' ')).encode()
+        line = prefix + json.dumps(js).encode() + b'\n'
+
+        with self.lock:
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                f.write(line)
+
+            key = (start_time.isoformat(' '), end_time.isoformat(' '))
+            self.offsets[key] = offset + len(prefix)
+
+    def remove(self):
+        """Delete the journal once it's no longer needed."""
+        os.remove(self.path)
+
+
+class ResponseCache:
+    """Keep responses from the API on disk to avoid requesting them again.
+
+    Each response is stored gzip-compressed in its own file, named after
+    a hash of the API key and the window of time it was requested for,
+    so the same request made again (by a later run, for example) can be
+    answered without contacting the server.  The combined size of the
+    files is kept track of as responses are added, and once it passes
+    max_size bytes, the least recently used files are removed until the
+    rest fit in low_water of it, so that the files aren't gone through
+    again for every response that is added.
+    A response older than ttl seconds is requested again.  Responses to
+    windows ending less than recent_span ago aren't cached at all, since
+    traps may still be uploading captures for them.  In replay only
+    mode, every request must be answered from the cache (however old the
+    response), which allows reprocessing data offline.
+
+    Public methods:
+        get
+        put
+        evict
+    """
+
+    # How long after the end of a window its response can be cached.
+    recent_span = dt.timedelta(hours=24)
+
+    # The fraction of max_size to remove files down to.
+    low_water = 0.9
+
+    def __init__(self, directory, max_size=2**30, ttl=None, replay_only=False):
+        """Initialize the instance, creating the directory if needed.
+
+        directory -- The name of the directory to keep the files in.
+        max_size -- The maximum combined size of the files in bytes,
+            or None for no limit.
+        ttl -- The number of seconds a response stays usable, or None
+            for no limit.
+        replay_only -- Pass True to raise an error for any response
+            that isn't in the cache instead of letting it be requested.
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.replay_only = replay_only
+        self.lock = threading.Lock()
+
+        # The combined size of the files, found when the first response
+        # is added.
+        self.size = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, api_key, start_time, end_time):
+        """Return the name of the file for a request."""
+        key = json.dumps([hashlib.sha256(api_key.encode()).hexdigest(),
+                          start_time.isoformat(' '), end_time.isoformat(' ')])
+
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest() + '.json.gz')
+
+    def get(self, api_key, start_time, end_time):
+        """Return the cached response to a request, or None."""
+        path = self.path(api_key, start_time, end_time)
+        js = None
+
+        # The first line holds the time the response was received,
+        # so an expired response isn't decompressed any further.
+        try:
+            with gzip.open(path, 'rt') as f:
+                header = json.loads(f.readline())
+
+                if (self.replay_only or self.ttl is None
+                        or time.time() - header['time'] < self.ttl):
+                    js = json.loads(f.readline(), object_pairs_hook=collections.OrderedDict)
+
+        # Treat a missing or damaged file as a miss.
+        except (OSError, EOFError, ValueError):
+            pass
+
+        if js is not None:
+            # Mark the response as recently used.
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+
+        elif self.replay_only:
+            raise ValueError('No cached response for request from {} to {}.'
+                             .format(start_time, end_time))
+
+        return js
+
+    def put(self, api_key, start_time, end_time, js):
+        """Add the response to a request to the cache, unless its window
+        ended less than recent_span ago.
+        """
+        if end_time > dt.datetime.now() - self.recent_span:
+            return
+
+        path = self.path(api_key, start_time, end_time)
+        header = json.dumps({'time': time.time()})
+
+        # Write to a temporary file first so that a file is never read
+        # while it's incomplete.
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+
+        try:
+            with open(fd, 'wb') as raw_f, gzip.GzipFile(fileobj=raw_f, mode='wb',
+                                                        compresslevel=6) as f:
+                f.write((header + '\n' + json.dumps(js) + '\n').encode())
+
+            size = os.path.getsize(temp_path)
+
+            with self.lock:
+                try:
+                    replaced_size = os.path.getsize(path)
+                except OSError:
+                    replaced_size = 0
+
+                os.replace(temp_path, path)
+
+                if self.size is not None:
+                    self.size += size - replaced_size
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        if self.max_size is not None and (self.size is None or self.size > self.max_size):
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used files if they take up more
+        than max_size, until they take up no more than low_water of it.
+
+        Goes through all of the files, so the combined size is also
+        brought up to date with any changes made by other processes.
+        """
+        with self.lock:
+            entries = []
+            total_size = 0
+
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.json.gz'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_size += stat.st_size
+
+            if total_size > self.max_size:
+                for mtime, size, path in sorted(entries):
+                    if total_size <= self.max_size * self.low_water:
+                        break
+
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+                    total_size -= size
+
+            self.size = total_size
 
 
 class Pad:
@@ -555,51 +1741,141 @@ class Pad:
     behaves well even if it's larger than the screen size, including
     providing basic scrolling functionality.
 
+    Drawing on the pad doesn't touch curses at all.  Instead, the
+    drawing calls are queued, and a render thread applies them at most
+    fps times per second, marking the rows they draw on as dirty, and
+    repaints the screen only when a row that's shown has changed or the
+    pad was scrolled.  Only the changed rows are sent to the terminal.
+    This way, drawing never waits for the terminal, however often the
+    caller draws.  Since curses isn't thread safe, all other curses
+    calls go through the same lock as the render thread, after applying
+    the queued drawing calls.
+
     Public methods:
         resize
         check_input
         scroll
-        refresh
+        close
     """
 
-    def __init__(self, stdscr, nlines, ncols):
-        """Initialize the instance and create the main pad object."""
+    # The methods of the pad that draw on it, mapped to the number of
+    # arguments they take when they're given coordinates.
+    drawing_methods = {'addch': 3, 'addstr': 3, 'hline': 4, 'vline': 4}
+
+    def __init__(self, stdscr, nlines, ncols, fps=10):
+        """Initialize the instance, create the main pad object and start
+        the render thread.
+
+        stdscr -- The curses screen object to show the pad on.
+        nlines -- The number of lines of the pad.
+        ncols -- The number of columns of the pad.
+        fps -- The maximum number of times to repaint the screen per
+            second.
+        """
         self.stdscr = stdscr
         self.pad = curses.newpad(nlines, ncols)
         self.scr_height, self.scr_width = stdscr.getmaxyx()
         self.top_shown = self.max_top_shown = 0
 
+        self.lock = threading.RLock()
+
+        # The drawing calls that haven't been applied yet, as (method,
+        # args) tuples.
+        self.queue = collections.deque()
+
+        # The rows drawn on since the last frame, and the top row that
+        # was shown in it.
+        self.dirty = set()
+        self.painted_top = None
+
+        self.interval = 1 / fps
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._render, daemon=True)
+        self.thread.start()
+
     def __getattr__(self, item):
         """Implement encapsulation.
 
         This method implements the encapsulation of the curses window
         object by routing all undefined attributes to the internal pad.
+        Calls to the drawing methods are queued for the render thread,
+        and other methods are called while holding the lock, once the
+        queued drawing calls have been applied.
 
         item -- The attribute that was called.
         """
-        return getattr(self.pad, item)
+        if item in self.drawing_methods:
+            def queued_method(*args):
+                self.queue.append((item, args))
+
+            return queued_method
+
+        attr = getattr(self.pad, item)
+
+        if not callable(attr):
+            return attr
+
+        def locked_method(*args):
+            with self.lock:
+                self._apply()
+                return attr(*args)
+
+        return locked_method
+
+    def _apply(self):
+        """Apply the queued drawing calls to the pad."""
+        with self.lock:
+            while self.queue:
+                method, args = self.queue.popleft()
+                self._mark_dirty(method, args)
+
+                try:
+                    getattr(self.pad, method)(*args)
+                except curses.error:
+                    # Drawing past the edge of the pad only
+                    # draws what fits.
+                    pass
+
+    def _mark_dirty(self, method, args):
+        """Mark the rows that a call to a drawing method draws on."""
+        # The coordinates are optional and default to the cursor.
+        if len(args) >= self.drawing_methods[method]:
+            y = args[0]
+            args = args[2:]
+        else:
+            y = self.pad.getyx()[0]
+
+        if method == 'vline':
+            self.dirty.update(range(y, y + args[1]))
+        else:
+            self.dirty.add(y)
 
     def resize(self, nlines, ncols):
         """Resize the pad."""
-        self.pad.resize(nlines, ncols)
-        self.max_top_shown = nlines - self.scr_height
+        with self.lock:
+            self._apply()
+            self.pad.resize(nlines, ncols)
+            self.max_top_shown = nlines - self.scr_height
+            self.painted_top = None
 
     def check_input(self):
         """Read keyboard input and perform the appropriate action."""
         pages = 0
-        code = self.stdscr.getch()
-
-        # Find the cumulative result of the key presses.
-        while code >= 0:
-            if code == curses.KEY_UP:
-                pages -= 1
-            elif code == curses.KEY_DOWN:
-                pages += 1
 
+        with self.lock:
             code = self.stdscr.getch()
 
-        if pages != 0:
-            self.scroll(pages)
+            # Find the cumulative result of the key presses.
+            while code >= 0:
+                if code == curses.KEY_UP:
+                    pages -= 1
+                elif code == curses.KEY_DOWN:
+                    pages += 1
+
+                code = self.stdscr.getch()
+
+            if pages != 0:
+                self.scroll(pages)
 
     def scroll(self, num_pages):
         """Scroll the pad some number of pages.
@@ -607,19 +1883,420 @@ class Pad:
         Note that a positive num_pages scrolls down while a negative
         scrolls up.
         """
-        self.top_shown = self.top_shown + num_pages*self.scr_height
+        with self.lock:
+            self.top_shown = self.top_shown + num_pages*self.scr_height
+
+            self.top_shown = max(self.top_shown, 0)
+            self.top_shown = min(self.top_shown, self.max_top_shown)
+
+    def _render(self):
+        """Check for input and repaint the screen on every frame.
+
+        Runs in the render thread until the pad is closed or curses
+        is shut down.
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.lock:
+                    if curses.isendwin():
+                        break
+
+                    self.check_input()
+                    self._paint()
+            except curses.error:
+                break
+
+    def _paint(self):
+        """Apply the queued drawing calls and repaint the screen if
+        anything shown has changed.
+        """
+        with self.lock:
+            self._apply()
+            bottom = self.top_shown + self.scr_height
+
+            if self.top_shown != self.painted_top:
+                # Everything shown is different after scrolling.
+                self.pad.touchwin()
+            elif not any(self.top_shown <= y < bottom for y in self.dirty):
+                self.dirty.clear()
+                return
+
+            self.pad.noutrefresh(self.top_shown, 0, 0, 0, self.scr_height - 1, self.scr_width)
+            curses.doupdate()
+
+            self.painted_top = self.top_shown
+            self.dirty.clear()
+
+    def close(self):
+        """Show the last changes and stop rendering."""
+        self.stopped.set()
+        self.thread.join()
+
+        with self.lock:
+            if not curses.isendwin():
+                self._paint()
+
+
+class DownloadProgress:
+    """Keep track of the progress of one download for a Dashboard.
+
+    download_data and request_data report to an instance as the download
+    goes along, while the dashboard reads it from its render thread, so
+    all methods hold the instance's lock.  The request and byte rates
+    are averaged over the last rate_window seconds while the download
+    is running, and over the whole download once it has stopped.
+
+    Public methods:
+        start
+        set_status
+        set_progress
+        add_request
+        add_retry
+        finish
+        fail
+        rates
+        eta
+    """
+
+    # The number of seconds to average the rates over.
+    rate_window = 10
+
+    def __init__(self):
+        """Initialize the instance."""
+        self.lock = threading.Lock()
+        self.status = 'Waiting...'
+        self.fraction = 0
+        self.num_requests = 0
+        self.num_bytes = 0
+        self.retries = 0
+        self.finished = self.failed = False
+
+        # The monotonic times the download started and stopped.
+        self.started = self.stopped = None
+
+        # The (time, bytes) pairs of the requests within the window.
+        self.recent = collections.deque()
+
+    def start(self):
+        """Mark the download as started."""
+        with self.lock:
+            self.started = time.monotonic()
+
+    def set_status(self, message):
+        """Set the message describing what the download is doing."""
+        with self.lock:
+            self.status = message
+
+    def set_progress(self, fraction):
+        """Set the fraction of the timeframe that has been downloaded."""
+        with self.lock:
+            self.fraction = fraction
+
+    def add_request(self, num_bytes):
+        """Count a finished request that received num_bytes bytes."""
+        with self.lock:
+            self.num_requests += 1
+            self.num_bytes += num_bytes
+            self.recent.append((time.monotonic(), num_bytes))
+
+    def add_retry(self):
+        """Count a request that is being retried."""
+        with self.lock:
+            self.retries += 1
+
+    def finish(self, message='Finished.'):
+        """Mark the download as complete."""
+        with self.lock:
+            self.status = message
+            self.fraction = 1
+            self.finished = True
+            self.stopped = time.monotonic()
+
+    def fail(self, error):
+        """Mark the download as stopped by an exception."""
+        with self.lock:
+            self.status = 'Error: {}'.format(error)
+            self.failed = True
+            self.stopped = time.monotonic()
+
+    def rates(self):
+        """Return the numbers of requests and bytes per second."""
+        with self.lock:
+            if self.started is None:
+                return 0, 0
+
+            if self.stopped is not None:
+                elapsed = self.stopped - self.started
+
+                if elapsed <= 0:
+                    return 0, 0
+
+                return self.num_requests / elapsed, self.num_bytes / elapsed
+
+            now = time.monotonic()
+
+            while self.recent and self.recent[0][0] < now - self.rate_window:
+                self.recent.popleft()
+
+            elapsed = min(now - self.started, self.rate_window)
+
+            if elapsed <= 0:
+                return 0, 0
+
+            return (len(self.recent) / elapsed,
+                    sum(num_bytes for _, num_bytes in self.recent) / elapsed)
+
+    def eta(self):
+        """Return the estimated number of seconds left, or None.
+
+        The estimate assumes the rest of the timeframe takes as long per
+        unit of time as the part downloaded so far.
+        """
+        with self.lock:
+            if self.started is None or self.stopped is not None or self.fraction <= 0:
+                return None
+
+            elapsed = time.monotonic() - self.started
+
+            return elapsed * (1-self.fraction) / self.fraction
+
+
+class Dashboard(Pad):
+    """Show the progress of several concurrent downloads on one screen.
+
+    Each download that is tracked gets a row with a progress bar over
+    its timeframe, its rates of requests and bytes received, its number
+    of retries, and an estimate of the time it has left, with its latest
+    status message on the line below.  A line at the top sums the rates
+    of all downloads.  The rows are worked out from the downloads'
+    DownloadProgress objects on every frame, and only the rows that
+    changed are redrawn.  Comparing the rates of the downloads shows
+    where throughput is being lost.  Being a Pad, the dashboard can be
+    scrolled if the rows don't fit on the screen.
+
+    Public methods:
+        track
+    """
+
+    # The width of the columns after the progress bar.
+    row_format = '{:<12} {} {:>5} {:>7} {:>10} {:>7} {:>9}'
+
+    # The row of the first download and the number of rows each
+    # download takes up.
+    first_y = 5
+    row_height = 3
+
+    def __init__(self, stdscr, fps=4):
+        """Initialize the instance and draw the column headers.
+
+        stdscr -- The curses screen object to show the dashboard on.
+        fps -- The maximum number of times to redraw the dashboard per
+            second.
+        """
+        max_y, max_x = stdscr.getmaxyx()
+
+        if max_x < 80:
+            raise ValueError('Window is too narrow. Please widen to at least 80 columns.')
+
+        curses.curs_set(False)
+        stdscr.nodelay(True)
+        curses.init_pair(1, curses.COLOR_BLACK, curses.COLOR_WHITE)
+        curses.init_pair(2, curses.COLOR_BLACK, curses.COLOR_GREEN)
+
+        # Set before the render thread starts.
+        self.width = max_x - 3
+        self.bar_width = self.width - len(self.row_format.format('', '', '', '', '', '', '')) - 2
+        self.downloads = []
+
+        # Keys will be the rows of the downloads and the title and
+        # values will be what was last drawn on them.
+        self.drawn = {}
+
+        super().__init__(stdscr, max_y, max_x, fps)
+
+        self.addstr(3, 2, self.row_format.format('Provider', 'Progress'.ljust(self.bar_width + 2),
+                                                 'Done', 'Req/s', 'Bytes/s', 'Retries', 'ETA'))
+
+    def track(self, name):
+        """Add a row for a download and return its DownloadProgress."""
+        progress = DownloadProgress()
+
+        with self.lock:
+            self.downloads.append((name, progress))
+            nlines = self.first_y + self.row_height*len(self.downloads)
+
+            if nlines > self.getmaxyx()[0]:
+                self.resize(nlines, self.getmaxyx()[1])
+
+        return progress
+
+    def _paint(self):
+        """Redraw the downloads and repaint the screen."""
+        with self.lock:
+            self._draw()
+            super()._paint()
+
+    def _draw(self):
+        """Draw the current progress of every download whose row has
+        changed.
+        """
+        total_requests = total_bytes = 0
+        num_finished = 0
+
+        for i, (name, progress) in enumerate(self.downloads):
+            y = self.first_y + self.row_height*i
+            request_rate, byte_rate = progress.rates()
+            total_requests += request_rate
+            total_bytes += byte_rate
+
+            if progress.failed:
+                eta = 'Failed'
+            elif progress.finished:
+                eta = 'Done'
+                num_finished += 1
+            else:
+                seconds = progress.eta()
+                eta = format_duration(seconds) if seconds is not None else '?'
+
+            line = self.row_format.format(
+                name[:12], '[' + '-'*self.bar_width + ']',
+                '{}%'.format(math.floor(progress.fraction * 100)), '{:.1f}'.format(request_rate),
+                format_size(byte_rate) + '/s', progress.retries, eta)
+            filled = math.floor(progress.fraction * self.bar_width)
+            status = progress.status[:self.width - 2].ljust(self.width - 2)
+            row = (line, filled, progress.finished, status)
+
+            if self.drawn.get(y) == row:
+                continue
+
+            self.drawn[y] = row
+            self.addstr(y, 2, line)
+
+            # Fill in the part of the bar that has been downloaded.
+            if filled:
+                self.hline(y, 16, ' ', filled, curses.color_pair(2 if progress.finished else 1))
+
+            self.addstr(y + 1, 4, status)
+
+        title = '{} of {} download(s) finished. Total: {:.1f} req/s, {}/s'.format(
+            num_finished, len(self.downloads), total_requests, format_size(total_bytes))
+        title = title[:self.width].ljust(self.width)
+
+        if self.drawn.get(1) != title:
+            self.drawn[1] = title
+            self.addstr(1, 2, title)
+
+
+class PrintedProgress(DownloadProgress):
+    """Print the progress of a download through a ProgressPrinter.
+
+    Works like a DownloadProgress, but also prints each status message,
+    each whole percent of the timeframe downloaded, and how the download
+    ended, prefixed with the name of the download.
+    """
+
+    def __init__(self, printer, name):
+        """Initialize the instance.
+
+        printer -- The ProgressPrinter to print through.
+        name -- The name of the download.
+        """
+        super().__init__()
+        self.printer = printer
+        self.name = name
+
+        # The last percentage that was printed.
+        self.percentage = None
 
-        self.top_shown = max(self.top_shown, 0)
-        self.top_shown = min(self.top_shown, self.max_top_shown)
+    def set_status(self, message):
+        """Set and print the message describing what the download is
+        doing.
+        """
+        super().set_status(message)
+        self.printer.write(self.name, message)
+
+    def set_progress(self, fraction):
+        """Set the fraction of the timeframe that has been downloaded and
+        print it if it reached another percent.
+        """
+        super().set_progress(fraction)
+        percentage = math.floor(fraction * 100)
+
+        if percentage != self.percentage:
+            self.percentage = percentage
+            self.printer.write(self.name, '{}% complete.'.format(percentage))
+
+    def finish(self, message='Finished.'):
+        """Mark the download as complete and print message."""
+        super().finish(message)
+        self.printer.write(self.name, message)
+
+    def fail(self, error):
+        """Mark the download as stopped by an exception and print it."""
+        super().fail(error)
+        self.printer.write(self.name, self.status)
+
+
+class ProgressPrinter:
+    """Print the progress of several concurrent downloads.
+
+    This is the plain-text counterpart of a Dashboard.  Each download
+    that is tracked prints one line per change in its progress, prefixed
+    with its name.  While the printer is paused, such as while the user
+    is being asked a question, nothing is printed.  Only the latest line
+    of each download is kept in the meantime, and these are printed when
+    the printer resumes.
+
+    Public methods:
+        track
+        write
+        pause
+        resume
+    """
+
+    def __init__(self):
+        """Initialize the instance."""
+        self.lock = threading.Lock()
+        self.paused = False
+
+        # The latest line of each download held back while paused.
+        self.held = collections.OrderedDict()
+
+    def track(self, name):
+        """Return a PrintedProgress for a download."""
+        return PrintedProgress(self, name)
+
+    def write(self, name, message):
+        """Print a message about a download, unless paused."""
+        line = '{}: {}'.format(name, message)
+
+        with self.lock:
+            if self.paused:
+                self.held.pop(name, None)
+                self.held[name] = line
+            else:
+                print(line, flush=True)
+
+    def pause(self):
+        """Hold back the messages until resume is called."""
+        with self.lock:
+            self.paused = True
+
+    def resume(self):
+        """Print the latest held message of each download and carry on
+        printing.
+        """
+        with self.lock:
+            for line in self.held.values():
+                print(line, flush=True)
 
-    def refresh(self):
-        """Refresh the pad after checking for input."""
-        self.check_input()
-        self.pad.refresh(self.top_shown, 0, 0, 0, self.scr_height - 1, self.scr_width)
+            self.held.clear()
+            self.paused = False
 
 
 if __name__ == '__main__':
     args = vars(parse_args())
+    com.configure_metrics(args.pop('metrics'), args.pop('profile'))
 
     display = args['display']
     del args['display']
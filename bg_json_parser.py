@@ -7,20 +7,48 @@ files.  The script can also automatically generate project files
 necessary for the full BG-Counter Tools pipeline, splitting data into
 years along the way, using the --split-years option.
 
+With --split-years, a checkpoint is kept in the database for each
+trap, recording the last complete day of captures that has been
+processed, so days that were processed in a previous run are skipped if
+the same data is parsed again.  Each trap's checkpoint is recorded along
+with the ordinals of the collections written for it as soon as they're
+saved to disk, so a run that dies partway through can be repeated: the
+project files it left are resumed, keeping only the collections that
+were recorded, and the traps it finished are skipped.  A day is only
+processed once the data covers it up to midnight, which is known for
+the days before --end-time, or if it isn't given, for the days before
+each trap's last one.  Checkpoints are ignored when the metadata is
+preserved or --no-checkpoints is given.  Databases created before
+checkpoints were added need update_database.sql run on them.
+
 For usage information, run with -h.
 
 This script requires at least Python 3.5.
 """
 
 import argparse
+import concurrent.futures
 import csv
-import json
+import glob
 import math
+import multiprocessing
 import os
+import pickle
 import random
+import sys
+import tempfile
 import datetime as dt
+from array import array
+from collections import deque
 from string import Template
 
+import psycopg2.extras as pg2_extras
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import bg_common as com
 
 
@@ -30,12 +58,28 @@ def parse_args():
                                                  ' API and creates an interchange format file '
                                                  'from the data.')
 
-    parser.add_argument('files', nargs='+', metavar='file', help='The JSON file(s) to parse.')
+    parser.add_argument('files', nargs='+', metavar='file',
+                        help='The JSON file(s) or capture store(s) to parse.')
     parser.add_argument('--preserve-metadata', action='store_true',
                         help="Don't change the metadata in the database in any way")
+    parser.add_argument('--no-checkpoints', dest='checkpoints', action='store_false',
+                        help='With --split-years, process all captures, including days that '
+                             'were processed in an earlier run.')
+    parser.add_argument('-e', '--end-time', type=com.parse_date,
+                        help='The end of the timeframe the data was downloaded over. With '
+                             '--split-years, only the days that end by then are processed. '
+                             "Default: all but each trap's last day")
     parser.add_argument('-c', '--check-locations', action='store_true',
                         help='Before writing to file, pause to allow the user to check for any '
                              'errant new locations.')
+    parser.add_argument('--seed',
+                        help='The seed to derive the random offsets of obfuscated locations '
+                             'from. Runs with the same seed and data give the same offsets, so '
+                             'keep it secret. Default: a new random seed')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help="The number of processes to process traps' captures with. "
+                             'Default: 1')
+    com.add_metrics_arguments(parser)
 
     output_group = parser.add_mutually_exclusive_group()
     output_group.add_argument('-o', '--output', help='The name of the output file.')
@@ -48,12 +92,15 @@ def parse_args():
     return args
 
 
+@com.stage('parse_json')
 def parse_json(files, output='interchange.pop', split_years=False, preserve_metadata=False,
-               check_locations=False):
+               check_locations=False, processes=1, seed=None, checkpoints=True, end_time=None,
+               metadata_updater=None):
     """Parse JSON files and create interchange format files from them.
 
     Required arguments:
-    files -- A list of filenames to parse.
+    files -- A list of filenames to parse.  Each may be a JSON file or
+        a capture store written by download_data.
 
     Optional arguments:
     output -- The name of the output file.  Ignored if split_years is
@@ -67,60 +114,155 @@ def parse_json(files, output='interchange.pop', split_years=False, preserve_meta
         operations.
     check_locations -- A boolean signalling whether to pause before
         writing to file for the use to check for any errant locations.
+    processes -- The number of processes to process traps' captures
+        with.  The collections are still written in the same order,
+        so the output doesn't depend on this.
+    seed -- The seed to derive the random offsets of obfuscated
+        locations from.  Each location gets its own random stream based
+        on this seed, its trap and its coordinates, so the offsets
+        don't depend on the order traps are processed in.  Defaults to
+        a new random seed.
+    checkpoints -- A boolean signalling whether to skip the days up to
+        each trap's checkpoint, record each trap's progress as soon as
+        its collections are written and resume the project files of
+        a run that didn't finish.  Only used if split_years is True,
+        since each run then writes its own project files, while
+        a single output file is overwritten with all of the data.
+        Ignored if preserve_metadata is True, as the checkpoints of
+        a run that doesn't record them can't be relied on.
+    end_time -- A datetime object representing the end of the timeframe
+        that the data was downloaded over.  When checkpoints are used,
+        only the days that end by then are processed, so that a day is
+        never split between runs.  If None, each trap's last day is
+        left for a later run.
+    metadata_updater -- A function to call instead of recording the
+        metadata with update_metadata, or finish_metadata when each
+        trap's progress was recorded as it was written.  It's called
+        with that function and the metadata as the 'update' and
+        'metadata' keyword arguments once all files have been written,
+        such as to make other changes in the same transaction.
     """
-    random.seed()
+    checkpoints = checkpoints and split_years and not preserve_metadata
+
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+
     metadata = {}
     out_csv = None
     projects = None
 
+    # Maps each trap ID with known metadata to its provider's prefix.
+    trap_index = {}
+
+    executor = None
+
     try:
+        if processes > 1:
+            # Forking while other threads are running (such as the
+            # downloads in bg_run_pipeline) can deadlock the workers and
+            # hands them copies of the pooled database connections, so
+            # start them from a fresh process instead.  Executors only
+            # take a start method as of Python 3.7.
+            if sys.version_info >= (3, 7):
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                else:
+                    context = multiprocessing.get_context('spawn')
+
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                                  mp_context=context)
+            else:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+
         if split_years:
             out_csv = {}
         else:
             out_csv = CSVWriter(output)
 
+        # Get metadata for all traps in all files up front in
+        # a single batch.  Only the trap objects are read here.
+        trap_ids = list(dict.fromkeys(trap_id for filename in files
+                                      for trap_id in com.iter_trap_ids(filename)))
+
+        if trap_ids:
+            merge_metadata(metadata, get_trapsets_metadata(trap_ids=trap_ids), trap_index)
+
+        # Pick up the project files of the providers that a run which
+        # didn't finish left behind, even if no trap writes to them
+        # again, so that they're still closed and returned.
+        if checkpoints:
+            for prefix in metadata:
+                out_csv[prefix] = {year: ProjectFileManager(prefix, year, resume=True)
+                                   for year in ProjectFileManager.unfinished_years(prefix)}
+
         for filename in files:
-            with open(filename, 'r') as json_f:
-                js = json.load(json_f)
-                collections = {}
-                capture_count = {}
-
-                print("Processing file " + filename)
-
-                for trap_wrapper in js['traps']:
-                    trap_id = trap_wrapper['Trap']['id']
-                    captures = trap_wrapper['Capture']
-                    capture_count[trap_id] = len(captures)
-
-                    if len(captures) != 0:
-                        # Get metadata for this trap
-                        for prefix, trapset in metadata.items():
-                            if trap_id in trapset['traps']:
-                                curr_prefix = prefix
-                                curr_trapset = trapset
-                                break
-                        else:
-                            new_metadata = get_trap_metadata(trap_id=trap_id)
-                            metadata.update(new_metadata)
-                            curr_prefix = list(new_metadata.keys())[0]
-                            curr_trapset = new_metadata[curr_prefix]
-                            collections[curr_prefix] = {}
+            print("Processing file " + filename)
 
-                        trap_metadata = {
-                            'locations': curr_trapset['traps'][trap_id],
-                            'obfuscate': curr_trapset['obfuscate']
-                        }
+            # Read the traps one at a time so that only a few traps'
+            # captures are held in memory.
+            if os.path.isdir(filename):
+                trap_wrappers = iter_store_traps(filename)
+            else:
+                trap_wrappers = com.iter_traps(filename)
+
+            traps = process_traps(trap_wrappers, metadata, trap_index, seed, executor,
+                                  max_pending=2 * processes, checkpoints=checkpoints,
+                                  end_time=end_time)
+
+            # If the new locations are to be checked, the traps'
+            # collections can only be written once all of them have
+            # been made, so they're held in a temporary file until then.
+            held = tempfile.TemporaryFile() if check_locations else None
 
-                        # Process captures.
-                        new_collections = process_captures(captures, trap_metadata)
+            # The new locations of the collections, with the trap each
+            # was found at, and the locations recorded before.
+            new_locations = []
+            known_locations = set()
 
-                        if trap_id not in collections[curr_prefix]:
-                            collections[curr_prefix][trap_id] = []
+            try:
+                for trap_id, num_captures, results in traps:
+                    com.count('captures', num_captures)
 
-                        collections[curr_prefix][trap_id].extend(new_collections)
+                    if num_captures != 0:
+                        trap_collections, locations, checkpoint, skipped_days = results
+                        curr_prefix = trap_index[trap_id]
 
                         # Update master metadata.
-                        curr_trapset['traps'][trap_id] = trap_metadata['locations']
+                        metadata[curr_prefix]['traps'][trap_id] = locations
+
+                        # Only move up the checkpoint if it's in use, since
+                        # otherwise the trap's days aren't all written to
+                        # their own project files.  A trap with no complete
+                        # days has no checkpoint.
+                        if checkpoints and checkpoint is not None:
+                            metadata[curr_prefix]['checkpoints'][trap_id] = checkpoint
+
+                        if skipped_days:
+                            print('Notice: Skipped {} day(s) processed in an earlier run at '
+                                  'trap_id: {} - use --no-checkpoints to process them again'
+                                  .format(skipped_days, trap_id))
+
+                        if check_locations:
+                            for collection in trap_collections:
+                                location = (collection['true_latitude'],
+                                            collection['true_longitude'])
+
+                                if collection['new']:
+                                    new_locations.append(
+                                        location + ('{}_{}'.format(curr_prefix, trap_id),))
+                                else:
+                                    known_locations.add(location)
+
+                            pickle.dump((trap_id, num_captures, trap_collections, checkpoint),
+                                        held)
+                        else:
+                            emitted = write_trap(trap_id, num_captures, trap_collections,
+                                                 metadata, trap_index, out_csv,
+                                                 resume=checkpoints)
+
+                            if checkpoints:
+                                commit_trap(trap_id, checkpoint, emitted, metadata, trap_index,
+                                            out_csv)
 
                     # Warn if a trap is showing no captures.
                     # We should reasonably expect data from each trap,
@@ -130,53 +272,40 @@ def parse_json(files, output='interchange.pop', split_years=False, preserve_meta
                         print('Warning: 0 captures at trap_id: ' + trap_id)
 
                 # Allow the user to manually check new locations if
-                # requested.
+                # requested, then write the held collections that have
+                # good locations.
                 if check_locations:
-                    collections = filter_locations(collections)
-
-                # Write collections to file.
-                for prefix, traps in collections.items():
-                    for trap_id, curr_collections in traps.items():
-                        good_captures = 0
-
-                        for collection in curr_collections:
-                            curr_metadata = {'prefix': prefix, 'ordinals': metadata[prefix]['ordinals']}
-                            date = com.make_date(collection['captures'][0]['timestamp_start'])
-                            year = date.year
-
-                            # Get the correct output file.
-                            if isinstance(out_csv, dict):
-                                # If the correct output file doesn't exist, make it.
-                                if prefix not in out_csv:
-                                    out_csv[prefix] = {}
-
-                                if year not in out_csv[prefix]:
-                                    out_csv[prefix][year] = ProjectFileManager(prefix, year)
-
-                                curr_csv = out_csv[prefix][year]
-
-                            else:
-                                curr_csv = out_csv
-
-                            # If a collection was be made, write it to
-                            # file and count its captures as good.
-                            if write_collection(collection, curr_metadata, curr_csv):
-                                good_captures += len(collection['captures'])
-                                metadata[prefix]['ordinals'] = curr_metadata['ordinals']
-
-                                # If the CSV is for a project, update
-                                # the project's dates.
-                                if isinstance(curr_csv, ProjectFileManager):
-                                    curr_csv.update_dates(date)
-
-                        # Print a summary.
-                        print('Trap {}: Total captures: {} - Good captures: {} ({}%)'
-                              .format(trap_id, capture_count[trap_id], good_captures,
-                                      math.floor((good_captures / capture_count[trap_id]) * 100)))
+                    good_locations = filter_locations(new_locations, known_locations)
+                    held.seek(0)
+
+                    while True:
+                        try:
+                            trap_id, num_captures, trap_collections, checkpoint = pickle.load(held)
+                        except EOFError:
+                            break
+
+                        if good_locations is not None:
+                            trap_collections = [
+                                collection for collection in trap_collections
+                                if (collection['true_latitude'],
+                                    collection['true_longitude']) in good_locations]
+
+                        emitted = write_trap(trap_id, num_captures, trap_collections, metadata,
+                                             trap_index, out_csv, resume=checkpoints)
+
+                        if checkpoints:
+                            commit_trap(trap_id, checkpoint, emitted, metadata, trap_index,
+                                        out_csv)
+            finally:
+                if held is not None:
+                    held.close()
 
     finally:
+        if executor:
+            executor.shutdown()
+
         # Close all output files.
-        if out_csv:
+        if out_csv is not None:
             if type(out_csv) is dict:
                 projects = []
 
@@ -192,114 +321,417 @@ def parse_json(files, output='interchange.pop', split_years=False, preserve_meta
                 out_csv.close()
 
     if not preserve_metadata:
-        update_metadata(metadata=metadata)
+        # When each trap was recorded as it was written, all that's
+        # left is to mark the run as finished.
+        update = finish_metadata if checkpoints else update_metadata
+
+        if metadata_updater:
+            metadata_updater(update=update, metadata=metadata)
+        else:
+            update(metadata=metadata)
+
+    # Only once the run is recorded as finished can the next one start
+    # its project files over.
+    if checkpoints:
+        for years in out_csv.values():
+            for csv_writer in years.values():
+                csv_writer.finish()
 
     return projects
 
 
-def process_captures(captures, metadata):
-    """Bin captures into days.
+def process_traps(trap_wrappers, metadata, trap_index, seed, executor=None, max_pending=0,
+                  checkpoints=True, end_time=None):
+    """Process the captures of each trap, in parallel if requested.
+
+    Yields a (trap_id, num_captures, results) tuple for each trap in
+    the order they were given, where results is the (collections,
+    locations, checkpoint, skipped_days) tuple returned by process_trap,
+    or None if the trap has no captures.
+
+    Arguments:
+    trap_wrappers -- An iterable of trap objects, each holding a trap
+        and its captures.
+    metadata -- The master metadata dict.
+    trap_index -- A dict mapping trap IDs to prefixes.
+    seed -- The seed of the run, used to derive the random streams for
+        obfuscating each trap's locations.
+    executor -- A concurrent.futures.Executor to process traps on.  If
+        None, traps are processed one at a time.
+    max_pending -- The maximum number of traps to process ahead on the
+        executor while earlier results are being consumed.
+    checkpoints -- Whether to pass on the traps' checkpoints, so that
+        the days up to them are skipped, and only process complete days.
+    end_time -- The end of the timeframe the data was downloaded over,
+        or None if it isn't known.  See process_captures.
+    """
+    # Traps that are being processed, as (trap_id, num_captures,
+    # future) tuples, in order.
+    pending = deque()
+
+    for trap_wrapper in trap_wrappers:
+        trap_id = trap_wrapper['Trap']['id']
+        captures = trap_wrapper['Capture']
+
+        # A trap's locations depend on its earlier captures, so if it
+        # shows up again, wait for it to be processed first.
+        while pending and (len(pending) >= max_pending
+                           or any(pending_id == trap_id for pending_id, _, _ in pending)):
+            pending_id, num_captures, future = pending.popleft()
+            yield pending_id, num_captures, future.result() if future else None
+
+        future = None
+
+        if len(captures) != 0:
+            # Get metadata for this trap
+            if trap_id not in trap_index:
+                raise ValueError('No database entry for trap ID: ' + trap_id)
+
+            curr_trapset = metadata[trap_index[trap_id]]
+            trap_metadata = {
+                'locations': curr_trapset['traps'][trap_id],
+                'obfuscate': curr_trapset['obfuscate'],
+                'seed': '{}:{}'.format(seed, trap_id),
+                'checkpoints': checkpoints,
+                'checkpoint': curr_trapset['checkpoints'].get(trap_id) if checkpoints else None,
+                'end_time': end_time
+            }
+
+            if not executor:
+                yield trap_id, len(captures), process_trap(captures, trap_metadata)
+                continue
+
+            future = executor.submit(process_trap, captures, trap_metadata)
+
+        elif not pending:
+            yield trap_id, 0, None
+            continue
+
+        pending.append((trap_id, len(captures), future))
+
+    while pending:
+        pending_id, num_captures, future = pending.popleft()
+        yield pending_id, num_captures, future.result() if future else None
+
+
+def write_trap(trap_id, num_captures, collections, metadata, trap_index, out_csv,
+               resume=False):
+    """Write a trap's collections to file and print a summary.
+
+    Returns a list of (year, ordinal, date) tuples, one for each
+    collection that was written.
+
+    Arguments:
+    trap_id -- The ID of the trap.
+    num_captures -- The trap's total number of captures.
+    collections -- A list of the trap's collections in chronological
+        order.
+    metadata -- The master metadata dict.  The ordinals of the trap's
+        provider are updated for the collections that are written.
+    trap_index -- A dict mapping trap IDs to prefixes.
+    out_csv -- The CSVWriter to write to, or a dict mapping prefixes to
+        dicts mapping years to ProjectFileManagers, to which the
+        projects that don't exist yet are added.
+    resume -- Passed on to the ProjectFileManagers that are added.
+    """
+    prefix = trap_index[trap_id]
+    good_captures = 0
+    emitted = []
+
+    for collection in collections:
+        curr_metadata = {'prefix': prefix, 'ordinals': metadata[prefix]['ordinals']}
+        date = collection['date']
+        year = date.year
+
+        # Get the correct output file.
+        if isinstance(out_csv, dict):
+            # If the correct output file doesn't exist, make it.
+            if prefix not in out_csv:
+                out_csv[prefix] = {}
+
+            if year not in out_csv[prefix]:
+                out_csv[prefix][year] = ProjectFileManager(prefix, year, resume)
+
+            curr_csv = out_csv[prefix][year]
+
+        else:
+            curr_csv = out_csv
+
+        # If a collection was be made, write it to
+        # file and count its captures as good.
+        if write_collection(collection, curr_metadata, curr_csv):
+            good_captures += collection['num_captures']
+            metadata[prefix]['ordinals'] = curr_metadata['ordinals']
+            emitted.append((year, curr_metadata['ordinals'][year], date))
+
+            # If the CSV is for a project, update
+            # the project's dates.
+            if isinstance(curr_csv, ProjectFileManager):
+                curr_csv.update_dates(date)
+
+    # Print a summary.
+    print('Trap {}: Total captures: {} - Good captures: {} ({}%)'
+          .format(trap_id, num_captures, good_captures,
+                  math.floor((good_captures / num_captures) * 100)))
+
+    return emitted
+
+
+def commit_trap(trap_id, checkpoint, emitted, metadata, trap_index, out_csv):
+    """Record a trap's progress in the database.
+
+    Once a trap's collections have been written, saves the project files
+    that the trap wrote to onto disk, then records the trap's locations
+    and checkpoint, the ordinals of its provider and the ordinals of the
+    collections that were written in a transaction of their own.  If
+    a run dies partway through, the next one picks up after the last
+    trap recorded.  Each call is counted as one of the stage's
+    'commits' (see com.count).
+
+    Arguments:
+    trap_id -- The ID of the trap.
+    checkpoint -- The trap's new checkpoint, or None if it has none.
+    emitted -- The collections that were written, as returned by
+        write_trap.
+    metadata -- The master metadata dict.
+    trap_index -- A dict mapping trap IDs to prefixes.
+    out_csv -- A dict mapping prefixes to dicts mapping years to the
+        ProjectFileManagers that the collections were written to.
+    """
+    prefix = trap_index[trap_id]
+
+    for year in sorted({year for year, _, _ in emitted}):
+        out_csv[prefix][year].flush()
+
+    trapset = metadata[prefix]
+
+    record_metadata(metadata={prefix: {
+        'traps': {trap_id: trapset['traps'][trap_id]},
+        'ordinals': trapset['ordinals'],
+        'checkpoints': {trap_id: checkpoint},
+        'emitted': [(year, ordinal, trap_id, date) for year, ordinal, date in emitted]
+    }})
+
+    com.count('commits')
+
+
+def iter_store_traps(dirname):
+    """Yield the trap objects in a capture store one at a time.
+
+    Works like com.iter_traps, except that each trap's captures are
+    given as a CaptureColumns object sliced straight out of the store
+    instead of as a list.
+
+    dirname -- The name of the capture store's directory.
+    """
+    for trap, trap_id, ids, columns in com.iter_capture_store(dirname):
+        yield {'Trap': trap, 'Capture': CaptureColumns.from_store(trap_id, ids, columns)}
+
+
+def process_trap(captures, metadata):
+    """Process a trap's captures.
+
+    Returns a tuple of the collections created from the captures, the
+    trap's updated locations, its updated checkpoint and the number of
+    days that were skipped because of its old one.  Runs in a worker
+    process when parsing in parallel.
 
     Arguments:
-    captures -- A dict containing the captures to process.
+    captures -- A list containing the captures to process, or
+        a CaptureColumns object holding them.
     metadata -- A dict containing the metadata for the trap and provider
         that the captures originate from.
     """
-    # The total number of unique captures (some are duplicates).
-    total_captures = 0
+    collections = process_captures(captures, metadata)
+    return (collections, metadata['locations'], metadata.get('checkpoint'),
+            metadata.get('skipped_days', 0))
+
 
-    # The captures within a single day.
-    day_captures = []
+def process_captures(captures, metadata):
+    """Bin captures into days.
+
+    Days up to and including the trap's checkpoint, if it has one, were
+    processed in a previous run and are left out whole, and their number
+    is stored as 'skipped_days'.  If the metadata's 'checkpoints' flag
+    is set, days that the data might not cover up to midnight are left
+    out too, to be processed in full by a later run: the days from the
+    date of the metadata's 'end_time' on, or if that is None, from the
+    date of the last capture on.  The checkpoint is then moved up to the
+    last day that was processed.
 
+    Arguments:
+    captures -- A list containing the captures to process, or
+        a CaptureColumns object holding them.
+    metadata -- A dict containing the metadata for the trap and provider
+        that the captures originate from.
+    """
     # The collections created from this set of captures.
     collections = []
 
-    # Will hold the timestamp_end of the last capture.
-    prev_end_timestamp = dt.datetime.min
+    if isinstance(captures, CaptureColumns):
+        columns = captures
+    else:
+        columns = CaptureColumns(captures)
 
-    num_captures = len(captures)
+    checkpoint = last_day = metadata.get('checkpoint')
+    skipped_days = 0
 
-    for i in range(num_captures):
-        capture = captures[i]
+    # The first day that might not be complete.
+    complete_until = None
+
+    if metadata.get('checkpoints'):
+        if metadata.get('end_time') is not None:
+            complete_until = metadata['end_time'].date()
+        elif len(columns):
+            complete_until = columns.date(len(columns) - 1)
+
+    for boundary, indexes in find_days(columns):
+        day = columns.date(boundary)
+
+        # Our current assumption is that there are no more
+        # than 96 unique captures in a day (4 per hour).
+        # If this changes, we'll need to edit this script.
+        if len(indexes) > 96:
+            raise ValueError('More than 96 captures in a day at trap_id: {} - date: {}'
+                             .format(columns.trap_id, day))
+
+        # Leave out days that have already been processed.
+        if checkpoint is not None and day <= checkpoint:
+            skipped_days += 1
+            continue
+
+        # Leave the days that might be incomplete to a later run.
+        if complete_until is not None and day >= complete_until:
+            continue
+
+        last_day = day
+
+        if len(indexes) == 0:
+            continue
+
+        # Try to make a collection from this set of captures.
+        collection = make_collection(columns, indexes, metadata['locations'],
+                                     metadata['obfuscate'], metadata.get('seed'))
+
+        if collection:
+            # Only keep what's needed to write the collection
+            # rather than the captures themselves.
+            collection_indexes = collection.pop('captures')
+            collection['trap_id'] = columns.trap_id
+            collection['date'] = columns.date(collection_indexes[0])
+            collection.update(columns.summarize(collection_indexes))
+            collections.append(collection)
+
+    metadata['checkpoint'] = last_day
+    metadata['skipped_days'] = skipped_days
+
+    return collections
+
+
+def find_days(columns):
+    """Find the captures that make up each day.
+
+    Skips captures with an empty ending timestamp, captures that are
+    identical to the previous one and captures whose timeframe is much
+    less than 15 minutes.  Yields a tuple for each day containing the
+    index of the capture that ends the day and the indexes of the day's
+    remaining captures.  Raises a ValueError if the captures aren't in
+    forward chronological order.
+
+    columns -- A CaptureColumns object holding a trap's captures.
+    """
+    num_captures = len(columns)
+    start, end = columns.start, columns.end
+
+    # Captures need to span at least 12 minutes to be kept.
+    min_span = 12 * 60
+
+    if np is not None:
+        valid = ~np.isnan(end)
+        long_enough = valid & (end - start >= min_span)
+
+        # The latest ending timestamp among the captures that were kept
+        # before each capture.  Captures that are long enough but not
+        # kept are duplicates of the latest one, so they don't change it.
+        prev_end = np.empty(num_captures)
+        prev_end[:1] = -math.inf
+        np.maximum.accumulate(np.where(long_enough, end, -math.inf)[:-1], out=prev_end[1:])
+
+        kept = np.flatnonzero(long_enough & (end > prev_end))
+
+        # A day ends at a capture with a valid ending timestamp if
+        # it's the last capture or the next capture is from a different
+        # day.  Every kept capture belongs to the first day ending at
+        # or after it, and any after the last day are left out.
+        days = start // 86400
+        is_boundary = valid.copy()
+        is_boundary[:-1] &= days[1:] != days[:-1]
+        boundaries = np.flatnonzero(is_boundary)
+
+        # We rely on the captures being delivered in forward
+        # chronological order.  Days are still yielded up to the first
+        # capture that isn't, so errors are raised in the same order as
+        # when going through the captures one by one.
+        out_of_order = np.flatnonzero(valid & (end < prev_end))
+
+        if out_of_order.size:
+            boundaries = boundaries[boundaries < out_of_order[0]]
+
+        day_indexes = np.split(kept, np.searchsorted(kept, boundaries, side='right'))
+        yield from zip(boundaries.tolist(), day_indexes)
+
+        if out_of_order.size:
+            raise ValueError('Capture has earlier ending timestamp than preceding capture. '
+                             'Capture ID: ' + columns.ids[out_of_order[0]])
 
-        # We use this to do some sanity checking.
-        # The ending timestamp is more consistent than the starting one.
-        curr_end_timestamp = com.make_datetime(capture['timestamp_end'])
-        curr_start_timestamp = com.make_datetime(capture['timestamp_start'])
-        curr_date = curr_start_timestamp.date()
+        return
 
-        valid_dates = curr_end_timestamp and curr_start_timestamp
+    day_indexes = []
+    prev_end = -math.inf
 
-        # Count a capture if it's not a duplicate
-        # or it has invalid dates.
-        if not valid_dates or curr_end_timestamp != prev_end_timestamp:
-            total_captures += 1
+    for i in range(num_captures):
+        curr_end = end[i]
 
-        if valid_dates:
+        if not math.isnan(curr_end):
             # If this end timestamp is later than the previous one,
-            # store the capture.  We ignore the capture if it's
-            # identical to the previous one or if its timeframe is
-            # much less than 15 minutes.
-            if (curr_end_timestamp > prev_end_timestamp
-                    and curr_end_timestamp - curr_start_timestamp >= dt.timedelta(minutes=12)):
-                day_captures.append({
-                    'trap_id': capture['trap_id'],
-                    'timestamp_start': capture['timestamp_start'],
-                    'co2_status': capture['co2_status'],
-                    'counter_status': capture['counter_status'],
-                    'medium': capture['medium'],
-                    'trap_latitude': capture['trap_latitude'],
-                    'trap_longitude': capture['trap_longitude'],
-                })
-
-                prev_end_timestamp = curr_end_timestamp
+            # keep the capture.
+            if curr_end > prev_end and curr_end - start[i] >= min_span:
+                day_indexes.append(i)
+                prev_end = curr_end
 
             # Else if this timestamp is earlier than the previous one,
             # error out.  We rely on the captures being delivered in
             # forward chronological order.
-            elif curr_end_timestamp < prev_end_timestamp:
+            elif curr_end < prev_end:
                 raise ValueError('Capture has earlier ending timestamp than preceding capture. '
-                                 'Capture ID: ' + capture['id'])
+                                 'Capture ID: ' + columns.ids[i])
 
             # If we're at the last capture or the next capture is
             # from a different day, end this day.
-            if (i == num_captures - 1
-                    or com.make_date(captures[i + 1]['timestamp_start']) != curr_date):
-                trap_id = capture['trap_id']
-
-                # Our current assumption is that there are no more
-                # than 96 unique captures in a day (4 per hour).
-                # If this changes, we'll need to edit this script.
-                if len(day_captures) > 96:
-                    raise ValueError('More than 96 captures in a day at trap_id: {} - date: {}'
-                                     .format(trap_id, curr_date))
-
-                # Try to make a collection from this set of captures.
-                collection = make_collection(day_captures, metadata['locations'],
-                                             metadata['obfuscate'])
-
-                if collection:
-                    collections.append(collection)
-
-                day_captures = []
-
-    return collections
+            if i == num_captures - 1 or start[i + 1] // 86400 != start[i] // 86400:
+                yield i, day_indexes
+                day_indexes = []
 
 
-def make_collection(captures, locations, obfuscate):
+def make_collection(columns, indexes, locations, obfuscate, seed=None):
     """Bin captures into collections based on location.
 
     Takes a set of captures within the same day, bins them based on
     location, and returns the collection that is big enough, returning
-    None if there is none.  Adds new locations to the metadata dict if
-    there are any.
+    None if there is none.  The 'captures' key of the collection holds
+    the indexes of its captures.  Adds new locations to the metadata
+    dict if there are any.
 
     Arguments:
-    captures -- A dict containing the captures to process.
+    columns -- A CaptureColumns object holding a trap's captures.
+    indexes -- The indexes of the captures to process.
     locations -- A dict containing the locations that have been recorded
         previously for the trap that the captures came from.
     obfuscate -- A boolean determining whether to obfuscate the new
         locations before adding them to the metadata.
+    seed -- A seed unique to the trap and run, from which a random
+        stream is derived for each new location to obfuscate it with.
+        If None, the global random module is used.
     """
     # Add a new key that will hold the captures that map
     # to each location and a key that will let us know that these
@@ -308,63 +740,73 @@ def make_collection(captures, locations, obfuscate):
         location['captures'] = []
         location['new'] = False
 
-    # First, loop through the captures to pinpoint any possible
-    # new locations.  We're looping backwards so we can delete captures
-    # if necessary.
-    for i in range(len(captures) - 1, -1, -1):
-        capture = captures[i]
-        curr_lat = float(capture['trap_latitude'])
-        curr_lon = float(capture['trap_longitude'])
-
-        # If a trap can't get correct GPS data, it will either report
-        # a coordinate that is exactly 0 or report its location as
-        # (51.4778, 0.0014), which is in Greenwich near the prime
-        # meridian.  Either way, drop the capture.
-        if curr_lat == 0 or curr_lon == 0 or (curr_lat == 51.4778 and curr_lon == 0.0014):
-            del captures[i]
-
-        else:
-            # Determine whether this capture is close to
-            # any existing locations.
-            for location in locations:
-                distance = calculate_distance(curr_lat, curr_lon, location['true_latitude'],
+    # First, drop any captures with bad GPS data.  If a trap can't get
+    # correct GPS data, it will either report a coordinate that is
+    # exactly 0 or report its location as (51.4778, 0.0014), which is
+    # in Greenwich near the prime meridian.
+    captures, lats, lons = [], [], []
+
+    for i, curr_lat, curr_lon in zip(indexes, *columns.coordinates(indexes)):
+        # Every capture needs its coordinates to be binned.
+        if math.isnan(curr_lat) or math.isnan(curr_lon):
+            raise ValueError('Capture is missing its coordinates. Capture ID: '
+                             + columns.ids[i])
+
+        if not (curr_lat == 0 or curr_lon == 0 or (curr_lat == 51.4778 and curr_lon == 0.0014)):
+            captures.append(int(i))
+            lats.append(curr_lat)
+            lons.append(curr_lon)
+
+    if captures:
+        min_lat, max_lat = min(lats), max(lats)
+
+        # 111 meters - arbitrary, but shouldn't be too small.
+        radius = 111
+
+        # Next, pinpoint any possible new locations.  Distances to the
+        # known locations are calculated for all captures in one go.
+        known = nearby_locations(locations, min_lat, max_lat, radius)
+        closest = find_closest_locations(lats, lons, [locations[j] for j in known])
+        new_locations = []
+
+        # Loop backwards to add new locations in the same order as
+        # the captures were checked in.
+        for i in range(len(captures) - 1, -1, -1):
+            # Skip the capture if it's close to an existing location.
+            if closest[i][1] < radius:
+                continue
+
+            # Otherwise, check it against the locations that were
+            # added for the previous captures.
+            for location in new_locations:
+                distance = calculate_distance(lats[i], lons[i], location['true_latitude'],
                                               location['true_longitude'])
 
-                # 111 meters - arbitrary, but shouldn't be too small.
-                if distance < 111:
+                if distance < radius:
                     break
 
             # If it's not close to any known location, add
             # a new location at its coordinates.  This bubbles up
             # to the metadata dict as well.
             else:
-                locations.append({
-                    'true_latitude': curr_lat,
-                    'true_longitude': curr_lon,
+                location = {
+                    'true_latitude': lats[i],
+                    'true_longitude': lons[i],
                     'captures': [],
                     'new': True
-                })
-
-    # Next, loop through the captures and assign them
-    # to the closest locations.
-    for capture in captures:
-        curr_lat = float(capture['trap_latitude'])
-        curr_lon = float(capture['trap_longitude'])
-
-        closest_location = None
-        closest_distance = math.inf
-
-        for location in locations:
-            distance = calculate_distance(curr_lat, curr_lon,
-                                          location['true_latitude'], location['true_longitude'])
-
-            if distance < closest_distance:
-                closest_location = location
-                closest_distance = distance
+                }
+                locations.append(location)
+                new_locations.append(location)
 
+        # Finally, assign the captures to the closest locations.
         # Because of the previous loop, each capture will be
-        # within a reasonable distance of some location.
-        closest_location['captures'].append(capture)
+        # within a reasonable distance of some location, so only the
+        # nearby ones need to be considered.
+        candidates = nearby_locations(locations, min_lat, max_lat, radius)
+        closest = find_closest_locations(lats, lons, [locations[j] for j in candidates])
+
+        for capture, (j, _) in zip(captures, closest):
+            locations[candidates[j]]['captures'].append(capture)
 
     # This will hold the final collection if there is one.
     collection = None
@@ -380,18 +822,24 @@ def make_collection(captures, locations, obfuscate):
             # to get a more accurate lat/lon, then obfuscate
             # if necessary.
             if location['new']:
-                lats, lons = [], []
-
-                for capture in location['captures']:
-                    lats.append(float(capture['trap_latitude']))
-                    lons.append(float(capture['trap_longitude']))
+                lats, lons = columns.coordinates(location['captures'])
 
                 location['true_latitude'] = round(sum(lats) / len(lats), 6)
                 location['true_longitude'] = round(sum(lons) / len(lons), 6)
 
                 if obfuscate:
+                    # Seed the offset with the location itself so it's
+                    # the same no matter what order locations are
+                    # processed in or which process does it.
+                    if seed is None:
+                        rng = random
+                    else:
+                        rng = random.Random('{}:{:.6f}:{:.6f}'.format(
+                            seed, location['true_latitude'], location['true_longitude']))
+
                     new_lat, new_lon = obfuscate_coordinates(location['true_latitude'],
-                                                             location['true_longitude'], 200, 400)
+                                                             location['true_longitude'], 200, 400,
+                                                             rng)
                     location['offset_latitude'] = round(new_lat, 6)
                     location['offset_longitude'] = round(new_lon, 6)
                 else:
@@ -417,10 +865,9 @@ def make_collection(captures, locations, obfuscate):
 def write_collection(collection, metadata, out_csv):
     """Write a collection of captures to file.
 
-    Take a collection containing a day's worth of captures and
-    aggregate and write it to file if the counter was on at some point
-    during the day.  Return True if the collection was written
-    and False if it wasn't.
+    Take a collection summarizing a day's worth of captures and write
+    it to file if the counter was on at some point during the day.
+    Return True if the collection was written and False if it wasn't.
 
     Arguments:
     collection -- A dict containing the collection to write to file.
@@ -428,33 +875,17 @@ def write_collection(collection, metadata, out_csv):
         that the captures originate from.
     out_csv -- A CSV writer object to write the collection to.
     """
-    captures = collection['captures']
-    mos_count = 0
-
-    # Stores whether the counter was turned on at some point in the day.
-    counter_on = False
-
-    # Stores whether CO2 was turned on at some point in the day.
-    used_co2 = False
-
-    trap_id = captures[0]['trap_id']
-    date = com.make_date(captures[0]['timestamp_start'])
+    trap_id = collection['trap_id']
+    date = collection['date']
 
-    # Sum all of the mosquitoes captured throughout the day
-    # and check to see whether counter and CO2 were used.
-    for capture in captures:
-        # Mosquito counts are stored in the 'medium' field.
-        mos_count += int(capture['medium'])
-
-        if not used_co2 and capture['co2_status']:
-            used_co2 = True
-
-        if not counter_on and capture['counter_status'] in {'1', True}:
-            counter_on = True
+    # Every capture needs its mosquito count to be written.
+    if collection['missing_count_id'] is not None:
+        raise ValueError('Capture is missing its mosquito count. Capture ID: '
+                         + collection['missing_count_id'])
 
     # Only write the collection if the counter was on.
-    if counter_on:
-        if used_co2:
+    if collection['counter_on']:
+        if collection['used_co2']:
             attractant = 'carbon dioxide'
         else:
             attractant = ''
@@ -492,7 +923,7 @@ def write_collection(collection, metadata, out_csv):
                           '{:.6f}'.format(collection['offset_latitude']),
                           '{:.6f}'.format(collection['offset_longitude']),
                           '', 'COLLECT_BGCT', attractant, 1, 1, 'Culicidae', 'SIZE', 'adult',
-                          'unknown sex', mos_count])
+                          'unknown sex', collection['mos_count']])
 
         return True
 
@@ -513,49 +944,141 @@ def get_trap_metadata(cur, trap_id):
     Note: Omit the 'cur' argument when calling and provide other
     arguments as keyword args.
     """
-    # Get the prefix associated with the trap
-    # to check if the trap exists in the database.
-    sql = ('SELECT p.prefix, p.obfuscate FROM traps as t, providers as p '
-           'WHERE t.prefix = p.prefix AND t.trap_id = %s')
-    cur.execute(sql, (trap_id,))
-    row = cur.fetchone()
+    metadata = query_trapsets_metadata(cur, [trap_id])
 
-    if not row:
+    if not metadata:
         raise ValueError('No database entry for trap ID: ' + trap_id)
 
-    prefix = row['prefix']
-    metadata = {prefix: {'traps': {}, 'ordinals': {}, 'obfuscate': row['obfuscate']}}
+    return metadata
+
+
+@com.run_with_connection
+def get_trapsets_metadata(cur, trap_ids):
+    """Get metadata for every trapset containing any of the given traps.
+
+    trap_ids -- A list of strings representing BG-Counter trap IDs.
+
+    Note: Omit the 'cur' argument when calling and provide other
+    arguments as keyword args.
+    """
+    return query_trapsets_metadata(cur, trap_ids)
+
+
+def query_trapsets_metadata(cur, trap_ids):
+    """Query the metadata for the trapsets containing the given traps.
+
+    Runs a fixed number of queries no matter how many traps or
+    providers are involved.  Traps that don't exist in the database are
+    left out of the result.
+
+    Arguments:
+    cur -- A database cursor.
+    trap_ids -- A list of strings representing BG-Counter trap IDs.
+    """
+    # Get the prefixes associated with the traps
+    # to check if the traps exist in the database.
+    sql = ('SELECT t.trap_id, p.prefix, p.obfuscate FROM traps as t, providers as p '
+           'WHERE t.prefix = p.prefix AND t.trap_id = ANY(%s)')
+    cur.execute(sql, (list(trap_ids),))
+    metadata = {}
+
+    for row in cur.fetchall():
+        if row['prefix'] not in metadata:
+            metadata[row['prefix']] = {'traps': {}, 'ordinals': {}, 'checkpoints': {},
+                                       'obfuscate': row['obfuscate']}
 
-    # Get the locations associated with the traps.
-    sql = ('SELECT t.trap_id, true_latitude, true_longitude, offset_latitude, offset_longitude '
+    prefixes = list(metadata.keys())
+
+    # Get the locations associated with all traps of the prefixes.
+    sql = ('SELECT t.prefix, t.trap_id, true_latitude, true_longitude, offset_latitude, '
+           'offset_longitude '
            'FROM traps as t LEFT OUTER JOIN locations as l ON t.trap_id = l.trap_id '
-           'WHERE t.prefix = %s')
-    cur.execute(sql, (prefix,))
+           'WHERE t.prefix = ANY(%s)')
+    cur.execute(sql, (prefixes,))
 
     rows = cur.fetchall()
     for row in rows:
+        trapset = metadata[row['prefix']]
         trap_id = row['trap_id']
 
-        if trap_id not in metadata[prefix]['traps']:
-            metadata[prefix]['traps'][trap_id] = []
+        if trap_id not in trapset['traps']:
+            trapset['traps'][trap_id] = []
 
         if row['true_latitude'] and row['true_longitude']:
-            metadata[prefix]['traps'][trap_id].append({
+            trapset['traps'][trap_id].append({
                 'true_latitude': row['true_latitude'],
                 'true_longitude': row['true_longitude'],
                 'offset_latitude': row['offset_latitude'],
                 'offset_longitude': row['offset_longitude'],
             })
 
-    # Get the ordinals associated with the prefix.
-    sql = 'SELECT year, ordinal FROM ordinals WHERE prefix = %s'
-    cur.execute(sql, (prefix,))
+    # Get the ordinals associated with the prefixes.
+    sql = 'SELECT prefix, year, ordinal FROM ordinals WHERE prefix = ANY(%s)'
+    cur.execute(sql, (prefixes,))
+
+    for row in cur.fetchall():
+        metadata[row['prefix']]['ordinals'][row['year']] = row['ordinal']
+
+    # Get the checkpoints of the traps of the prefixes.
+    sql = ('SELECT t.prefix, c.trap_id, c.last_day FROM traps as t, checkpoints as c '
+           'WHERE t.trap_id = c.trap_id AND t.prefix = ANY(%s)')
+    cur.execute(sql, (prefixes,))
 
-    metadata[prefix]['ordinals'] = {row['year']: row['ordinal'] for row in cur.fetchall()}
+    for row in cur.fetchall():
+        metadata[row['prefix']]['checkpoints'][row['trap_id']] = row['last_day']
 
     return metadata
 
 
+def merge_metadata(metadata, new_metadata, trap_index):
+    """Merge newly fetched trapset metadata into the master metadata.
+
+    Trapsets that are already known keep their (possibly updated)
+    locations, ordinals and checkpoints; only traps missing from them
+    are added.
+    The trap index is updated to map every trap to its prefix.
+
+    Arguments:
+    metadata -- The master metadata dict.
+    new_metadata -- A metadata dict as returned by
+        get_trapsets_metadata.
+    trap_index -- A dict mapping trap IDs to prefixes.
+    """
+    for prefix, trapset in new_metadata.items():
+        if prefix not in metadata:
+            metadata[prefix] = trapset
+        else:
+            for trap_id, locations in trapset['traps'].items():
+                metadata[prefix]['traps'].setdefault(trap_id, locations)
+
+            for trap_id, checkpoint in trapset['checkpoints'].items():
+                metadata[prefix]['checkpoints'].setdefault(trap_id, checkpoint)
+
+        for trap_id in metadata[prefix]['traps']:
+            trap_index[trap_id] = prefix
+
+
+@com.run_with_connection
+def get_emitted_ordinals(cur, prefix, year):
+    """Get the ordinals of the collections recorded for a project.
+
+    Returns a set of the ordinals of the collections that were written
+    to the project's file by a run that hasn't finished and recorded by
+    commit_trap.
+
+    Arguments:
+    prefix -- A string corresponding to the prefix of the provider.
+    year -- The year of the project.
+
+    Note: Omit the 'cur' argument when calling and provide other
+    arguments as keyword args.
+    """
+    sql = 'SELECT ordinal FROM emitted_ordinals WHERE prefix = %s AND year = %s'
+    cur.execute(sql, (prefix, year))
+
+    return {row['ordinal'] for row in cur.fetchall()}
+
+
 @com.run_with_connection
 def get_provider_metadata(cur, prefix):
     """Get metadata for a particular data provider.
@@ -575,41 +1098,111 @@ def get_provider_metadata(cur, prefix):
     return row
 
 
-@com.run_with_connection
-def update_metadata(cur, metadata):
-    """Update metadata in the database.
+@com.stage('update_metadata')
+def update_metadata(metadata):
+    """Update metadata in the database at the end of a run.
 
     metadata -- A dict containing the metadata to update the database
         with.  Can contain metadata on multiple providers.
 
+    Note: Provide arguments as keyword args.
+    """
+    record_metadata(metadata=metadata)
+
+
+@com.stage('update_metadata')
+@com.run_with_connection
+def finish_metadata(cur, metadata):
+    """Record the end of a run that recorded each trap as it went.
+
+    Every trap's metadata was already recorded by commit_trap, so this
+    only forgets the collections written by the run, since the project
+    files of a run that finished aren't resumed.
+
+    metadata -- A dict containing the metadata of the run.  Can contain
+        metadata on multiple providers.
+
     Note: Omit the 'cur' argument when calling and provide other
     arguments as keyword args.
     """
-    for prefix, trapset in metadata.items():
-        # Update the ordinals associated with the prefix.
-        sql = ('INSERT INTO ordinals VALUES (%s, %s, %s) '
-               'ON CONFLICT (prefix, year) DO UPDATE SET ordinal = EXCLUDED.ordinal')
-        for year, ordinal in trapset['ordinals'].items():
-            cur.execute(sql, (prefix, year, ordinal))
+    if metadata:
+        sql = 'DELETE FROM emitted_ordinals WHERE prefix = ANY(%s)'
+        cur.execute(sql, (list(metadata.keys()),))
+
+
+@com.run_with_connection
+def record_metadata(cur, metadata):
+    """Record metadata in the database.
+
+    metadata -- A dict containing the metadata to update the database
+        with.  Can contain metadata on multiple providers.  Each
+        provider's metadata may also have an 'emitted' list of
+        (year, ordinal, trap_id, date) tuples for the collections that
+        were written.
+
+    Note: Omit the 'cur' argument when calling and provide other
+    arguments as keyword args.
+    """
+    # The number of rows sent to the database per statement.
+    page_size = 1000
 
-        for trap_id, locations in trapset['traps'].items():
-            # Check the trap to make sure it still exists
-            # and has the same prefix.
-            sql = 'SELECT prefix FROM traps WHERE trap_id = %s'
-            cur.execute(sql, (trap_id,))
-            row = cur.fetchone()
+    # Check all traps to make sure they still exist
+    # and have the same prefixes.
+    trap_prefixes = {trap_id: prefix for prefix, trapset in metadata.items()
+                     for trap_id in trapset['traps']}
 
-            if not row:
+    if trap_prefixes:
+        sql = 'SELECT trap_id, prefix FROM traps WHERE trap_id = ANY(%s)'
+        cur.execute(sql, (list(trap_prefixes.keys()),))
+        db_prefixes = {row['trap_id']: row['prefix'] for row in cur.fetchall()}
+
+        for trap_id, prefix in trap_prefixes.items():
+            if trap_id not in db_prefixes:
                 raise ValueError('Metadata update failed - trap no longer exists: ' + trap_id)
-            elif row['prefix'] != prefix:
+            elif db_prefixes[trap_id] != prefix:
                 raise ValueError('Metadata update failed - prefix has changed for trap: '
                                  + trap_id)
 
-            # Add new locations if there are any.
-            sql = 'INSERT INTO locations VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING'
-            for location in locations:
-                cur.execute(sql, (trap_id, location['true_latitude'], location['true_longitude'],
-                                  location['offset_latitude'], location['offset_longitude']))
+    # Update the ordinals associated with the prefixes.
+    ordinal_rows = [(prefix, year, ordinal) for prefix, trapset in metadata.items()
+                    for year, ordinal in trapset['ordinals'].items()]
+
+    if ordinal_rows:
+        sql = ('INSERT INTO ordinals VALUES %s '
+               'ON CONFLICT (prefix, year) DO UPDATE SET ordinal = EXCLUDED.ordinal')
+        pg2_extras.execute_values(cur, sql, ordinal_rows, page_size=page_size)
+
+    # Add new locations if there are any.
+    location_rows = [(trap_id, location['true_latitude'], location['true_longitude'],
+                      location['offset_latitude'], location['offset_longitude'])
+                     for trapset in metadata.values()
+                     for trap_id, locations in trapset['traps'].items()
+                     for location in locations]
+
+    if location_rows:
+        sql = 'INSERT INTO locations VALUES %s ON CONFLICT DO NOTHING'
+        pg2_extras.execute_values(cur, sql, location_rows, page_size=page_size)
+
+    # Move up the checkpoints of the traps that were processed.
+    checkpoint_rows = [(trap_id, checkpoint) for trapset in metadata.values()
+                       for trap_id, checkpoint in trapset['checkpoints'].items()
+                       if checkpoint is not None]
+
+    if checkpoint_rows:
+        sql = ('INSERT INTO checkpoints VALUES %s ON CONFLICT (trap_id) DO UPDATE '
+               'SET last_day = GREATEST(checkpoints.last_day, EXCLUDED.last_day)')
+        pg2_extras.execute_values(cur, sql, checkpoint_rows, page_size=page_size)
+
+    # Record the ordinals of the collections that were written.
+    emitted_rows = [(prefix, year, ordinal, trap_id, date)
+                    for prefix, trapset in metadata.items()
+                    for year, ordinal, trap_id, date in trapset.get('emitted', [])]
+
+    if emitted_rows:
+        sql = ('INSERT INTO emitted_ordinals VALUES %s ON CONFLICT (prefix, year, ordinal) '
+               'DO UPDATE SET trap_id = EXCLUDED.trap_id, '
+               'collection_date = EXCLUDED.collection_date')
+        pg2_extras.execute_values(cur, sql, emitted_rows, page_size=page_size)
 
 
 def calculate_distance(lat1, lon1, lat2, lon2):
@@ -637,7 +1230,98 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     return distance
 
 
-def obfuscate_coordinates(lat, lon, min_distance, max_distance):
+def calculate_distances(lats1, lons1, lats2, lons2):
+    """Get distances in meters between two sets of decimal coordinates.
+
+    Returns a matrix with a row for each point of the first set and a
+    column for each point of the second.  The matrix is a NumPy array
+    if NumPy is installed and a list of lists otherwise.  Uses the same
+    formula as calculate_distance.
+    """
+    if np is None:
+        return [[calculate_distance(lat1, lon1, lat2, lon2) for lat2, lon2 in zip(lats2, lons2)]
+                for lat1, lon1 in zip(lats1, lons1)]
+
+    # Approximate radius of earth in km.
+    r = 6373.0
+
+    # Convert the parameters to radians, shaped so that
+    # the operations broadcast into a matrix.
+    lat1 = np.radians(np.asarray(lats1, dtype=float))[:, np.newaxis]
+    lon1 = np.radians(np.asarray(lons1, dtype=float))[:, np.newaxis]
+    lat2 = np.radians(np.asarray(lats2, dtype=float))[np.newaxis, :]
+    lon2 = np.radians(np.asarray(lons2, dtype=float))[np.newaxis, :]
+
+    # Get their deltas.
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+
+    # Calculate distances in meters.
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    distances = r * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    distances *= 1000
+
+    return distances
+
+
+def find_closest_locations(lats, lons, locations):
+    """Find the closest location to each of a set of coordinates.
+
+    Returns a list with an (index, distance) tuple for each point,
+    where index is the position of the closest location in the given
+    list.  Ties go to the earliest location.  If there are no locations,
+    index is None and distance is infinite.
+
+    Arguments:
+    lats -- A list of decimal latitudes.
+    lons -- A list of decimal longitudes.
+    locations -- A list of location dicts.
+    """
+    if not locations:
+        return [(None, math.inf)] * len(lats)
+
+    distances = calculate_distances(lats, lons,
+                                    [location['true_latitude'] for location in locations],
+                                    [location['true_longitude'] for location in locations])
+
+    if np is None:
+        closest = []
+
+        for row in distances:
+            index = min(range(len(row)), key=row.__getitem__)
+            closest.append((index, row[index]))
+
+        return closest
+
+    indexes = distances.argmin(axis=1)
+    return [(int(j), float(distances[i, j])) for i, j in enumerate(indexes)]
+
+
+def nearby_locations(locations, min_lat, max_lat, radius):
+    """Get the indexes of locations that may be close to a latitude band.
+
+    Two points within a distance of each other can't be further apart
+    in latitude than that distance along a meridian, so any location
+    outside the band widened by that much can be ruled out without
+    calculating distances.  This keeps traps with long location
+    histories cheap to process.  Indexes are returned in order.
+
+    Arguments:
+    locations -- A list of location dicts.
+    min_lat -- The lowest decimal latitude of the band.
+    max_lat -- The highest decimal latitude of the band.
+    radius -- The distance in meters to widen the band by.
+    """
+    # Use the same radius of earth as calculate_distance,
+    # with a little slack for rounding errors.
+    margin = math.degrees(radius / 6373000) * 1.01
+    low, high = min_lat - margin, max_lat + margin
+
+    return [i for i, location in enumerate(locations)
+            if low <= location['true_latitude'] <= high]
+
+
+def obfuscate_coordinates(lat, lon, min_distance, max_distance, rng=random):
     """Obfuscate a set of GPS coordinates.
 
     Obfuscates a set of GPS coordinates by translating the represented
@@ -651,18 +1335,20 @@ def obfuscate_coordinates(lat, lon, min_distance, max_distance):
         the point.
     max_distance -- The maximum distance in meters by which to displace
         the point.
+    rng -- The random.Random instance (or the random module) to draw
+        the distance and direction from.
 
     Formula source: http://www.edwilliams.org/avform.htm#LL
     """
     # Randomly choose a distance within the parameters.
-    d_m = random.uniform(min_distance, max_distance)
+    d_m = rng.uniform(min_distance, max_distance)
 
     # Convert this distance to nautical miles, then to radians.
     d_nm = d_m / 1852
     d_r = (math.pi / (180*60)) * d_nm
 
     # Randomly choose a true course (direction) in radians.
-    tc = random.uniform(0, 2 * math.pi)
+    tc = rng.uniform(0, 2 * math.pi)
 
     # Convert the lat/lon to radians.
     lat = math.radians(lat)
@@ -681,21 +1367,28 @@ def obfuscate_coordinates(lat, lon, min_distance, max_distance):
     return new_lat, new_lon
 
 
-def filter_locations(collections):
+def filter_locations(new_locations, known_locations):
     """Let the user filter out errant new locations.
 
-    Checks a set of collections for new locations, writes them to a file
-    for the user to check, then filters out any collections with
-    locations that the user removed.  The file is formatted so that it
-    can be directly imported into the GPS plotting app found here:
-    https://www.darrinward.com/lat-long/.
+    Writes a set of new locations to a file for the user to check, and
+    returns the set of (latitude, longitude) tuples of the locations
+    that collections may be kept at: the known locations and the new
+    locations that the user didn't remove.  Returns None if there are no
+    new locations, in which case all collections can be kept.  The file
+    is formatted so that it can be directly imported into the GPS
+    plotting app found here: https://www.darrinward.com/lat-long/.
 
-    collections -- A dict containing the set of collections to filter.
+    Arguments:
+    new_locations -- A list of (latitude, longitude, note) tuples, one
+        for each collection at a new location, where note names the
+        trap it was found at.
+    known_locations -- A set of (latitude, longitude) tuples of the
+        collections at locations that were recorded before.  We assume
+        that they have been checked before and are good.
     """
     gps_filename = 'check_locations.csv'
-    new_locations = set()
+    named_locations = set()
     good_locations = set()
-    good_collections = {}
 
     # Signals whether we've correctly interpreted what locations the
     # user filtered out.
@@ -706,29 +1399,14 @@ def filter_locations(collections):
             gps_csv = csv.writer(gps_f)
             gps_csv.writerow(['latitude', 'longitude', 'name', 'color', 'note'])
 
-            # Loop through the collections to find new locations.
-            for prefix, trapset in collections.items():
-                for trap_id, curr_collections in trapset.items():
-                    for collection in curr_collections:
-                        lat = collection['true_latitude']
-                        lon = collection['true_longitude']
+            for lat, lon, note in new_locations:
+                # Give the location a name, write it to file, and store
+                # it as a new location.
+                name = 'loc_' + str(len(named_locations))
+                gps_csv.writerow([lat, lon, name, '#FF0000', note])
+                named_locations.add((lat, lon, name))
 
-                        if collection['new']:
-                            # Give the location a name, write it to
-                            # file, and store it as a new location.
-                            name = 'loc_' + str(len(new_locations))
-
-                            gps_csv.writerow([
-                                lat, lon, name, '#FF0000', '{}_{}'.format(prefix, trap_id)
-                            ])
-
-                            new_locations.add((lat, lon, name))
-                        else:
-                            # We assume that it has been checked before
-                            # and is good.
-                            good_locations.add((lat, lon))
-
-        if new_locations:
+        if named_locations:
             # Ask the user to check the new locations.
             input("\nNew locations have been dumped to 'check_locations.csv'.\n"
                   "Delete errant locations from this file, then press Enter to continue.")
@@ -740,7 +1418,7 @@ def filter_locations(collections):
                     good_locations.add((float(row['latitude']), float(row['longitude']),
                                         row['name']))
 
-            missing = new_locations - good_locations
+            missing = named_locations - good_locations
 
             if missing:
                 # Print the names of the deleted locations.
@@ -766,7 +1444,7 @@ def filter_locations(collections):
                 elif answer in {'n', 'no'}:
                     good_input = True
                     print('Resetting...')
-                    new_locations = set()
+                    named_locations = set()
                     good_locations = set()
                 else:
                     print('Please answer yes or no.')
@@ -775,55 +1453,239 @@ def filter_locations(collections):
             print('No new locations. Continuing.')
             finished = True
 
-    if new_locations:
+    if named_locations:
         # Remove the names from the locations.
-        good_locations = {(loc[0], loc[1]) for loc in good_locations}
+        return known_locations | {(loc[0], loc[1]) for loc in good_locations}
+    else:
+        return None
 
-        # Keep the collections that have good locations.
-        for prefix, trapset in collections.items():
-            good_collections[prefix] = {}
 
-            for trap_id, curr_collections in trapset.items():
-                good_collections[prefix][trap_id] = []
+class CaptureColumns:
+    """Hold a trap's captures column by column.
 
-                for collection in curr_collections:
-                    location = (collection['true_latitude'], collection['true_longitude'])
+    Each capture field used by the parser is stored in its own compact
+    array rather than in a dict per capture: timestamps as seconds
+    since the epoch (NaN if empty), coordinates as floats (NaN if
+    missing), mosquito counts as integers (com.missing_count if
+    missing) and the CO2 and counter statuses as flags.  The arrays are
+    NumPy arrays if NumPy is installed and standard library arrays
+    otherwise.
 
-                    if location in good_locations:
-                        good_collections[prefix][trap_id].append(collection)
-    else:
-        good_collections = collections
+    Public methods:
+        from_store
+        coordinates
+        date
+        summarize
+    """
+
+    epoch = com.epoch
+
+    def __init__(self, captures):
+        """Initialize the instance.
+
+        captures -- A list containing the captures of a single trap in
+            forward chronological order.
+        """
+        columns = com.capture_columns(captures)
+
+        self.ids = columns['ids']
+        self.trap_id = captures[0]['trap_id'] if captures else None
+
+        for name, typecode in com.store_columns:
+            setattr(self, name, self._column(typecode, columns[name]))
 
-    return good_collections
+        self._check_start()
+
+    @classmethod
+    def from_store(cls, trap_id, ids, columns):
+        """Make an instance from a trap's data in a capture store.
+
+        The arrays are used as they are, without copying them.
+        Arguments are as yielded by com.iter_capture_store.
+        """
+        self = cls.__new__(cls)
+        self.ids = ids
+        self.trap_id = trap_id
+
+        for name, _ in com.store_columns:
+            setattr(self, name, columns[name])
+
+        self._check_start()
+
+        return self
+
+    def _check_start(self):
+        """Check that every capture has a starting timestamp."""
+        # Captures can't be binned into days without
+        # a starting timestamp.
+        if np is not None:
+            missing = np.flatnonzero(np.isnan(self.start)).tolist()
+        else:
+            missing = [i for i, timestamp in enumerate(self.start) if math.isnan(timestamp)]
+
+        if missing:
+            raise ValueError('Empty starting timestamp at capture ID: ' + self.ids[missing[0]])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _column(typecode, values):
+        """Make an array of the given type from a list of values."""
+        if np is not None:
+            return np.array(values, dtype=typecode)
+        else:
+            return array(typecode, values)
+
+    def coordinates(self, indexes):
+        """Get the coordinates of a set of captures.
+
+        Returns a list of latitudes and a list of longitudes.
+
+        indexes -- The indexes of the captures.
+        """
+        if np is not None:
+            indexes = np.asarray(indexes, dtype=int)
+            return self.lat[indexes].tolist(), self.lon[indexes].tolist()
+        else:
+            return [self.lat[i] for i in indexes], [self.lon[i] for i in indexes]
+
+    def date(self, index):
+        """Get the date of a capture from its starting timestamp.
+
+        index -- The index of the capture.
+        """
+        return self.epoch.date() + dt.timedelta(days=int(self.start[index] // 86400))
+
+    def summarize(self, indexes):
+        """Summarize a set of captures for writing to file.
+
+        Returns a dict with the number of captures, the total number of
+        mosquitoes captured, whether the counter and CO2 were used at
+        some point and the ID of the first capture that's missing its
+        mosquito count, if any.
+
+        indexes -- The indexes of the captures to summarize.
+        """
+        if np is not None:
+            indexes = np.asarray(indexes, dtype=int)
+            medium = self.medium[indexes]
+            missing = indexes[medium == com.missing_count]
+
+            return {
+                'num_captures': len(indexes),
+                'mos_count': int(medium[medium != com.missing_count].sum()),
+                'counter_on': bool(self.counter[indexes].any()),
+                'used_co2': bool(self.co2[indexes].any()),
+                'missing_count_id': self.ids[missing[0]] if missing.size else None,
+            }
+        else:
+            missing = [i for i in indexes if self.medium[i] == com.missing_count]
+
+            return {
+                'num_captures': len(indexes),
+                'mos_count': sum(self.medium[i] for i in indexes
+                                 if self.medium[i] != com.missing_count),
+                'counter_on': any(self.counter[i] for i in indexes),
+                'used_co2': any(self.co2[i] for i in indexes),
+                'missing_count_id': self.ids[missing[0]] if missing else None,
+            }
 
 
 class ProjectFileManager:
     """Handle the formation of all files related to a project.
 
     Public methods:
+        unfinished_years
         update_dates
         write_config
+        flush
         close
+        finish
     """
 
-    def __init__(self, prefix, year):
+    def __init__(self, prefix, year, resume=False):
         """Initialize the instance.
 
         prefix -- The prefix of the provider that this project's data
             comes from.
         year -- The year that this project's data was collected.
+        resume -- Whether to resume the data file of a run that didn't
+            finish, keeping the rows whose collections it recorded in
+            the database and dropping the others.  A file is only
+            resumed if its in-progress marker, which is created while
+            the file is written and removed by finish, is still there.
+            Otherwise, or if this is False, the file is overwritten.
         """
         self.prefix = prefix
         self.year = year
 
-        csv_filename = '{}_{}_saf.csv'.format(prefix, year)
-        self.writer = CSVWriter(csv_filename)
-        self.writerow = self.writer.writerow
-
         self.first_date = dt.date.max
         self.last_date = dt.date.min
         self.month = None
 
+        csv_filename = '{}_{}_saf.csv'.format(prefix, year)
+        self.marker = csv_filename + '.inprogress'
+        rows = []
+
+        if resume and os.path.exists(self.marker) and os.path.exists(csv_filename):
+            rows = self.committed_rows(csv_filename)
+
+            if rows:
+                print('Keeping {} collections already written to {}'
+                      .format(len(rows), csv_filename))
+
+            for row in rows:
+                self.update_dates(dt.datetime.strptime(row[2], '%Y-%m-%d').date())
+
+        # Only a run that records the collections it writes can be
+        # resumed.
+        if resume:
+            open(self.marker, 'w').close()
+        elif os.path.exists(self.marker):
+            os.remove(self.marker)
+
+        self.writer = CSVWriter(csv_filename, rows)
+        self.writerow = self.writer.writerow
+
+    @staticmethod
+    def unfinished_years(prefix):
+        """Return the years of a provider's projects left to be resumed.
+
+        prefix -- The prefix of the provider.
+        """
+        years = []
+
+        for marker in glob.glob(glob.escape(prefix) + '_*_saf.csv.inprogress'):
+            year = os.path.basename(marker)[len(prefix) + 1:-len('_saf.csv.inprogress')]
+
+            if year.isdigit():
+                years.append(int(year))
+
+        return sorted(years)
+
+    def committed_rows(self, filename):
+        """Return the rows of a data file that were recorded.
+
+        Only complete rows whose ordinals were recorded by commit_trap
+        are returned, so rows from a trap that was still being written
+        when a run died are dropped.
+
+        filename -- The name of the existing data file.
+        """
+        ordinals = get_emitted_ordinals(prefix=self.prefix, year=self.year)
+
+        with open(filename, newline='') as csv_f:
+            lines = [line for line in csv_f if line.endswith('\n')]
+
+        rows = []
+
+        for row in csv.reader(lines[1:]):
+            if row and int(row[0].rsplit('_', 1)[1]) in ordinals:
+                rows.append(row)
+
+        return rows
+
     def update_dates(self, date):
         """Update the first and/or last date, as appropriate.
 
@@ -860,6 +1722,10 @@ class ProjectFileManager:
 
             config_f.write(config_text)
 
+    def flush(self):
+        """Save the rows written to the data file so far to disk."""
+        self.writer.flush()
+
     def close(self):
         """Close the data file and write other files if necessary.
 
@@ -877,17 +1743,33 @@ class ProjectFileManager:
         else:
             return None
 
+    def finish(self):
+        """Mark the data file as finished.
+
+        Removes the in-progress marker, if there is one, so that the
+        next run overwrites the data file instead of resuming it.  Only
+        call this once the run that wrote it is recorded as finished.
+        """
+        if os.path.exists(self.marker):
+            os.remove(self.marker)
+
 
 class CSVWriter:
     """Handle CSV data file operations.
 
     Public methods:
         is_empty
+        flush
         close
     """
 
-    def __init__(self, filename):
-        """Initialize the instance."""
+    def __init__(self, filename, rows=()):
+        """Initialize the instance.
+
+        filename -- The name of the CSV file, which is overwritten.
+        rows -- Data rows to write after the header, such as those
+            kept from an earlier run.
+        """
         self.filename = filename
         self.file = open(filename, 'w')
         self.writer = csv.writer(self.file, lineterminator='\n')
@@ -901,11 +1783,17 @@ class CSVWriter:
         ])
 
         self.empty_pos = self.file.tell()
+        self.writer.writerows(rows)
 
     def is_empty(self):
         """Return whether the CSV file is empty of any data rows."""
         return self.file.tell() == self.empty_pos
 
+    def flush(self):
+        """Save the rows written so far to disk."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
     def close(self):
         """Close the CSV file.
 
@@ -927,4 +1815,5 @@ class CSVWriter:
 
 if __name__ == '__main__':
     args = vars(parse_args())
+    com.configure_metrics(args.pop('metrics'), args.pop('profile'))
     parse_json(**args)
@@ -42,12 +42,16 @@ This script requires at least Python 3.5.
 """
 
 import argparse
+import concurrent.futures
+import curses
 import datetime as dt
 import os
+import shutil
 import subprocess
 import time
 
-from bg_download_data import download_data
+from bg_download_data import (download_data, Dashboard, PageJournal, ProgressPrinter,
+                              RequestLimiter, ResponseCache, shard_units)
 from bg_update_metadata import update_traps
 from bg_json_parser import parse_json
 import bg_common as com
@@ -65,6 +69,49 @@ def parse_args():
     parser.add_argument('--preserve-metadata', action='store_true',
                         help="Don't change the metadata in the database other than adding new "
                              "traps, which is required for the pipeline to work.")
+    parser.add_argument('--no-checkpoints', dest='checkpoints', action='store_false',
+                        help='Parse all downloaded captures, including days that were processed '
+                             'in an earlier run.')
+    parser.add_argument('--max-downloads', type=int, default=4,
+                        help='The maximum number of providers to download data for at once. '
+                             'Default: 4')
+    parser.add_argument('--max-requests', type=int, default=4,
+                        help='The maximum number of concurrent requests to the Biogents API. '
+                             'Default: 4')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='The maximum number of requests to start per second. Default: 1')
+    parser.add_argument('--max-conversions', type=int,
+                        help='The maximum number of ISA-Tab conversions to run at once. '
+                             'Default: the number of CPUs')
+    parser.add_argument('--parse-processes', type=int, default=1,
+                        help="The number of processes to process traps' captures with when "
+                             'parsing the JSON. Default: 1')
+    parser.add_argument('--compress', dest='compression', choices=['gzip', 'zstd'],
+                        help='Compress the raw JSON data files. zstd requires the zstandard '
+                             'package.')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Also write the raw data to a capture store and parse that instead '
+                             'of the JSON. The store is deleted once the data is processed.')
+    parser.add_argument('--cache-dir',
+                        help='Keep the responses from the Biogents API in this directory and '
+                             'answer identical requests from it on later runs. Responses covering '
+                             'the last 24 hours are not kept.')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='The maximum size of the cache in MB. Default: 1024')
+    parser.add_argument('--cache-ttl', type=float,
+                        help='The number of hours a cached response stays usable. Default: No '
+                             'limit')
+    parser.add_argument('--replay-only', action='store_true',
+                        help='Only answer requests from the cache, without contacting the API. '
+                             'Requires --cache-dir.')
+    parser.add_argument('--shard', choices=shard_units + ('none',), default='month',
+                        help="Split each provider's timeframe at the start of each year, month or "
+                             'week and download the pieces in parallel, or "none" to download it '
+                             'as a whole. Default: month')
+    parser.add_argument('--dashboard', action='store_true',
+                        help='Show the progress, request and byte rates, retries and estimated '
+                             'time left of all downloads on a live dashboard. The rest of the '
+                             'pipeline runs once all downloads have finished.')
 
     mutex_group = parser.add_mutually_exclusive_group()
     mutex_group.add_argument('-i', '--include', nargs='+',
@@ -74,13 +121,24 @@ def parse_args():
                              help='Exclude the given providers, identified by their prefixes, from'
                                   ' the pipeline.')
 
+    com.add_metrics_arguments(parser)
+
     args = parser.parse_args()
 
+    if args.replay_only and not args.cache_dir:
+        parser.error('--replay-only requires --cache-dir')
+
+    if args.shard == 'none':
+        args.shard = None
+
     return args
 
 
 def run_pipeline(include=None, exclude=None, start_time=None, end_time=None,
-                 preserve_metadata=False):
+                 preserve_metadata=False, max_downloads=4, max_requests=4, rate=1,
+                 max_conversions=None, parse_processes=1, cache_dir=None, cache_size=1024,
+                 cache_ttl=None, replay_only=False, compression=None, columnar=False,
+                 shard='month', dashboard=False, checkpoints=True):
     """Run the full BG-Counter Tools pipeline.
 
     Optional arguments:
@@ -93,6 +151,39 @@ def run_pipeline(include=None, exclude=None, start_time=None, end_time=None,
         to get data over.
     preserve_metadata -- A boolean signaling whether to leave the
         database data unchanged (apart from adding new traps).
+    max_downloads -- The maximum number of providers to download data
+        for at once.
+    max_requests -- The maximum number of requests to have in flight to
+        the Biogents API at once, across all downloads.
+    rate -- The maximum number of requests to start per second, across
+        all downloads.
+    max_conversions -- The maximum number of PopBioWizard conversions
+        to run at once.  Defaults to the number of CPUs.
+    parse_processes -- The number of processes to process traps'
+        captures with when parsing the JSON.
+    cache_dir -- The directory to cache responses from the Biogents API
+        in.  Pass None to not use a cache.
+    cache_size -- The maximum size of the cache in MB.
+    cache_ttl -- The number of hours a cached response stays usable, or
+        None for no limit.
+    replay_only -- Pass True to get all data from the cache instead of
+        from the API.
+    compression -- The format to compress the raw JSON data files with:
+        'gzip', 'zstd', or None.
+    columnar -- Pass True to also write each provider's data to
+        a capture store and parse that instead of the JSON.
+    shard -- The unit of time to split each provider's timeframe by
+        so that the pieces are downloaded in parallel: 'year',
+        'month', 'week', or None to not split it.
+    dashboard -- Pass True to show the progress of the downloads on
+        a curses dashboard instead of printing it.
+    checkpoints -- A boolean signaling whether to skip the days that
+        were processed in an earlier run when parsing.
+
+    The data for all providers is downloaded concurrently, and the rest
+    of the pipeline runs for each provider as soon as its download
+    finishes.  The ISA-Tab conversions run in the background while the
+    next providers are processed.
     """
     providers = get_providers()
     prefixes = {provider['prefix'] for provider in providers}
@@ -125,74 +216,398 @@ def run_pipeline(include=None, exclude=None, start_time=None, end_time=None,
     if not os.path.exists(extras_dir):
         os.makedirs(extras_dir)
 
+    # Work out each provider's timeframe and run the safety checks
+    # before starting any downloads.
+    jobs = []
+
     for provider in providers:
         # The file that will hold the raw JSON capture data.
-        json_output = provider['prefix'] + '_data.json'
+        json_output = (provider['prefix'] + '_data.json'
+                       + com.compression_extensions.get(compression, ''))
+
+        # The capture store to write alongside the JSON, if any.
+        store = provider['prefix'] + '_data.store' if columnar else None
 
         # Get the last download time or set it if it doesn't exist.
-        if not start_time:
-            if not provider['last_download']:
-                start_time = dt.datetime(2000, 1, 1)
-            else:
-                start_time = provider['last_download']
+        if start_time:
+            provider_start = start_time
+        elif provider['last_download']:
+            provider_start = provider['last_download']
+        else:
+            provider_start = dt.datetime(2000, 1, 1)
 
         # Continue if we didn't already get data
         # from this provider today.
-        if end_time > start_time:
+        if end_time > provider_start:
             # Send a message if we got data from this provider
             # within the last month.
-            if end_time - start_time < dt.timedelta(days=31):
+            if end_time - provider_start < dt.timedelta(days=31):
                 print("Notice: Last download for prefix '{}' occurred less than a month ago: {}."
                       "\nContinuing in 5 seconds."
                       .format(provider['prefix'], provider['last_download']))
                 time.sleep(5)
 
-            # If the data file doesn't already exist, download the data.
-            if not os.path.isfile(json_output):
-                download_data(stdscr=None, api_key=provider['api_key'], start_time=start_time,
-                              end_time=end_time, output=json_output)
+            jobs.append((provider, provider_start, json_output, store))
+
+    # All downloads share one limiter since they all go to the same
+    # server.
+    limiter = RequestLimiter(rate, max_requests)
+
+    if cache_dir:
+        cache = ResponseCache(cache_dir, cache_size * 2**20,
+                              cache_ttl * 3600 if cache_ttl is not None else None, replay_only)
+    else:
+        cache = None
+
+    # Will hold the ISA-Tab conversions started for each provider.
+    conversions = []
+
+    if max_conversions is None:
+        max_conversions = os.cpu_count() or 1
+
+    # The conversions are run by separate PopBioWizard processes, so
+    # threads are enough to keep them running in parallel.
+    converter = concurrent.futures.ThreadPoolExecutor(max_workers=max_conversions)
+
+    try:
+        run_downloads(jobs, end_time, extras_dir, preserve_metadata, limiter, max_downloads,
+                      converter, conversions, parse_processes, cache, shard, dashboard,
+                      checkpoints)
+    except BaseException:
+        # Still clean up after the conversions that were started, but
+        # don't let their failures hide this error.  They're reported
+        # either way.
+        converter.shutdown()
+        finish_conversions(conversions, extras_dir, raise_failure=False)
+        raise
+
+    converter.shutdown()
+    finish_conversions(conversions, extras_dir)
+
+
+def run_downloads(jobs, end_time, extras_dir, preserve_metadata, limiter, max_downloads,
+                  converter, conversions, parse_processes=1, cache=None, shard=None,
+                  dashboard=False, checkpoints=True):
+    """Download data for all providers and process it as it arrives.
+
+    Arguments:
+    jobs -- A list of (provider, start_time, json_output, store) tuples,
+        where store is the name of the capture store to write, or None.
+    end_time -- A datetime object representing the end of the timeframe
+        to get data over.  A provider whose partial download is resumed
+        keeps the end time it was started with (see start_downloads).
+    extras_dir -- The directory to move intermediate files to.
+    preserve_metadata -- A boolean signaling whether to leave the
+        database data unchanged (apart from adding new traps).
+    limiter -- The RequestLimiter shared by all downloads.
+    max_downloads -- The maximum number of providers to download data
+        for at once.
+    converter -- The executor to run ISA-Tab conversions on.
+    conversions -- A list to append each provider's conversions to, as
+        returned by process_provider.
+    parse_processes -- The number of processes to process traps'
+        captures with when parsing the JSON.
+    cache -- The ResponseCache shared by all downloads, or None.
+    shard -- The unit of time to split each download by, or None.
+    dashboard -- Pass True to show the downloads on a Dashboard.  Since
+        the rest of the pipeline prints, and may ask questions, it only
+        runs once the dashboard is closed after all downloads finish.
+        Otherwise, the downloads print their progress through
+        a ProgressPrinter, which holds it back while a provider is
+        processed so that it doesn't bury the questions asked there.
+    checkpoints -- A boolean signaling whether to skip the days that
+        were processed in an earlier run when parsing.
+    """
+    printer = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_downloads) as executor:
+        if dashboard:
+            downloads = curses.wrapper(watch_downloads, executor, jobs, end_time, limiter, cache,
+                                       shard)
+        else:
+            printer = ProgressPrinter()
+            downloads = start_downloads(executor, jobs, end_time, limiter, cache, shard,
+                                        printer=printer)
+
+        # Finish the pipeline for each provider as its data arrives.
+        for future in concurrent.futures.as_completed(downloads):
+            provider, json_output, store, provider_end = downloads[future]
+
+            # Raise any error from the download.
+            future.result()
+
+            if printer:
+                printer.pause()
+
+            try:
+                conversions.append(process_provider(provider, json_output, provider_end,
+                                                    converter, preserve_metadata,
+                                                    parse_processes, store, checkpoints))
+            finally:
+                if printer:
+                    printer.resume()
+
+
+def start_downloads(executor, jobs, end_time, limiter, cache=None, shard=None, dashboard=None,
+                    printer=None):
+    """Start downloading the data for all providers at once.
+
+    Returns a dict mapping a future for each download to
+    a (provider, json_output, store, end_time) tuple, where end_time is
+    the end of the timeframe the provider's data is downloaded over.
+    It's the given end time unless a partial download that was recorded
+    with an earlier one is resumed.
+
+    Arguments:
+    executor -- The executor to run the downloads on.
+    jobs -- A list of (provider, start_time, json_output, store) tuples
+        as taken by run_downloads.
+    end_time -- A datetime object representing the end of the timeframe
+        to get data over.
+    limiter -- The RequestLimiter shared by all downloads.
+    cache -- The ResponseCache shared by all downloads, or None.
+    shard -- The unit of time to split each download by, or None.
+    dashboard -- The Dashboard to track the downloads on, or None to
+        print their progress.
+    printer -- The ProgressPrinter to print the progress of the
+        downloads through if there is no dashboard, or None to let the
+        downloads print it themselves.
+    """
+    downloads = {}
+
+    for provider, provider_start, json_output, store in jobs:
+        progress = dashboard.track(provider['prefix']) if dashboard else None
+        provider_end = end_time
+
+        # If the data file doesn't already exist, download the data.
+        if not os.path.isfile(json_output):
+            journal = json_output + '.journal'
+            message = None
+
+            # The journal can only be resumed over the timeframe it was
+            # recorded for, so a run that died on an earlier day
+            # finishes its download with the earlier end time.
+            if os.path.isfile(journal):
+                recorded_end = PageJournal.recorded_end_time(journal, provider['api_key'],
+                                                             provider_start)
+
+                if recorded_end is not None and recorded_end > provider_start:
+                    provider_end = recorded_end
+                    message = ('Notice: Resuming partial download of {} up to {}.'
+                               .format(json_output, provider_end))
+                else:
+                    message = ('Notice: Discarding partial download of {}, which was for '
+                               'a different timeframe.'.format(json_output))
+
+            if message:
+                if progress:
+                    progress.set_status(message)
+                else:
+                    print(message)
+
+            if printer and not dashboard:
+                progress = printer.track(provider['prefix'])
+
+            future = executor.submit(download_data, stdscr=None, api_key=provider['api_key'],
+                                     start_time=provider_start, end_time=provider_end,
+                                     output=json_output, spill=True, limiter=limiter,
+                                     journal=journal, cache=cache, store=store,
+                                     progress=progress, shard=shard)
+
+            if progress:
+                # Show why the download stopped, if it failed.
+                def report_error(future, progress=progress):
+                    if not future.cancelled() and future.exception() is not None:
+                        progress.fail(future.exception())
+
+                future.add_done_callback(report_error)
+        else:
+            message = 'Notice: Using raw trap data from file {}.'.format(json_output)
+
+            if progress:
+                progress.finish(message)
             else:
-                print('Notice: Using raw trap data from file {}.\nContinuing in 5 seconds.'
-                      .format(json_output))
+                print(message + '\nContinuing in 5 seconds.')
                 time.sleep(5)
 
-            # Add any new traps to the database.
-            update_traps(api_key=provider['api_key'], file=[json_output])
+            future = concurrent.futures.Future()
+            future.set_result(None)
+
+        downloads[future] = (provider, json_output, store, provider_end)
+
+    return downloads
 
-            # Parse the JSON and return the metadata
-            # of successful projects, if any.
-            projects = parse_json(files=[json_output], split_years=True, check_locations=True,
-                                  preserve_metadata=preserve_metadata)
 
-            # Update the last download time.
-            if not preserve_metadata:
-                update_last_download(prefix=provider['prefix'], time=end_time)
+def watch_downloads(stdscr, executor, jobs, end_time, limiter, cache=None, shard=None):
+    """Start the downloads and show them on a dashboard until they finish.
+
+    Meant to be called through curses.wrapper.  Takes the same arguments
+    as start_downloads, after the curses screen object, and returns the
+    same dict.
+    """
+    dashboard = Dashboard(stdscr)
+
+    try:
+        downloads = start_downloads(executor, jobs, end_time, limiter, cache, shard, dashboard)
+        concurrent.futures.wait(downloads)
 
-            for project in projects:
-                # Define filenames.
-                project_id = '{}_{}'.format(project['prefix'], project['year'])
-                project_dir = './' + project_id + '/'
-                interchange_name = project_id + '_saf.csv'
-                config_name = project_id + '_config.yaml'
+        # Leave the final numbers up for a moment.
+        time.sleep(1.5)
+    finally:
+        dashboard.close()
 
-                # Create the project directory.
-                if not os.path.exists(project_dir):
-                    os.makedirs(project_dir)
+    return downloads
 
-                # Create ISA-Tabs.
-                subprocess.run(check=True, args=[
-                    'perl', 'PopBio-interchange-format/PopBioWizard.pl', '--file',
-                    interchange_name, '--config', config_name, '--output-directory', project_dir,
-                    '--isatab'
-                ])
 
+def process_provider(provider, json_output, end_time, converter, preserve_metadata=False,
+                     parse_processes=1, store=None, checkpoints=True):
+    """Run the steps of the pipeline that follow the download.
+
+    Adds new traps to the database, parses the JSON, updates the last
+    download time, and starts creating the ISA-Tabs for each resulting
+    project.  Returns a (json_output, store, projects) tuple, where
+    store is the capture store that was used, if any, and projects is
+    a list of (future, interchange_name, config_name) tuples, one for
+    each conversion.
+
+    Arguments:
+    provider -- A dict-like row with the provider's prefix and API key.
+    json_output -- The name of the file holding the raw JSON data.
+    end_time -- A datetime object representing the end of the timeframe
+        that the data was downloaded over.
+    converter -- The executor to run ISA-Tab conversions on.
+    preserve_metadata -- A boolean signaling whether to leave the
+        database data unchanged (apart from adding new traps).
+    parse_processes -- The number of processes to process traps'
+        captures with when parsing the JSON.
+    store -- The name of the capture store holding the same data as the
+        JSON.  It's used instead of the JSON if it exists.
+    checkpoints -- A boolean signaling whether to skip the days that
+        were processed in an earlier run when parsing.
+    """
+    # Read the capture store if there is a complete one, since it's
+    # much faster.  A JSON file from a previous run might not have one,
+    # and a run that died while writing it leaves one without an index.
+    if store and os.path.isfile(os.path.join(store, 'index.json')):
+        data_file = store
+    else:
+        data_file = json_output
+        store = None
+
+    # Add any new traps to the database.
+    update_traps(api_key=provider['api_key'], file=[data_file])
+
+    def update_provider(update, metadata):
+        """Finish the metadata and update the last download time together."""
+        with com.shared_connection():
+            update(metadata=metadata)
+            update_last_download(prefix=provider['prefix'], time=end_time)
+
+    # Parse the JSON and return the metadata of successful projects,
+    # if any.  No transaction is held open while parsing, since it
+    # waits for the user to check any new locations.  With checkpoints,
+    # each trap's progress is recorded as soon as its collections are
+    # written, so that a run that dies partway through is resumed.
+    # Once all collections have been written, the run is finished and
+    # the last download time is updated in one transaction, so that
+    # either both or neither are recorded.
+    projects = parse_json(files=[data_file], split_years=True,
+                          check_locations=True, preserve_metadata=preserve_metadata,
+                          processes=parse_processes, checkpoints=checkpoints,
+                          end_time=end_time, metadata_updater=update_provider)
+
+    conversions = []
+
+    for project in projects:
+        # Define filenames.
+        project_id = '{}_{}'.format(project['prefix'], project['year'])
+        project_dir = './' + project_id + '/'
+        interchange_name = project_id + '_saf.csv'
+        config_name = project_id + '_config.yaml'
+
+        # Create the project directory.
+        if not os.path.exists(project_dir):
+            os.makedirs(project_dir)
+
+        # Start creating the ISA-Tabs.
+        future = converter.submit(create_isatabs, interchange_name, config_name, project_dir)
+        conversions.append((future, interchange_name, config_name))
+
+    return json_output, store, conversions
+
+
+def create_isatabs(interchange_name, config_name, project_dir):
+    """Convert a project's files into ISA-Tabs with PopBioWizard.
+
+    Returns the subprocess.CompletedProcess, with the stderr output
+    captured as a string.
+    """
+    with com.stage('PopBioWizard', project=project_dir):
+        return subprocess.run(stderr=subprocess.PIPE, universal_newlines=True, args=[
+            'perl', 'PopBio-interchange-format/PopBioWizard.pl', '--file',
+            interchange_name, '--config', config_name, '--output-directory', project_dir,
+            '--isatab'
+        ])
+
+
+def finish_conversions(conversions, extras_dir, raise_failure=True):
+    """Wait for ISA-Tab conversions to finish and clean up after them.
+
+    Moves each successful project's files to the extras folder, along
+    with a provider's JSON file once all of its projects have succeeded,
+    at which point its capture store, if any, is deleted.  The files of
+    failed projects are left in place.  Once every conversion has
+    finished, raises the error of the first one that failed, if any: a
+    CalledProcessError if PopBioWizard exited with an error, or the
+    exception that kept it from running.
+
+    Arguments:
+    conversions -- A list of (json_output, store, projects) tuples as
+        returned by process_provider.
+    extras_dir -- The directory to move intermediate files to.
+    raise_failure -- Pass False to only report failed conversions
+        instead of raising an error.
+    """
+    failures = []
+
+    for json_output, store, projects in conversions:
+        success = True
+
+        for future, interchange_name, config_name in projects:
+            try:
+                result = future.result()
+            except Exception as e:
+                # PopBioWizard couldn't be run at all, for example
+                # because Perl is missing.
+                success = False
+                failures.append(e)
+                print('Error: PopBioWizard could not be run for {}: {}'
+                      .format(interchange_name, e))
+                continue
+
+            if result.returncode == 0:
                 # Move extra files to the extras folder.
                 os.rename(interchange_name, extras_dir + interchange_name)
                 os.rename(config_name, extras_dir + config_name)
 
-            # Move the JSON output file to the extras folder.
+            else:
+                success = False
+                failures.append(subprocess.CalledProcessError(result.returncode, result.args,
+                                                              stderr=result.stderr))
+                print('Error: PopBioWizard failed for {} with exit status {}:\n{}'
+                      .format(interchange_name, result.returncode, result.stderr))
+
+        # Move the JSON output file to the extras folder.
+        if success:
             os.rename(json_output, extras_dir + json_output)
 
+            # The capture store is only a copy of the JSON.
+            if store:
+                shutil.rmtree(store)
+
+    if failures and raise_failure:
+        raise failures[0]
+
 
 @com.run_with_connection
 def get_providers(cur):
@@ -226,4 +641,5 @@ def update_last_download(cur, prefix, time):
 
 if __name__ == '__main__':
     args = vars(parse_args())
+    com.configure_metrics(args.pop('metrics'), args.pop('profile'))
     run_pipeline(**args)
@@ -12,9 +12,10 @@ This script requires at least Python 3.5.
 """
 
 import argparse
-import json
 import re
 
+import psycopg2.extras as pg2_extras
+
 import bg_common as com
 
 
@@ -25,6 +26,7 @@ def parse_args():
     subparsers = parser.add_subparsers(title='subcommands',
                                        help='Add a subcommand name followed by -h for specific '
                                             'help on it.')
+    com.add_metrics_arguments(parser)
 
     # update-traps parser.
     parser_ut = subparsers.add_parser('update-traps',
@@ -96,14 +98,21 @@ def parse_args():
     return args
 
 
+@com.stage('update_traps')
 @com.run_with_connection
-def update_traps(cur, api_key, file):
+def update_traps(cur, api_key, file=None, trap_ids=None):
     """Search a file for new traps and add any that are found.
 
     Arguments:
     api_key -- The API key associated with the trapset to add new traps
         to.
-    file -- A list of filenames to search for new traps.
+    file -- A list of filenames to search for new traps.  Only the trap
+        objects are read from the files; capture data is skipped.
+    trap_ids -- An iterable of trap IDs to check in addition to (or
+        instead of) those found in the files.
+
+    All new traps are inserted in a single statement.  A ValueError is
+    raised if any of them already belongs to another provider.
 
     Note: Omit the 'cur' argument when calling and provide other
     arguments as keyword args.
@@ -120,24 +129,34 @@ def update_traps(cur, api_key, file):
     sql = 'SELECT trap_id FROM traps WHERE prefix = %s'
     cur.execute(sql, (prefix,))
 
-    trap_ids = {row['trap_id'] for row in cur.fetchall()}
-    new_traps = []
+    known_traps = {row['trap_id'] for row in cur.fetchall()}
+
+    # Use a dict as an insertion-ordered set to drop duplicates.
+    new_traps = {}
 
-    for filename in file:
-        with open(filename) as json_f:
-            js = json.load(json_f)
+    sources = [com.iter_trap_ids(filename) for filename in file or []]
 
-            for trap_wrapper in js['traps']:
-                trap_id = trap_wrapper['Trap']['id']
+    if trap_ids is not None:
+        sources.append(trap_ids)
 
-                if trap_id not in trap_ids:
-                    new_traps.append(trap_id)
-                    print('New trap: ' + trap_id)
+    for source in sources:
+        for trap_id in source:
+            if trap_id not in known_traps and trap_id not in new_traps:
+                new_traps[trap_id] = None
+                print('New trap: ' + trap_id)
 
     if new_traps:
-        sql = 'INSERT INTO traps VALUES (%s, %s)'
-        for trap_id in new_traps:
-            cur.execute(sql, (trap_id, prefix))
+        # Let the database handle conflicts so that a trap owned
+        # by another provider doesn't abort the statement midway.
+        sql = 'INSERT INTO traps VALUES %s ON CONFLICT (trap_id) DO NOTHING RETURNING trap_id'
+        rows = pg2_extras.execute_values(cur, sql, [(trap_id, prefix) for trap_id in new_traps],
+                                         page_size=len(new_traps), fetch=True)
+
+        conflicts = set(new_traps) - {row['trap_id'] for row in rows}
+
+        if conflicts:
+            raise ValueError('Trap(s) already belong to another provider: '
+                             + ', '.join(sorted(conflicts)))
 
     else:
         print('No new traps.')
@@ -218,6 +237,7 @@ def non_empty(string):
 
 if __name__ == '__main__':
     args = vars(parse_args())
+    com.configure_metrics(args.pop('metrics'), args.pop('profile'))
 
     # Remove and store arguments that don't get passed to func.
     func = args['func']
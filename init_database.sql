@@ -1,5 +1,6 @@
 /*
  * Creates the schema required for BG-Counter Tools.
+ * To bring an existing database up to date, run update_database.sql.
  * Written for PostgreSQL 9.5.
  */
 
@@ -47,3 +48,17 @@ CREATE TABLE locations (
     offset_longitude longitude NOT NULL,
     PRIMARY KEY (trap_id, true_latitude, true_longitude)
 );
+
+CREATE TABLE checkpoints (
+    trap_id TEXT PRIMARY KEY REFERENCES traps,
+    last_day DATE NOT NULL
+);
+
+CREATE TABLE emitted_ordinals (
+    prefix TEXT NOT NULL REFERENCES providers ON UPDATE CASCADE,
+    year INTEGER NOT NULL,
+    ordinal INTEGER NOT NULL,
+    trap_id TEXT NOT NULL REFERENCES traps,
+    collection_date DATE NOT NULL,
+    PRIMARY KEY (prefix, year, ordinal)
+);
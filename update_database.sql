@@ -0,0 +1,20 @@
+/*
+ * Adds the tables that bg_json_parser.py keeps checkpoints in to
+ * a database created with an earlier version of init_database.sql.
+ * Safe to run more than once.
+ * Written for PostgreSQL 9.5.
+ */
+
+CREATE TABLE IF NOT EXISTS checkpoints (
+    trap_id TEXT PRIMARY KEY REFERENCES traps,
+    last_day DATE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS emitted_ordinals (
+    prefix TEXT NOT NULL REFERENCES providers ON UPDATE CASCADE,
+    year INTEGER NOT NULL,
+    ordinal INTEGER NOT NULL,
+    trap_id TEXT NOT NULL REFERENCES traps,
+    collection_date DATE NOT NULL,
+    PRIMARY KEY (prefix, year, ordinal)
+);